@@ -2,13 +2,26 @@ import streamlit as st
 import pandas as pd
 import openai
 from openai import OpenAI
-from datetime import datetime
+from datetime import date, datetime, time as dt_time, timedelta
 import os
 import json
 import numpy as np
+import openpyxl
 from io import BytesIO
 import sqlite3
+import random
 import re
+import copy
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from types import MappingProxyType
+from urllib.parse import quote
 
 # Set page config
 st.set_page_config(
@@ -451,6 +464,1459 @@ observer.observe(document.body, { childList: true, subtree: true });
 </script>
 """, unsafe_allow_html=True)
 
+# Column keywords that mark product-like columns in the schema summary
+PRODUCT_COLUMN_KEYWORDS = ['product', 'name', 'item', 'sku']
+
+# Columns generated queries filter and group on get an index at ingest time; keywords match whole
+# "_"-separated name parts, and names with a measure part (Avg_..._Change, First_Order_Date) are skipped
+INDEX_COLUMN_KEYWORDS = PRODUCT_COLUMN_KEYWORDS + ['week', 'year', 'vendor', 'date']
+INDEX_MEASURE_PARTS = ['avg', 'change', 'total', 'sum', 'min', 'max', 'first', 'last', 'count']
+
+# Daily order lines are rolled up into weekly tables at ingest, keyed on ISO year/week.
+# Each rollup maps to the extra columns it is grouped by.
+ROLLUP_SOURCE_TABLE = "Raw_Data_Date_Wise"
+ROLLUP_DATE_COLUMN = "Local_Order_Date"
+ROLLUP_QUANTITY_COLUMN = "Sold_Quantity"
+ROLLUP_TABLES = {
+    "Raw_Data_Weekly": [],
+    "Raw_Data_Vendor_Weekly": ["Vendor_Name"],
+    "Raw_Data_SKU_Weekly": ["Item_SKU", "Item_Description"]
+}
+
+# Incremental updates match rows on the first of these keys a table has (case-insensitive). All rows of a key are
+# replaced together when they differ from the workbook; tables with none of the keys are replaced whole if they changed.
+INCREMENTAL_KEYS = (
+    ("Local_Order_Date", "Item_SKU", "Vendor_Name"),
+    ("Year", "Week", "Product_Name"),
+    ("Year", "Week")
+)
+# Rows are grouped on this many leading key columns (an order day, a year) to find changed partitions before comparing rows
+INCREMENTAL_PARTITION_COLUMNS = 1
+
+# Answer cache: repeated questions on the same data generation skip both OpenAI calls
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_TTL_SECONDS = 6 * 60 * 60
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Query watchdog: wall-clock limit per query, VM steps between deadline checks, and the largest
+# number of rows a query plan may be estimated to visit before it is refused
+QUERY_TIMEOUT_SECONDS = 5
+QUERY_PROGRESS_STEPS = 10000
+QUERY_PLAN_MAX_ROWS = 10_000_000
+REJECTED_QUERY_LOG_SIZE = 100
+SQL_KEYWORDS_AFTER_TABLE = frozenset(
+    "where join on using group order left right inner outer cross natural full limit union except intersect having window".split()
+)
+
+# Rows materialised per query, and the share of the answer prompt a result may take
+QUERY_MAX_ROWS = 5000
+RESULT_TOKEN_BUDGET = 1500
+CHARS_PER_TOKEN = 4
+
+# Index advisor: how many executed queries are remembered, and how often a pattern must recur
+QUERY_LOG_SIZE = 500
+INDEX_ADVISOR_MIN_USES = 3
+
+# Per-question prompt metrics kept for the admin panel
+PROMPT_METRICS_SIZE = 200
+
+# Pipeline traces: recent ones in memory for the admin panel, every one appended to a JSONL log
+TRACE_BUFFER_SIZE = 500
+TRACE_LOG_PATH = os.path.join("logs", "pipeline_traces.jsonl")
+TRACE_STAGES = ("queue", "readiness", "summary", "prompt", "first_completion", "sql_parse", "sql_execute", "second_completion", "render")
+SLOWEST_TRACES_SHOWN = 10
+
+# Token and cost accounting: every model call is stored with its usage and an estimate of what filled the prompt.
+# Prices are USD per million gpt-4o-mini tokens.
+USAGE_DB_PATH = os.path.join("data", "usage.db")
+MODEL_PRICE_PER_MILLION = {"input": 0.15, "cached_input": 0.075, "output": 0.60}
+PROMPT_SECTIONS = ("instructions", "schema", "sample_rows", "results", "question")
+USAGE_DAYS_SHOWN = 14
+EXPENSIVE_QUESTIONS_SHOWN = 10
+
+# Shared request executor: questions answered at once, questions allowed to wait, and how often the chat page checks on them.
+# The rate limits match the gpt-4o-mini limits of our OpenAI usage tier.
+ANSWER_MAX_CONCURRENCY = 8
+ANSWER_QUEUE_SIZE = 32
+ANSWER_POLL_SECONDS = 0.5
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 200_000
+RATE_LIMIT_MAX_WAIT_SECONDS = 60
+
+# OpenAI call policy: per-call timeout, retries on 429/5xx with jittered exponential backoff, and an overall
+# deadline per question. Hedging sends a duplicate call once the first is slower than the recent p95.
+OPENAI_TIMEOUT_SECONDS = 30
+OPENAI_MAX_RETRIES = 3
+OPENAI_BACKOFF_BASE_SECONDS = 0.5
+OPENAI_BACKOFF_MAX_SECONDS = 8
+QUESTION_DEADLINE_SECONDS = 90
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+CALL_LATENCY_SAMPLES = 200
+
+# Query protocols: the model either calls the run_sql tool, or writes SQL_QUERY text that is parsed out
+SQL_MODE_TOOLS = "tools"
+SQL_MODE_LEGACY = "legacy"
+SQL_TOOL_MAX_ROUNDS = 3
+# The answer turn of tools mode carries the query results and these guidelines, not the schema prompt or tool definitions
+TOOL_ANSWER_GUIDELINES = (
+    "Answer like a business analyst talking to a colleague: the direct answer first, then the supporting numbers and "
+    "vendor or product names in plain sentences. No numbered or bulleted lists and no bold section headings. Never "
+    "mention tables, sheets, files or the database. For weeks 21-24 say \"units sold\"; for weeks 25-28 say "
+    "\"invoiced units\" or \"supplied units\", never \"units sold\"."
+)
+
+# Fast path: question templates answered straight from SQL, without a model call.
+# Weeks before the cut-over are reported as units sold, later weeks as invoiced/supplied units.
+INVOICED_FROM_WEEK = 25
+ROUTER_DEFAULT_TOP_K = 5
+ROUTER_MAX_TOP_K = 20
+ROUTER_FILLER_WORDS = frozenset(
+    "a all and are at by can did do during for from get give had have how i in is me "
+    "many much number of on our overall please s show tell the there total us was we were what which you".split()
+)
+ROUTER_UNIT_WORDS = frozenset("units unit sold sell sales selling invoiced supplied quantity qty".split())
+ROUTER_COMPARE_WORDS = frozenset("compare comparison compared vs versus v against with to between difference or performance breakdown split share".split())
+ROUTER_RANK_WORDS = frozenset("top best highest most leading performing biggest".split())
+ROUTER_ENTITY_WORDS = {
+    "product": "product", "products": "product", "item": "product", "items": "product", "sku": "product", "skus": "product",
+    "vendor": "vendor", "vendors": "vendor", "branch": "vendor", "branches": "vendor", "store": "vendor", "stores": "vendor"
+}
+ROUTES = ("greeting", "answer_cache", "fast_path", "llm")
+
+# Schema pruning: tables are scored against the question with TF-IDF over their names, column names, original
+# headers and product values. Tables scoring within SCHEMA_RELATIVE_SCORE of the best are kept; below
+# SCHEMA_MIN_SCORE the match is too weak to trust and the full schema is sent instead.
+SCHEMA_MIN_SCORE = 1.0
+SCHEMA_RELATIVE_SCORE = 0.4
+SCHEMA_NAME_REPEATS = 3
+SCHEMA_SYNONYM_WEIGHT = 0.5
+SCHEMA_STOP_WORDS = frozenset(
+    "a all and are as at be by can compare did do does during for from get give had has have how i in is it "
+    "its last me my of on or our please show tell than that the their there these this those to us vs was we "
+    "were what when where which who why with you".split()
+)
+# Business words users say, mapped to the abbreviations and column words the sheets use
+SCHEMA_SYNONYMS = {
+    "media": ("msv",), "organic": ("osv", "org"), "income": ("ni",), "profit": ("ni", "income"), "margin": ("ni",),
+    "revenue": ("sv",), "value": ("sv",), "sale": ("sv", "sold", "quantity"), "sold": ("quantity",), "sell": ("sold", "quantity"),
+    "selling": ("sold", "quantity"), "unit": ("sold", "quantity"), "branch": ("vendor",), "store": ("vendor",),
+    "outlet": ("vendor",), "location": ("vendor",), "day": ("daily", "date", "order"), "daily": ("date", "order"),
+    "date": ("order",), "cost": ("cogs", "tts", "tcs", "cpa"), "acquisition": ("cpa",), "average": ("avg",),
+    "trend": ("change",), "growth": ("change",), "declining": ("change",), "product": ("item", "sku"), "item": ("product",),
+    "invoiced": ("supplied",), "supplied": ("invoiced",)
+}
+RUN_SQL_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "run_sql",
+        "description": "Run one read-only SQLite SELECT statement against the business data and return its columns and rows",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "A single SQLite SELECT statement using the system column names"}
+            },
+            "required": ["query"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Internal bookkeeping tables are prefixed so they never show up as data sources
+INTERNAL_TABLE_PREFIX = "_krispr_"
+CATALOG_TABLE = INTERNAL_TABLE_PREFIX + "catalog"
+# Random id carried from one generation to the next; a database built from scratch gets a new one, so cache keys
+# from deleted data never match a new database that restarts its generation count
+META_TABLE = INTERNAL_TABLE_PREFIX + "meta"
+
+# Entity resolution: every distinct product and vendor name is indexed at ingest, so misspelled or partial names
+# in a question resolve to the exact values in the data. Long multi-line cells are descriptions, not names.
+ENTITY_TABLE = INTERNAL_TABLE_PREFIX + "entities"
+ENTITY_COLUMNS = {"product": ("product_name", "item_description"), "vendor": ("vendor_name",)}
+ENTITY_MAX_LENGTH = 80
+ENTITY_WORD_SIMILARITY = 0.6
+ENTITY_MIN_SCORE = 1.0
+ENTITY_RELATIVE_SCORE = 0.8
+ENTITY_MAX_MATCHES = 6
+# Words of vendor names that questions also use generically ("sales by area")
+ENTITY_STOP_WORDS = frozenset({"area", "areas", "city", "zone", "pack"})
+
+def list_data_tables(conn):
+    """List user data tables, skipping internal bookkeeping and SQLite statistics tables"""
+    cursor = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND substr(name, 1, ?) != ? AND name NOT LIKE 'sqlite!_%' ESCAPE '!' ORDER BY rowid",
+        (len(INTERNAL_TABLE_PREFIX), INTERNAL_TABLE_PREFIX)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def list_table_indexes(conn, table_name):
+    """Return the column tuples of every index on a table"""
+    indexes = []
+    for index_row in conn.execute(f'PRAGMA index_list("{table_name}")').fetchall():
+        columns = tuple(row[2] for row in conn.execute(f'PRAGMA index_info("{index_row[1]}")').fetchall())
+        indexes.append(columns)
+    return indexes
+
+class QueryLog:
+    """Rolling record of recent queries: executed ones for the index advisor, refused ones for the admin panel"""
+    
+    def __init__(self, max_queries=QUERY_LOG_SIZE):
+        self._lock = threading.Lock()
+        self._queries = deque(maxlen=max_queries)
+    
+    def record(self, query):
+        with self._lock:
+            self._queries.append(query)
+    
+    def snapshot(self):
+        with self._lock:
+            return list(self._queries)
+
+class PromptMetricsLog:
+    """Rolling record of prompt build time and prompt size for recent questions"""
+    
+    def __init__(self, max_requests=PROMPT_METRICS_SIZE):
+        self._lock = threading.Lock()
+        self._requests = deque(maxlen=max_requests)
+    
+    def record(self, metrics):
+        with self._lock:
+            self._requests.append(metrics)
+    
+    def snapshot(self):
+        with self._lock:
+            return list(self._requests)
+
+class RouteStats:
+    """Counts how each question was answered, to show the share served without a model call"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+    
+    def record(self, route):
+        with self._lock:
+            self._counts[route] += 1
+    
+    def snapshot(self):
+        with self._lock:
+            return {route: self._counts[route] for route in ROUTES}
+
+class CallStats:
+    """Latency of recent model calls plus retry, hedge and deadline counters"""
+    
+    def __init__(self, max_samples=CALL_LATENCY_SAMPLES):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=max_samples)
+        self._counts = Counter()
+    
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+    
+    def count(self, event):
+        with self._lock:
+            self._counts[event] += 1
+    
+    def percentile(self, percent, min_samples=HEDGE_MIN_SAMPLES):
+        """Latency at the given percentile in seconds, or None until enough calls have been seen"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+    
+    def stats(self):
+        """Return call counters and latency percentiles for the admin panel"""
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            "calls": len(self._latencies),
+            "p50": self.percentile(50, min_samples=1),
+            "p95": self.percentile(95, min_samples=1),
+            **{event: counts.get(event, 0) for event in ("retries", "hedges", "hedge_wins", "deadline_misses")}
+        }
+
+class QuestionDeadlineExceeded(Exception):
+    """The question used up its overall time allowance before the model answered"""
+
+class ModelBusy(RuntimeError):
+    """The model rate limit stayed saturated for longer than the caller can wait"""
+
+# 429s, 5xx responses, timeouts and dropped connections are worth another attempt; other errors are not
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+def retry_delay(attempt, error=None):
+    """Seconds to wait before retry number attempt: the server's Retry-After if given, else full-jitter exponential backoff"""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get('retry-after')), OPENAI_BACKOFF_MAX_SECONDS)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def schema_terms(text):
+    """Lower-case word stems of a question or schema name, split on underscores and camelCase"""
+    words = re.findall(r'[a-z]+', re.sub(r'([a-z])([A-Z])', r'\1 \2', str(text)).lower())
+    terms = []
+    for word in words:
+        if word in SCHEMA_STOP_WORDS:
+            continue
+        if word.endswith("ies") and len(word) > 4:
+            word = word[:-3] + "y"
+        elif word.endswith(("ches", "shes", "sses", "xes")):
+            word = word[:-2]
+        elif word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class SchemaIndex:
+    """TF-IDF index of each table's names, columns, original headers and product values, for picking the tables a question needs"""
+    
+    def __init__(self, tables):
+        documents = {}
+        self.rollups = {}
+        for sheet_name, table_info in tables.items():
+            # The table and sheet names say most about what a table is for, so they count several times
+            text = [table_info['table_name'], sheet_name] * SCHEMA_NAME_REPEATS
+            text += set(table_info['sample_columns']) | set(table_info['column_mapping'].keys())
+            for product_column in table_info['product_columns']:
+                text.extend(value for value in product_column['unique_values'] if isinstance(value, str))
+            documents[table_info['table_name']] = Counter(term for item in text for term in schema_terms(item))
+            if table_info.get('rollup_of'):
+                self.rollups[table_info['table_name']] = table_info['rollup_of']
+        
+        document_frequency = Counter(term for counts in documents.values() for term in counts)
+        idf = {term: np.log((len(documents) + 1) / (frequency + 1)) for term, frequency in document_frequency.items()}
+        self.weights = {
+            table_name: {term: (1 + np.log(count)) * idf[term] for term, count in counts.items() if idf[term] > 0}
+            for table_name, counts in documents.items()
+        }
+    
+    def score(self, question):
+        """TF-IDF score of every table for the question; a word the schema lacks may match through a synonym, at a discount"""
+        terms = set(schema_terms(question))
+        scores = {}
+        for table_name, weights in self.weights.items():
+            score = 0.0
+            for term in terms:
+                synonym = max((weights.get(synonym, 0.0) for synonym in SCHEMA_SYNONYMS.get(term, ())), default=0.0)
+                score += max(weights.get(term, 0.0), synonym * SCHEMA_SYNONYM_WEIGHT)
+            scores[table_name] = float(score)
+        return scores
+    
+    def select(self, question):
+        """Tables the question needs, or None when the match is too weak and the full schema should be sent"""
+        scores = self.score(question)
+        best = max(scores.values(), default=0.0)
+        if best < SCHEMA_MIN_SCORE:
+            return None
+        selected = {table_name for table_name, score in scores.items() if score >= best * SCHEMA_RELATIVE_SCORE}
+        
+        # A rollup and its daily source answer the same questions at different grains, so they travel together
+        for rollup, source in self.rollups.items():
+            if rollup in selected or source in selected:
+                selected.update((rollup, source))
+        selected &= set(scores)
+        return None if len(selected) == len(scores) else frozenset(selected)
+
+def entity_columns(columns):
+    """(kind, column) for each product or vendor name column, matched case-insensitively"""
+    return [(kind, column) for column in columns for kind, names in ENTITY_COLUMNS.items() if column.lower() in names]
+
+def name_words(text):
+    """Lower-case words and sizes of a name or question, such as 'basil' or '75g'"""
+    return re.findall(r'[a-z0-9]+', str(text).lower())
+
+def word_trigrams(word):
+    """Character trigrams of a word, padded so the start of the word counts most"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class EntityIndex:
+    """Trigram index over every distinct product and vendor name, resolving misspelled or partial names in a question"""
+    
+    def __init__(self, rows):
+        # rows are (kind, value, table_name, column_name); the same name may live in several tables
+        self.entities = []
+        self.locations = {}
+        for kind, value, table_name, column_name in rows:
+            if value is None or len(str(value)) > ENTITY_MAX_LENGTH or "\n" in str(value):
+                continue
+            key = (kind, str(value).strip())
+            if key not in self.locations:
+                self.entities.append(key)
+                self.locations[key] = []
+            self.locations[key].append(f"{table_name}.{column_name}")
+        
+        self.word_entities = {}
+        for entity_id, (kind, value) in enumerate(self.entities):
+            for word in set(name_words(value)):
+                self.word_entities.setdefault(word, set()).add(entity_id)
+        
+        # A word shared by every name of its kind (Krispr, Talabat) identifies nothing, so it weighs nothing
+        kind_sizes = Counter(kind for kind, _ in self.entities)
+        self.word_weights = {}
+        for word, entity_ids in self.word_entities.items():
+            for kind, count in Counter(self.entities[entity_id][0] for entity_id in entity_ids).items():
+                self.word_weights[(word, kind)] = float(np.log(kind_sizes[kind] / count))
+        
+        self.trigram_words = {}
+        self.trigram_counts = {}
+        for word in self.word_entities:
+            grams = word_trigrams(word)
+            self.trigram_counts[word] = len(grams)
+            for gram in grams:
+                self.trigram_words.setdefault(gram, set()).add(word)
+    
+    def similar_words(self, word):
+        """Indexed words close to word: Dice similarity of trigrams, or a prefix of at least four letters"""
+        grams = word_trigrams(word)
+        shared = Counter(candidate for gram in grams for candidate in self.trigram_words.get(gram, ()))
+        similar = {}
+        for candidate, count in shared.items():
+            similarity = 2 * count / (len(grams) + self.trigram_counts[candidate])
+            if len(word) >= 4 and candidate.startswith(word):
+                similarity = max(similarity, 0.9)
+            if similarity >= ENTITY_WORD_SIMILARITY:
+                similar[candidate] = similarity
+        return similar
+    
+    def resolve(self, question):
+        """Names the question refers to, best first: dicts with kind, value, score and the table.column locations"""
+        scores = Counter()
+        for word in set(name_words(question)):
+            if len(word) < 3 or word.isdigit() or word in SCHEMA_STOP_WORDS or word in ENTITY_STOP_WORDS:
+                continue
+            best = {}
+            for candidate, similarity in self.similar_words(word).items():
+                for entity_id in self.word_entities[candidate]:
+                    score = similarity * self.word_weights[(candidate, self.entities[entity_id][0])]
+                    best[entity_id] = max(best.get(entity_id, 0.0), score)
+            scores.update(best)
+        
+        matches = []
+        for kind in ENTITY_COLUMNS:
+            kind_scores = {entity_id: score for entity_id, score in scores.items() if self.entities[entity_id][0] == kind}
+            if not kind_scores:
+                continue
+            threshold = max(ENTITY_MIN_SCORE, max(kind_scores.values()) * ENTITY_RELATIVE_SCORE)
+            for entity_id, score in sorted(kind_scores.items(), key=lambda item: -item[1]):
+                if score >= threshold:
+                    kind_name, value = self.entities[entity_id]
+                    matches.append({"kind": kind_name, "value": value, "score": round(score, 2), "locations": self.locations[(kind_name, value)]})
+        return sorted(matches, key=lambda match: -match['score'])[:ENTITY_MAX_MATCHES]
+
+class RequestTrace:
+    """Timing spans for one question as it moves through the pipeline; stages that repeat add up"""
+    
+    def __init__(self, question):
+        self.id = uuid.uuid4().hex[:12]
+        self.question = question
+        self.at = datetime.now().isoformat(timespec='seconds')
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.sql = []
+        self.schema_tables = None
+        self.entities = []
+        self.route = None
+        self.total_ms = None
+    
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, (time.perf_counter() - start) * 1000)
+    
+    def add(self, stage, ms):
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+    
+    def timed_stream(self, chunks, stage, finish=True):
+        """Pass a streamed answer through, adding the time spent reading it to stage"""
+        start = time.perf_counter()
+        try:
+            yield from chunks
+        finally:
+            self.add(stage, (time.perf_counter() - start) * 1000)
+            if finish:
+                self.finish()
+    
+    def finish(self):
+        """Close the trace and record it; later calls do nothing"""
+        if self.total_ms is None:
+            self.total_ms = (time.perf_counter() - self.started) * 1000
+            get_trace_log().record(self.to_dict())
+    
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "at": self.at,
+            "question": self.question,
+            "route": self.route,
+            "total_ms": round(self.total_ms, 1),
+            "stages": {stage: round(ms, 1) for stage, ms in self.stages.items()},
+            "sql": self.sql,
+            "schema_tables": self.schema_tables,
+            "entities": self.entities
+        }
+
+class TraceLog:
+    """Rolling buffer of recent pipeline traces, each also appended to a JSONL file"""
+    
+    def __init__(self, max_traces=TRACE_BUFFER_SIZE, path=TRACE_LOG_PATH):
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=max_traces)
+        self.path = path
+    
+    def record(self, trace):
+        line = json.dumps(trace, default=str)
+        with self._lock:
+            self._traces.append(trace)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError:
+                # The in-memory buffer still has it; tracing must never break answering
+                pass
+    
+    def snapshot(self):
+        with self._lock:
+            return list(self._traces)
+    
+    def stage_percentiles(self):
+        """Count, p50, p95 and max in ms for each stage seen in the buffer, plus the whole request"""
+        samples = {}
+        for trace in self.snapshot():
+            for stage, ms in trace['stages'].items():
+                samples.setdefault(stage, []).append(ms)
+            samples.setdefault("total", []).append(trace['total_ms'])
+        rows = []
+        for stage in TRACE_STAGES + ("total",):
+            values = sorted(samples.get(stage, []))
+            if values:
+                rows.append({
+                    "stage": stage,
+                    "count": len(values),
+                    "p50_ms": values[len(values) // 2],
+                    "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+                    "max_ms": values[-1]
+                })
+        return rows
+    
+    def slowest(self, count=SLOWEST_TRACES_SHOWN):
+        return sorted(self.snapshot(), key=lambda trace: trace['total_ms'], reverse=True)[:count]
+
+def estimate_prompt_sections(messages, tools=None):
+    """Approximate the tokens of a request by what they carry: instructions, schema, sample rows, query results and the question"""
+    chars = dict.fromkeys(PROMPT_SECTIONS, 0)
+    chars['instructions'] += len(json.dumps(tools)) if tools else 0
+    for message in messages:
+        content = message.get('content') or ''
+        if message['role'] == 'user':
+            chars['question'] += len(content)
+            continue
+        if message['role'] != 'system':
+            # Tool results, and the assistant turns that requested them
+            chars['results'] += len(content) + len(json.dumps(message.get('tool_calls') or ''))
+            continue
+        results = re.search(r'Results:(.*?)Based on these results', content, re.DOTALL)
+        if results:
+            chars['results'] += len(results.group(1))
+            content = content.replace(results.group(1), '')
+        schema_start = content.find("AVAILABLE DATA SOURCES AND SCHEMA:")
+        schema_end = content.find("INSTRUCTIONS:")
+        if 0 <= schema_start < schema_end:
+            schema = content[schema_start:schema_end]
+            samples = sum(len(line) for line in re.findall(r'^\s*(?:Row \d+:|Sample products:).*$', schema, re.MULTILINE))
+            chars['sample_rows'] += samples
+            chars['schema'] += len(schema) - samples
+            content = content[:schema_start] + content[schema_end:]
+        chars['instructions'] += len(content)
+    return {section: count // CHARS_PER_TOKEN for section, count in chars.items()}
+
+def usage_cost(prompt_tokens, completion_tokens, cached_tokens=0):
+    """USD cost of one call at the gpt-4o-mini prices"""
+    return (
+        (prompt_tokens - cached_tokens) * MODEL_PRICE_PER_MILLION['input']
+        + cached_tokens * MODEL_PRICE_PER_MILLION['cached_input']
+        + completion_tokens * MODEL_PRICE_PER_MILLION['output']
+    ) / 1_000_000
+
+class UsageStore:
+    """Local SQLite record of every model call's tokens and cost, aggregated per question, stage, session and day"""
+    
+    def __init__(self, path=USAGE_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = None
+        self.path = path
+    
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS usage_calls (
+                    at TEXT, day TEXT, session TEXT, question_id TEXT, question TEXT, stage TEXT, mode TEXT,
+                    prompt_tokens INTEGER, completion_tokens INTEGER, cached_tokens INTEGER, cost_usd REAL,
+                    {", ".join(f"est_{section} INTEGER" for section in PROMPT_SECTIONS)}
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_calls_day ON usage_calls(day)")
+        return self._conn
+    
+    def record(self, call):
+        """Store one call; accounting must never break answering, so storage errors are dropped"""
+        columns = ["at", "day", "session", "question_id", "question", "stage", "mode", "prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd"]
+        values = [call[column] for column in columns] + [call['sections'][section] for section in PROMPT_SECTIONS]
+        columns += [f"est_{section}" for section in PROMPT_SECTIONS]
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute(f"INSERT INTO usage_calls ({', '.join(columns)}) VALUES ({', '.join('?' * len(values))})", values)
+                conn.commit()
+            except (OSError, sqlite3.Error):
+                pass
+    
+    def query(self, sql, params=()):
+        with self._lock:
+            try:
+                conn = self._connection()
+                return pd.read_sql_query(sql, conn, params=params)
+            except (OSError, sqlite3.Error, pd.errors.DatabaseError):
+                return pd.DataFrame()
+    
+    def daily(self, days=USAGE_DAYS_SHOWN):
+        return self.query("""
+            SELECT day, COUNT(DISTINCT question_id) AS questions, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(completion_tokens) AS completion_tokens, SUM(cost_usd) AS cost_usd
+            FROM usage_calls GROUP BY day ORDER BY day DESC LIMIT ?
+        """, (days,))
+    
+    def by_stage(self):
+        """Actual tokens per stage next to the estimated make-up of its prompts"""
+        return self.query(f"""
+            SELECT stage, COUNT(*) AS calls, AVG(prompt_tokens) AS avg_prompt_tokens, AVG(completion_tokens) AS avg_completion_tokens,
+                   SUM(cost_usd) AS cost_usd, {", ".join(f"AVG(est_{section}) AS {section}" for section in PROMPT_SECTIONS)}
+            FROM usage_calls GROUP BY stage ORDER BY stage
+        """)
+    
+    def by_session(self, limit=EXPENSIVE_QUESTIONS_SHOWN):
+        return self.query("""
+            SELECT session, MIN(at) AS first_call, COUNT(DISTINCT question_id) AS questions,
+                   SUM(prompt_tokens + completion_tokens) AS tokens, SUM(cost_usd) AS cost_usd
+            FROM usage_calls GROUP BY session ORDER BY cost_usd DESC LIMIT ?
+        """, (limit,))
+    
+    def top_questions(self, limit=EXPENSIVE_QUESTIONS_SHOWN):
+        return self.query(f"""
+            SELECT MIN(at) AS at, question, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(completion_tokens) AS completion_tokens, SUM(cost_usd) AS cost_usd,
+                   {", ".join(f"SUM(est_{section}) AS {section}" for section in PROMPT_SECTIONS)}
+            FROM usage_calls GROUP BY question_id ORDER BY cost_usd DESC LIMIT ?
+        """, (limit,))
+
+def round_trip_summary(requests):
+    """Aggregate prompt metrics per query mode: questions, answered share and model round trips per answered question"""
+    summary = {}
+    for request in requests:
+        mode = summary.setdefault(request['mode'], {"questions": 0, "answered": 0, "round_trips": 0})
+        mode['questions'] += 1
+        mode['answered'] += request['answered']
+        mode['round_trips'] += request['round_trips']
+    for mode in summary.values():
+        mode['answered_share'] = mode['answered'] / mode['questions']
+        mode['round_trips_per_answer'] = mode['round_trips'] / mode['answered'] if mode['answered'] else None
+    return summary
+
+def get_database_stamp(db_path):
+    """Identify the current database file by inode, modification time and size"""
+    try:
+        file_stat = os.stat(db_path)
+    except OSError:
+        return None
+    return (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+def freeze_summary(value):
+    """Convert a summary into read-only containers so every session can share it"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_summary(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_summary(item) for item in value)
+    return value
+
+class DatabaseSnapshotCache:
+    """Process-wide value derived from the database file, rebuilt only when the file changes"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, db_path, build_value):
+        """Return the value for the current database file, calling build_value on a miss"""
+        stamp = get_database_stamp(db_path)
+        if stamp is None:
+            return None
+        
+        # Building under the lock means concurrent sessions wait for one build instead of repeating it
+        with self._lock:
+            entry = self._entries.get(db_path)
+            if entry and entry[0] == stamp:
+                self.hits += 1
+                return entry[1]
+            
+            self.misses += 1
+            value = build_value()
+            if value is None:
+                return None
+            value = freeze_summary(value)
+            self._entries[db_path] = (stamp, value)
+            return value
+    
+    def put(self, db_path, value):
+        """Publish a freshly generated value for the current database file"""
+        value = freeze_summary(value)
+        with self._lock:
+            self._entries[db_path] = (get_database_stamp(db_path), value)
+        return value
+    
+    def stats(self):
+        """Return hit/miss counters for the admin panel"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "cached_databases": len(self._entries)
+            }
+
+# Streaming ingest: rows per executemany batch, and the upload size that switches it on by default
+INGEST_BATCH_ROWS = 5000
+STREAMING_INGEST_MIN_BYTES = 10 * 1024 * 1024
+
+class DatabaseUnchanged(Exception):
+    """An incremental update found no rows in the workbook that differ from the live database"""
+
+class RowDigest:
+    """SQLite aggregate hashing a multiset of rows, so two tables compare without sorting them; equal values hash equally (1 == 1.0)"""
+    
+    def __init__(self):
+        self.total = 0
+    
+    def step(self, *values):
+        self.total += hash(values)
+    
+    def finalize(self):
+        return self.total % (1 << 63)
+
+def match_columns(left, right, columns):
+    """SQL condition that two aliases agree on columns; IS, not =, so blank values still match each other"""
+    return " AND ".join(f'{left}."{col}" IS {right}."{col}"' for col in columns)
+
+# Read connection tuning: memory-map the file and keep a generous page cache per connection
+READ_POOL_SIZE = 8
+READ_MMAP_SIZE = 256 * 1024 * 1024
+READ_CACHE_SIZE_KB = 64 * 1024
+
+class ReadConnectionPool:
+    """Process-wide pool of read-only SQLite connections, reused across requests and sessions"""
+    
+    def __init__(self, max_idle=READ_POOL_SIZE):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self.max_idle = max_idle
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+    
+    def _open(self, db_path):
+        """Open a read-only connection with query tuning pragmas applied"""
+        uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={READ_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{READ_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+    
+    @contextmanager
+    def connection(self, db_path):
+        """Check out a connection for the current database file and return it to the pool afterwards"""
+        stamp = get_database_stamp(db_path)
+        if stamp is None:
+            raise FileNotFoundError(f"Database file not found: {db_path}")
+        
+        conn = None
+        stale = []
+        with self._lock:
+            idle = self._idle.setdefault(db_path, [])
+            while idle:
+                conn_stamp, candidate = idle.pop()
+                if conn_stamp == stamp:
+                    conn = candidate
+                    self.reused += 1
+                    break
+                stale.append(candidate)
+            self.discarded += len(stale)
+        
+        # Connections opened on an older file keep reading that file, so they are never reused
+        for candidate in stale:
+            candidate.close()
+        
+        if conn is None:
+            conn = self._open(db_path)
+            with self._lock:
+                self.opened += 1
+        
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(db_path, [])
+                if len(idle) < self.max_idle and get_database_stamp(db_path) == stamp:
+                    idle.append((stamp, conn))
+                    conn = None
+                else:
+                    self.discarded += 1
+            if conn is not None:
+                conn.close()
+    
+    def invalidate(self, db_path):
+        """Close idle connections for a database that has just been replaced"""
+        with self._lock:
+            idle = self._idle.pop(db_path, [])
+            self.discarded += len(idle)
+        for _, conn in idle:
+            conn.close()
+    
+    def stats(self):
+        """Return pool counters for the admin panel"""
+        with self._lock:
+            return {
+                "opened": self.opened,
+                "reused": self.reused,
+                "discarded": self.discarded,
+                "idle": sum(len(idle) for idle in self._idle.values())
+            }
+
+@st.cache_resource
+def get_read_pool():
+    """Read connection pool shared by all sessions and reruns of this process"""
+    return ReadConnectionPool()
+
+# In-memory replica: database files up to this size are copied into process memory and serve generated queries.
+# Shared in-memory databases use the memdb VFS, which needs SQLite 3.36 or later.
+MEMORY_REPLICA_MAX_BYTES = 512 * 1024 * 1024
+MEMORY_REPLICA_MIN_SQLITE = (3, 36, 0)
+
+class MemoryReplica:
+    """Process-wide in-memory copy of each database file, loaded with the backup API and replaced whole per file version"""
+    
+    def __init__(self, max_bytes=MEMORY_REPLICA_MAX_BYTES, max_idle=READ_POOL_SIZE):
+        self._lock = threading.Lock()
+        self._replicas = {}
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle
+        self.loads = 0
+        self.last_load_ms = None
+        self.opened = 0
+        self.reused = 0
+        self.fallbacks = 0
+        self.disabled_reason = None
+        if sqlite3.sqlite_version_info < MEMORY_REPLICA_MIN_SQLITE:
+            self.disabled_reason = f"SQLite {sqlite3.sqlite_version} has no memdb VFS (needs {'.'.join(map(str, MEMORY_REPLICA_MIN_SQLITE))})"
+    
+    def refresh(self, db_path):
+        """Return the replica of the current database file, copying the file into memory first if it changed"""
+        with self._lock:
+            replica, closing = self._refresh_locked(db_path)
+        for handle in closing:
+            handle.close()
+        return replica
+    
+    def _refresh_locked(self, db_path):
+        """Bring the replica of db_path up to date; caller holds the lock. Returns the replica (or None) and handles to close"""
+        if self.disabled_reason:
+            return None, []
+        
+        # The stamp is read under the lock, so a file swap triggers exactly one reload
+        stamp = get_database_stamp(db_path)
+        previous = self._replicas.get(db_path)
+        if previous is not None and previous['stamp'] == stamp:
+            return previous, []
+        
+        # Files that are gone or too large are read from disk; any older copy is dropped rather than served
+        if stamp is None or stamp[2] > self.max_bytes:
+            self._replicas.pop(db_path, None)
+            replica = None
+        else:
+            try:
+                replica = self._load(db_path, stamp)
+            except (sqlite3.Error, MemoryError) as e:
+                # Queries go back to reading the file for good rather than failing on every load attempt
+                self.disabled_reason = f"Replica load failed: {e}"
+                self._replicas.pop(db_path, None)
+                replica = None
+        return replica, self._retire(previous) if previous is not None else []
+    
+    def _retire(self, replica):
+        """Take a replaced replica out of service; caller holds the lock. Returns the handles that can be closed now"""
+        replica['retired'] = True
+        closing, replica['idle'] = replica['idle'], []
+        # The anchor keeps the in-memory database alive until the last checked-out connection is returned
+        if replica['users'] == 0:
+            closing.append(replica['anchor'])
+        return closing
+    
+    def _load(self, db_path, stamp):
+        """Copy the database file into a new in-memory database and make it the current replica; caller holds the lock"""
+        # Loading under the lock makes concurrent sessions wait for one copy instead of each making their own
+        load_start = time.perf_counter()
+        uri = f"file:/krispr-replica-{uuid.uuid4().hex}?vfs=memdb"
+        anchor = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+        try:
+            source.backup(anchor)
+        except Exception:
+            anchor.close()
+            raise
+        finally:
+            source.close()
+        
+        # Readers switch only once the copy is complete, so every query sees exactly one data generation
+        replica = {"stamp": stamp, "uri": uri, "anchor": anchor, "idle": [], "users": 0, "retired": False}
+        self._replicas[db_path] = replica
+        self.loads += 1
+        self.last_load_ms = (time.perf_counter() - load_start) * 1000
+        return replica
+    
+    @contextmanager
+    def connection(self, db_path):
+        """Check out a read connection on the current replica, or a pooled file connection if there is none"""
+        conn = None
+        with self._lock:
+            replica, closing = self._refresh_locked(db_path)
+            if replica is None:
+                self.fallbacks += 1
+            else:
+                # Counted before the lock is released, so a swap from here on cannot close the anchor under us
+                replica['users'] += 1
+                if replica['idle']:
+                    conn = replica['idle'].pop()
+                    self.reused += 1
+        for handle in closing:
+            handle.close()
+        
+        if replica is None:
+            with get_read_pool().connection(db_path) as conn:
+                yield conn
+            return
+        
+        try:
+            if conn is None:
+                conn = sqlite3.connect(replica['uri'], uri=True, check_same_thread=False)
+                # A memory map lets reads use the replica's pages in place instead of copying them into the page cache
+                conn.execute(f"PRAGMA mmap_size={READ_MMAP_SIZE}")
+                conn.execute("PRAGMA query_only=ON")
+                with self._lock:
+                    self.opened += 1
+            yield conn
+        finally:
+            closing = []
+            with self._lock:
+                replica['users'] -= 1
+                if conn is not None:
+                    if not replica['retired'] and len(replica['idle']) < self.max_idle:
+                        replica['idle'].append(conn)
+                    else:
+                        closing.append(conn)
+                if replica['retired'] and replica['users'] == 0:
+                    closing.append(replica['anchor'])
+            for handle in closing:
+                handle.close()
+    
+    def stats(self):
+        """Return replica counters for the admin panel"""
+        with self._lock:
+            return {
+                "replicas": len(self._replicas),
+                "bytes": sum(replica['stamp'][2] for replica in self._replicas.values()),
+                "loads": self.loads,
+                "last_load_ms": self.last_load_ms,
+                "opened": self.opened,
+                "reused": self.reused,
+                "fallbacks": self.fallbacks,
+                "disabled_reason": self.disabled_reason
+            }
+
+@st.cache_resource
+def get_memory_replica():
+    """In-memory database replica shared by all sessions and reruns of this process"""
+    return MemoryReplica()
+
+def strip_sql_markdown(query):
+    """Generated SQL statement as it should run: no markdown or HTML around it, no trailing semicolons"""
+    # Remove ```sql and ``` markers
+    query = query.replace("```sql", "").replace("```", "").strip()
+    # Remove any remaining markdown or HTML
+    query = query.replace("<code>", "").replace("</code>", "").strip()
+    return query.rstrip(";").rstrip()
+
+# String literals and quoted names are matched first, so comment markers and spacing inside them are kept
+SQL_LAYOUT_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|(?:--[^\n]*|/\*.*?(?:\*/|$)|\s)+""", re.DOTALL)
+
+def normalize_sql_query(query):
+    """Canonical form of a generated SQL statement for cache keys and logs: no markdown or comments, single spaces outside literals, one trailing semicolon"""
+    # Comments and runs of whitespace become one space; literals are copied as they are
+    query = SQL_LAYOUT_PATTERN.sub(lambda match: match.group(1) or " ", strip_sql_markdown(query))
+    query = query.strip().rstrip(";").rstrip()
+    return query + ";" if query else ""
+
+def normalize_question(question):
+    """Canonical form of a question for cache keys: lowercase words and numbers only"""
+    return " ".join(re.sub(r'[^\w\s]', ' ', question.lower()).split())
+
+def match_question_template(question):
+    """Map a question onto one of the fast-path templates, returning (intent, slots) or None"""
+    # Every word has to be part of the template or filler, so questions with extra conditions
+    # (a product name, a date range, ...) are left to the model
+    words = re.sub(r'\b(weeks?|wk)(\d{1,2})\b', r'\1 \2', normalize_question(question)).split()
+    weeks, top_k, keywords = [], None, set()
+    for position, word in enumerate(words):
+        previous = words[position - 1] if position else ""
+        if word.isdigit():
+            if previous in ("week", "weeks", "wk") or (weeks and previous in ("and", "vs", "versus", "to", "with", "or")):
+                weeks.append(int(word))
+            elif previous in ROUTER_RANK_WORDS and top_k is None:
+                top_k = int(word)
+            else:
+                return None
+        elif word in ("week", "weeks", "wk"):
+            continue
+        elif word not in ROUTER_FILLER_WORDS:
+            keywords.add(word)
+    
+    entities = {ROUTER_ENTITY_WORDS[word] for word in keywords if word in ROUTER_ENTITY_WORDS}
+    if len(set(weeks)) != len(weeks) or not 1 <= len(weeks) <= 2:
+        return None
+    
+    if len(weeks) == 1 and {"media", "organic"} <= keywords and keywords <= {"media", "organic"} | ROUTER_UNIT_WORDS | ROUTER_COMPARE_WORDS:
+        return "media_organic", {"week": weeks[0]}
+    if len(weeks) == 1 and len(entities) == 1 and keywords & ROUTER_RANK_WORDS and keywords <= ROUTER_RANK_WORDS | ROUTER_UNIT_WORDS | set(ROUTER_ENTITY_WORDS):
+        singular = any(word in keywords for word in ("product", "item", "sku", "vendor", "branch", "store"))
+        k = top_k if top_k is not None else (1 if singular else ROUTER_DEFAULT_TOP_K)
+        return "top_k", {"week": weeks[0], "entity": entities.pop(), "k": max(1, min(k, ROUTER_MAX_TOP_K))}
+    if top_k is not None or entities:
+        return None
+    if len(weeks) == 2 and keywords & ROUTER_COMPARE_WORDS and keywords <= ROUTER_UNIT_WORDS | ROUTER_COMPARE_WORDS:
+        return "compare_weeks", {"weeks": weeks}
+    if len(weeks) == 1 and keywords & ROUTER_UNIT_WORDS and keywords <= ROUTER_UNIT_WORDS:
+        return "units", {"week": weeks[0]}
+    return None
+
+def format_units(value):
+    """Format a unit count for a templated answer"""
+    return f"{value:,.0f}"
+
+def join_names(names):
+    """Join names as 'A, B and C'"""
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+
+class BoundedCache:
+    """Thread-safe LRU cache with an entry limit, optional byte budget and optional per-entry time-to-live"""
+    
+    def __init__(self, max_entries, ttl_seconds=None, max_bytes=None, sizeof=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _discard(self, key):
+        value, stored_at, size = self._entries.pop(key)
+        self.total_bytes -= size
+        self.evictions += 1
+    
+    def get(self, key):
+        """Return the cached value, or None when missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds is not None and time.monotonic() - entry[1] > self.ttl_seconds:
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value):
+        """Store a value, evicting least recently used entries to stay within the limits"""
+        size = self.sizeof(value) if self.sizeof else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[2]
+            self._entries[key] = (value, time.monotonic(), size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self._discard(next(iter(self._entries)))
+        return True
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+    
+    def stats(self):
+        """Return counters for the admin panel"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "evictions": self.evictions,
+                "bytes": self.total_bytes
+            }
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at a per-minute rate, holding at most ten seconds' worth"""
+    
+    def __init__(self, per_minute):
+        self._lock = threading.Lock()
+        self.rate = per_minute / 60
+        self.capacity = max(1, per_minute / 6)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self.waits = 0
+        self.wait_seconds = 0.0
+    
+    def acquire(self, amount=1, max_wait=RATE_LIMIT_MAX_WAIT_SECONDS):
+        """Take tokens, sleeping until they are available; returns False if that would take longer than max_wait"""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    if waited:
+                        self.waits += 1
+                        self.wait_seconds += waited
+                    return True
+                delay = (amount - self._tokens) / self.rate
+            if waited + delay > max_wait:
+                return False
+            time.sleep(delay)
+            waited += delay
+    
+    def release(self, amount=1):
+        """Give back tokens taken for a call that was then not made"""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + min(amount, self.capacity))
+
+class RateLimiter:
+    """Keeps model calls from every session under the account's requests and tokens per minute"""
+    
+    def __init__(self, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE, tokens_per_minute=OPENAI_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+    
+    def acquire(self, estimated_tokens, max_wait=RATE_LIMIT_MAX_WAIT_SECONDS):
+        if not self.requests.acquire(1, max_wait):
+            raise ModelBusy("The model rate limit is saturated; try again shortly")
+        if not self.tokens.acquire(estimated_tokens, max_wait):
+            # The call is not made, so its request slot goes back for the next caller
+            self.requests.release(1)
+            raise ModelBusy("The model rate limit is saturated; try again shortly")
+    
+    def stats(self):
+        return {
+            "waits": self.requests.waits + self.tokens.waits,
+            "wait_seconds": self.requests.wait_seconds + self.tokens.wait_seconds
+        }
+
+class RequestExecutor:
+    """Process-wide worker pool for chat questions, with a concurrency limit and a bounded queue"""
+    
+    def __init__(self, max_workers=ANSWER_MAX_CONCURRENCY, max_queued=ANSWER_QUEUE_SIZE):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="krispr-answer")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.submitted = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+    
+    def submit(self, fn, *args):
+        """Queue fn(*args); returns None instead of queueing when the executor is full"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        with self._lock:
+            self.submitted += 1
+        # Jobs get no script context: everything they produce goes through their PendingAnswer, never st.*
+        return self._pool.submit(self._run, fn, args)
+    
+    def _run(self, fn, args):
+        with self._lock:
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+            self._slots.release()
+    
+    def stats(self):
+        """Return executor counters for the admin panel"""
+        with self._lock:
+            return {
+                "running": self.running,
+                "queued": self.submitted - self.completed - self.running,
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+class PendingAnswer:
+    """An answer being produced on the executor; the chat page polls it and redraws the text produced so far"""
+    
+    def __init__(self, question):
+        self.question = question
+        self.trace = RequestTrace(question)
+        self._condition = threading.Condition()
+        self._parts = []
+        self.finished = False
+    
+    def append(self, text):
+        with self._condition:
+            self._parts.append(text)
+            self._condition.notify_all()
+    
+    def finish(self):
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+    
+    def snapshot(self):
+        """Return the text produced so far and whether the answer is finished, without waiting"""
+        with self._condition:
+            return "".join(self._parts), self.finished
+    
+    def chunks(self):
+        """Yield the text produced so far, then new text until the answer is finished"""
+        position = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._parts) > position or self.finished)
+                new_parts = self._parts[position:]
+                finished = self.finished
+            position += len(new_parts)
+            yield from new_parts
+            if finished:
+                return
+
+class QueryRejected(Exception):
+    """A generated query was refused or stopped by the query watchdog"""
+
+READ_ONLY_REJECTION = "Only read-only SELECT statements are allowed"
+
+# Everything a plain SELECT (with CTEs and functions) asks the authorizer for; writes, ATTACH and PRAGMA are not here
+READ_ONLY_ACTIONS = frozenset({sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE})
+
+def check_read_only_query(query):
+    """Return why a query may not run, or None for a single read-only SELECT"""
+    statement = re.sub(r'^(\s*(--[^\n]*\n|/\*.*?\*/))*', '', query, flags=re.DOTALL).strip()
+    if not re.match(r'(SELECT|WITH)\b', statement, re.IGNORECASE):
+        return READ_ONLY_REJECTION
+    return None
+
+@contextmanager
+def read_only_statements(conn):
+    """Refuse, when they are prepared, statements in the block that would do more than read (e.g. WITH ... DELETE)"""
+    conn.set_authorizer(lambda action, *_: sqlite3.SQLITE_OK if action in READ_ONLY_ACTIONS else sqlite3.SQLITE_DENY)
+    try:
+        yield
+    finally:
+        conn.set_authorizer(None)
+
+def query_table_aliases(query, table_names):
+    """Map the aliases used in a query (FROM Overall o, JOIN "Media" AS m) to their table names"""
+    aliases = {}
+    for table, alias in re.findall(r'(?:\bFROM|\bJOIN|,)\s*"?(\w+)"?(?:\s+(?:AS\s+)?"?(\w+)"?)?', query, re.IGNORECASE):
+        if table in table_names and alias and alias.lower() not in SQL_KEYWORDS_AFTER_TABLE:
+            aliases[alias] = table
+    return aliases
+
+def estimate_plan_rows(plan, table_rows, aliases):
+    """Rough upper bound on rows a query plan visits: full scans under the same parent are nested loops, so they multiply"""
+    scans = {}
+    for node_id, parent, _, detail in plan:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match and match.group(1) != "CONSTANT":
+            name = aliases.get(match.group(1), match.group(1))
+            scans.setdefault(parent, []).append(table_rows.get(name))
+    
+    # Scans of CTEs and subqueries have no catalog size; assume the largest table involved
+    fallback = max((rows for sizes in scans.values() for rows in sizes if rows is not None), default=1)
+    estimate = 0
+    for sizes in scans.values():
+        loop_rows = 1
+        for rows in sizes:
+            loop_rows *= rows if rows is not None else fallback
+        estimate = max(estimate, loop_rows)
+    return estimate
+
+@contextmanager
+def query_deadline(conn, seconds=QUERY_TIMEOUT_SECONDS):
+    """Interrupt statements run inside the block once the deadline passes"""
+    deadline = time.monotonic() + seconds
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, QUERY_PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, 0)
+
+class QueryResult:
+    """Read-only query result stored column by column; far smaller than a list of row tuples"""
+    
+    __slots__ = ("columns", "values", "row_count", "truncated")
+    
+    def __init__(self, columns, rows, truncated=False):
+        self.columns = tuple(columns)
+        self.values = tuple(zip(*rows)) if rows else tuple(() for _ in self.columns)
+        self.row_count = len(rows)
+        self.truncated = truncated
+    
+    def rows(self):
+        """Rebuild the row tuples in their original order"""
+        return list(zip(*self.values)) if self.row_count else []
+    
+    def nbytes(self):
+        """Approximate memory held by the result, counting each distinct value object once"""
+        seen = set()
+        total = sys.getsizeof(self.columns) + sys.getsizeof(self.values)
+        for column in self.values:
+            total += sys.getsizeof(column)
+            for value in column:
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+        return total
+
+@st.cache_resource
+def get_answer_cache():
+    """Final answers shared by every session, keyed on database id, data generation and normalized question"""
+    return BoundedCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_SECONDS)
+
+@st.cache_resource
+def get_result_cache():
+    """SQL results shared by every session, keyed on database id, table generations and canonical SQL text"""
+    return BoundedCache(RESULT_CACHE_SIZE, max_bytes=RESULT_CACHE_MAX_BYTES, sizeof=QueryResult.nbytes)
+
+@st.cache_resource
+def get_request_executor():
+    """Worker pool that answers questions for every session"""
+    return RequestExecutor()
+
+@st.cache_resource
+def get_rate_limiter():
+    """Requests and tokens per minute budget shared by every session"""
+    return RateLimiter()
+
+@st.cache_resource
+def get_trace_log():
+    """Pipeline traces shared by every session"""
+    return TraceLog()
+
+@st.cache_resource
+def get_usage_store():
+    """Token and cost ledger shared by every session"""
+    return UsageStore()
+
+@st.cache_resource
+def get_call_stats():
+    """Model call latencies and retry counters shared by every session"""
+    return CallStats()
+
+@st.cache_resource
+def get_hedge_pool():
+    """Threads that run the original and duplicate attempts of hedged model calls"""
+    return ThreadPoolExecutor(max_workers=2 * ANSWER_MAX_CONCURRENCY, thread_name_prefix="krispr-hedge")
+
+@st.cache_resource
+def get_ingest_lock():
+    """Serialises ingests across sessions"""
+    return threading.Lock()
+
+@st.cache_resource
+def get_query_log():
+    """Executed queries from every session, for index suggestions"""
+    return QueryLog()
+
+@st.cache_resource
+def get_rejected_query_log():
+    """Queries the watchdog refused or stopped, with their plans"""
+    return QueryLog(REJECTED_QUERY_LOG_SIZE)
+
+@st.cache_resource
+def get_summary_cache():
+    """Single summary cache shared by all sessions and reruns of this process"""
+    return DatabaseSnapshotCache()
+
+@st.cache_resource
+def get_prompt_cache():
+    """SQL system prompt per database file, rebuilt only when a new generation is published"""
+    return DatabaseSnapshotCache()
+
+@st.cache_resource
+def get_entity_index_cache():
+    """Product and vendor name index per database file, rebuilt only when a new generation is published"""
+    return DatabaseSnapshotCache()
+
+@st.cache_resource
+def get_schema_index_cache():
+    """Schema pruning index per database file, rebuilt only when a new generation is published"""
+    return DatabaseSnapshotCache()
+
+@st.cache_resource
+def get_route_stats():
+    """How questions from every session were answered: greeting, answer cache, fast path or model"""
+    return RouteStats()
+
+@st.cache_resource
+def get_prompt_metrics():
+    """Prompt build time and token counts of recent questions from every session"""
+    return PromptMetricsLog()
+
+@st.cache_resource
+def get_catalog_cache():
+    """In-process copy of the database catalog, used for constant-time readiness checks"""
+    return DatabaseSnapshotCache()
+
 class KrisprChatbot:
     def __init__(self):
         self.client = None
@@ -458,52 +1924,228 @@ class KrisprChatbot:
         self.data_dir = "data"
         self.db_path = os.path.join(self.data_dir, "krispr_data.db")
         self.data_summary = None
+        self.last_prompt_metrics = None
+        self.sql_mode = SQL_MODE_TOOLS
+        self.call_timeout = OPENAI_TIMEOUT_SECONDS
+        self.max_retries = OPENAI_MAX_RETRIES
+        self.question_timeout = QUESTION_DEADLINE_SECONDS
+        self.hedge_requests = False
+        self.question_deadline = None
+        self.trace = None
+        self.session_id = uuid.uuid4().hex[:8]
+        self.prune_schema = True
+        self.last_call = None
+        # Opt in to serving generated queries from the shared in-memory replica instead of the database file;
+        # off by default because the memory-mapped file measures as fast (benchmark.py replica)
+        self.memory_replica = False
         
         # Ensure data directory exists
         os.makedirs(self.data_dir, exist_ok=True)
         
-    def initialize_openai(self, api_key):
-        """Initialize OpenAI client"""
+    def initialize_openai(self, api_key, base_url=None):
+        """Initialize OpenAI client, optionally against an OpenAI-compatible endpoint"""
         try:
-            self.client = OpenAI(api_key=api_key)
+            # Retries are handled in chat_completion, where they can respect the question deadline
+            self.client = OpenAI(api_key=api_key, base_url=base_url, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=0)
             return True
         except Exception as e:
             st.error(f"Error initializing OpenAI: {str(e)}")
             return False
     
     def check_database_exists_and_ready(self):
-        """Check if database exists and has data"""
+        """Check if database exists and has data, using the ingest-time catalog"""
         try:
             if not os.path.exists(self.db_path):
                 return False, "Database file not found"
             
-            conn = sqlite3.connect(self.db_path)
-            
-            # Check if any tables exist
-            cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
-            
-            if not tables:
-                conn.close()
+            catalog = self.get_catalog()
+            if not catalog or not catalog['tables']:
                 return False, "Database exists but has no tables"
             
-            # Check if tables have data
-            total_rows = 0
-            for table in tables:
-                cursor = conn.execute(f"SELECT COUNT(*) FROM {table}")
-                row_count = cursor.fetchone()[0]
-                total_rows += row_count
-            
-            conn.close()
+            # Row counts come from the catalog, so no table is scanned here; rollups repeat source rows
+            total_rows = sum(entry['row_count'] for entry in catalog['tables'].values() if not entry.get('rollup_of'))
             
             if total_rows == 0:
                 return False, "Database exists but has no data"
             
-            return True, f"Database ready with {len(tables)} tables and {total_rows:,} total records"
+            return True, f"Database ready with {len(catalog['tables'])} tables and {total_rows:,} total records"
             
         except Exception as e:
             return False, f"Database error: {str(e)}"
     
+    def get_catalog(self):
+        """Return the cached catalog for the current database file"""
+        return get_catalog_cache().get(self.db_path, self.build_catalog)
+    
+    def get_data_generation(self):
+        """Return the monotonically increasing generation number of the live database (0 if none)"""
+        if not os.path.exists(self.db_path):
+            return 0
+        catalog = self.get_catalog()
+        return catalog['generation'] if catalog else 0
+    
+    def get_database_id(self):
+        """Return the id of the live database's lineage, which together with the generation identifies its data"""
+        catalog = self.get_catalog()
+        return catalog['database_id'] if catalog else None
+    
+    def write_database_id(self, path, database_id):
+        """Stamp a newly built database file with the lineage id it continues (or starts)"""
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {META_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(f"INSERT OR REPLACE INTO {META_TABLE} VALUES ('database_id', ?)", (database_id,))
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def build_catalog(self):
+        """Read the catalog table, falling back to a one-off scan for databases built before it existed"""
+        if not os.path.exists(self.db_path):
+            return None
+        
+        with get_read_pool().connection(self.db_path) as conn:
+            catalog = {
+                "tables": {},
+                "ingested_at": None,
+                "source": CATALOG_TABLE,
+                "generation": conn.execute("PRAGMA user_version").fetchone()[0],
+                "database_id": None
+            }
+            
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (META_TABLE,)).fetchone():
+                row = conn.execute(f"SELECT value FROM {META_TABLE} WHERE key = 'database_id'").fetchone()
+                catalog["database_id"] = row[0] if row else None
+            if catalog["database_id"] is None:
+                # Databases published before the id existed are told apart by their file instead
+                catalog["database_id"] = "file:{}:{}:{}".format(*get_database_stamp(self.db_path))
+            
+            has_catalog = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (CATALOG_TABLE,)
+            ).fetchone()
+            
+            if has_catalog:
+                cursor = conn.execute(f"SELECT * FROM {CATALOG_TABLE} ORDER BY position")
+                catalog_columns = [description[0] for description in cursor.description]
+                for values in cursor.fetchall():
+                    row = dict(zip(catalog_columns, values))
+                    catalog["tables"][row['table_name']] = {
+                        "sheet_name": row['sheet_name'],
+                        "row_count": row['row_count'],
+                        "columns": json.loads(row['columns']),
+                        "original_columns": json.loads(row['original_columns']),
+                        "ingested_at": row['ingested_at'],
+                        "rollup_of": row.get('rollup_of'),
+                        # Generation that last changed the table; catalogs from before incremental updates lack it
+                        "data_generation": catalog["generation"] if row.get('data_generation') is None else row['data_generation']
+                    }
+                    catalog["ingested_at"] = row['ingested_at']
+                return catalog
+            
+            # Legacy database: count once per file version, the result is cached with the catalog
+            catalog["source"] = "scan"
+            for table_name in list_data_tables(conn):
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})").fetchall()]
+                row_count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+                catalog["tables"][table_name] = {
+                    "sheet_name": table_name,
+                    "row_count": row_count,
+                    "columns": columns,
+                    "original_columns": columns,
+                    "ingested_at": None,
+                    "rollup_of": None,
+                    "data_generation": catalog["generation"]
+                }
+            return catalog
+    
+    def write_catalog(self, conn, sheet_info, generation):
+        """Record row counts, columns, ingest time and last-changed generation for every ingested sheet"""
+        ingested_at = datetime.now().isoformat(timespec='seconds')
+        conn.execute(f"DROP TABLE IF EXISTS {CATALOG_TABLE}")
+        conn.execute(f"""
+            CREATE TABLE {CATALOG_TABLE} (
+                table_name TEXT PRIMARY KEY,
+                sheet_name TEXT,
+                position INTEGER,
+                row_count INTEGER,
+                columns TEXT,
+                original_columns TEXT,
+                ingested_at TEXT,
+                rollup_of TEXT,
+                data_generation INTEGER
+            )
+        """)
+        conn.executemany(
+            f"INSERT INTO {CATALOG_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    info['table_name'],
+                    sheet_name,
+                    position,
+                    info['row_count'],
+                    json.dumps(info['clean_columns']),
+                    json.dumps([str(col) for col in info['original_columns']]),
+                    # Tables an incremental update left alone keep their ingest time and generation
+                    info.get('ingested_at') or ingested_at,
+                    info.get('rollup_of'),
+                    generation if info.get('data_generation') is None else info['data_generation']
+                )
+                for position, (sheet_name, info) in enumerate(sheet_info.items())
+            ]
+        )
+        conn.commit()
+    
+    def write_entity_table(self, conn, sheet_info, tables=None):
+        """Record every distinct product and vendor name with the table and column it comes from; tables limits it to those"""
+        has_table = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (ENTITY_TABLE,)).fetchone()
+        if tables is None or not has_table:
+            conn.execute(f"DROP TABLE IF EXISTS {ENTITY_TABLE}")
+            conn.execute(f"CREATE TABLE {ENTITY_TABLE} (kind TEXT, value TEXT, table_name TEXT, column_name TEXT)")
+            tables = None
+        else:
+            conn.executemany(f"DELETE FROM {ENTITY_TABLE} WHERE table_name = ?", [(table_name,) for table_name in tables])
+        for info in sheet_info.values():
+            # Rollups repeat the names of the table they summarise
+            if info.get('rollup_of') or (tables is not None and info['table_name'] not in tables):
+                continue
+            for kind, column in entity_columns(info['clean_columns']):
+                conn.execute(
+                    f'INSERT INTO {ENTITY_TABLE} SELECT DISTINCT ?, CAST("{column}" AS TEXT), ?, ? FROM "{info["table_name"]}" WHERE "{column}" IS NOT NULL',
+                    (kind, info['table_name'], column)
+                )
+        conn.commit()
+    
+    def build_entity_index(self):
+        """Index the names recorded at ingest; databases from before the entity table are scanned instead"""
+        with get_read_pool().connection(self.db_path) as conn:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (ENTITY_TABLE,)).fetchone():
+                rows = conn.execute(f"SELECT kind, value, table_name, column_name FROM {ENTITY_TABLE}").fetchall()
+            else:
+                rows = []
+                for table_name in list_data_tables(conn):
+                    columns = [column[1] for column in conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()]
+                    for kind, column in entity_columns(columns):
+                        rows.extend(
+                            (kind, value, table_name, column)
+                            for (value,) in conn.execute(f'SELECT DISTINCT CAST("{column}" AS TEXT) FROM "{table_name}" WHERE "{column}" IS NOT NULL')
+                        )
+        return EntityIndex(rows)
+    
+    def resolve_entities(self, user_question):
+        """Exact product and vendor names for the (possibly misspelled or partial) names in a question"""
+        index = get_entity_index_cache().get(self.db_path, self.build_entity_index)
+        return index.resolve(user_question) if index is not None else []
+    
+    def entity_hint(self, user_question):
+        """Note appended to the question listing the exact values its names resolve to, so queries filter with = instead of LIKE scans"""
+        matches = self.resolve_entities(user_question)
+        if self.trace is not None:
+            self.trace.entities = [match['value'] for match in matches]
+        if not matches:
+            return ""
+        lines = [f"- {match['kind']} '{match['value']}' in {', '.join(match['locations'])}" for match in matches]
+        return "\n\nNames in this question match these exact values in the data; filter on them with = rather than LIKE:\n" + "\n".join(lines)
+    
     def clean_column_name(self, col_name):
         """Clean column names for SQL compatibility"""
         # Remove special characters and replace with underscores
@@ -519,135 +2161,830 @@ class KrisprChatbot:
             clean_name = 'col_' + clean_name
         return clean_name or 'unnamed_column'
     
-    def create_database_from_excel(self, uploaded_file):
-        """Convert Excel file to SQLite database"""
+    def parse_workbook(self, uploaded_file):
+        """Parse an uploaded workbook once so the admin preview and the ingest can share it"""
+        if isinstance(uploaded_file, pd.ExcelFile):
+            return uploaded_file
+        
+        if hasattr(uploaded_file, 'getvalue'):
+            data = uploaded_file.getvalue()
+        else:
+            with open(uploaded_file, 'rb') as f:
+                data = f.read()
+        
+        # Legacy .xls files need xlrd; everything else goes through a read-only openpyxl workbook
+        file_name = str(getattr(uploaded_file, 'name', uploaded_file))
+        if file_name.lower().endswith('.xls'):
+            return pd.ExcelFile(BytesIO(data))
+        
+        book = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True, keep_links=False)
+        return pd.ExcelFile(book, engine='openpyxl')
+    
+    def get_sheet_dimensions(self, xl_file, sheet_name):
+        """Return (rows, columns) recorded in the workbook without reading the sheet, or None"""
         try:
-            # Remove existing database
-            if os.path.exists(self.db_path):
-                os.remove(self.db_path)
+            if isinstance(xl_file.book, openpyxl.Workbook):
+                sheet = xl_file.book[sheet_name]
+                if sheet.max_row is None or sheet.max_column is None:
+                    return None
+                return sheet.max_row - 1, sheet.max_column
+            sheet = xl_file.book.sheet_by_name(sheet_name)
+            return sheet.nrows - 1, sheet.ncols
+        except Exception:
+            return None
+    
+    def create_database_from_excel(self, uploaded_file, streaming=False, progress_callback=None):
+        """Convert Excel file to SQLite database, swapping it in atomically once validated"""
+        try:
+            def build(path, generation):
+                sheet_info = self.build_database_file(uploaded_file, path, generation, streaming, progress_callback)
+                self.validate_database_file(path, sheet_info)
+                return sheet_info
+            
+            generation, sheet_info = self.publish_database(build)
+            
+            # Generate database summary
+            self.generate_database_summary(sheet_info)
             
-            # Create new database connection
-            conn = sqlite3.connect(self.db_path)
+            st.success(f"🎉 Data processed successfully with {len(sheet_info)} datasets!")
+            st.info(f"📊 Database saved to: {self.db_path} (data generation {generation})")
+            st.warning("⚠️ **IMPORTANT**: Commit the `data/` folder to GitHub to make this persistent!")
             
-            # Read all sheets from Excel
-            xl_file = pd.ExcelFile(uploaded_file)
-            sheet_info = {}
+            return True
             
-            for sheet_name in xl_file.sheet_names:
-                # Read sheet
-                df = pd.read_excel(uploaded_file, sheet_name=sheet_name)
+        except Exception as e:
+            st.error(f"Error creating database: {str(e)}")
+            return False
+    
+    def publish_database(self, build_file):
+        """Build a new database with build_file(path, generation) in a temp file, then swap it in atomically"""
+        # Build next to the live database so the final rename stays on one filesystem
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        tmp_path = None
+        try:
+            # One writer at a time, so generation numbers stay strictly increasing
+            with get_ingest_lock():
+                generation = self.get_data_generation() + 1
+                # Only ids stored by a previous publish continue; file-based ids of older databases do not
+                database_id = self.get_database_id()
+                if not database_id or database_id.startswith("file:"):
+                    database_id = uuid.uuid4().hex
                 
-                # Clean data
-                df = df.dropna(how='all').dropna(axis=1, how='all')
+                fd, tmp_path = tempfile.mkstemp(prefix="krispr_data.", suffix=".db.tmp", dir=db_dir)
+                os.close(fd)
+                os.chmod(tmp_path, 0o644)
                 
-                # Clean column names for SQL
-                original_columns = df.columns.tolist()
-                clean_columns = [self.clean_column_name(col) for col in original_columns]
-                df.columns = clean_columns
+                result = build_file(tmp_path, generation)
+                self.write_database_id(tmp_path, database_id)
                 
-                # Create table name (clean sheet name)
-                table_name = self.clean_column_name(sheet_name)
+                # Readers keep serving the old file until this rename, then see the complete new one
+                os.replace(tmp_path, self.db_path)
+                tmp_path = None
+            
+            # Drop pooled connections that still point at the previous database file
+            get_read_pool().invalidate(self.db_path)
+            
+            # Load the new generation into memory now, so the first question after an ingest does not pay for it.
+            # The new database is already live, so a failure here must not be reported as a failed ingest.
+            if self.memory_replica:
+                try:
+                    get_memory_replica().refresh(self.db_path)
+                except Exception:
+                    pass
+            return generation, result
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def build_database_file(self, uploaded_file, target_path, generation, streaming=False, progress_callback=None):
+        """Write every sheet of the workbook into a new SQLite file and return the sheet metadata"""
+        conn = sqlite3.connect(target_path)
+        try:
+            # The file is private until validated and swapped in, so skip journaling and fsyncs
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            
+            sheet_info = self.load_workbook_sheets(conn, uploaded_file, streaming, progress_callback)
+            
+            # Precompute weekly rollups of the daily order lines
+            for table_name, info in self.create_weekly_rollups(conn, sheet_info).items():
+                self.create_table_indexes(conn, table_name)
+                sheet_info[table_name] = info
+            
+            # Record the catalog used for readiness checks and row counts
+            self.write_catalog(conn, sheet_info, generation)
+            self.write_entity_table(conn, sheet_info)
+            
+            # Give the query planner row statistics for the new indexes
+            conn.execute("ANALYZE")
+            
+            # Stamp the file with its data generation so caches can key on it
+            conn.execute(f"PRAGMA user_version = {int(generation)}")
+            conn.commit()
+            return sheet_info
+        finally:
+            conn.close()
+    
+    def load_workbook_sheets(self, conn, uploaded_file, streaming=False, progress_callback=None, index_tables=True):
+        """Load every sheet of the workbook into its own table and return the sheet metadata"""
+        # Reuse the parsed workbook when the admin preview already opened it
+        xl_file = self.parse_workbook(uploaded_file)
+        sheet_info = {}
+        
+        # Streaming needs openpyxl's row iterator, which .xls workbooks don't have
+        streaming = streaming and isinstance(xl_file.book, openpyxl.Workbook)
+        
+        for sheet_name in xl_file.sheet_names:
+            # Create table name (clean sheet name)
+            table_name = self.clean_column_name(sheet_name)
+            
+            if streaming:
+                info = self.stream_sheet_to_table(conn, xl_file.book[sheet_name], sheet_name, table_name, progress_callback)
+            else:
+                info = self.load_sheet_to_table(conn, xl_file, sheet_name, table_name)
+                if progress_callback:
+                    progress_callback(sheet_name, info['row_count'], info['row_count'])
+            
+            # Index the columns generated queries filter and group on
+            if index_tables:
+                self.create_table_indexes(conn, table_name)
+            
+            # Store metadata
+            sheet_info[sheet_name] = info
+            
+            st.success(f"✅ Sheet '{sheet_name}' → Dataset '{table_name}' ({info['row_count']:,} records)")
+        
+        return sheet_info
+    
+    def update_database_from_excel(self, uploaded_file, streaming=False, progress_callback=None):
+        """Upsert the workbook's new or changed rows into a copy of the live database and swap it in"""
+        if not os.path.exists(self.db_path):
+            return self.create_database_from_excel(uploaded_file, streaming, progress_callback)
+        
+        try:
+            # Summaries of the tables the update leaves alone are carried over instead of rebuilt
+            previous_summary = self.data_summary if self.load_existing_database_summary() else None
+            
+            def build(path, generation):
+                sheet_info, changes = self.upsert_database_file(uploaded_file, path, generation, streaming, progress_callback)
+                self.validate_database_file(path, sheet_info)
+                return sheet_info, changes
+            
+            generation, (sheet_info, changes) = self.publish_database(build)
+            self.generate_database_summary(sheet_info, previous_summary, set(changes))
+            
+            for table_name, change in changes.items():
+                if change.get('replaced'):
+                    st.success(f"✅ Dataset '{table_name}' replaced ({change['inserted']:,} records)")
+                elif change.get('weeks') is not None:
+                    st.success(f"✅ Rollup '{table_name}' recomputed for {change['weeks']} week(s)")
+                else:
+                    st.success(f"✅ Dataset '{table_name}': {change['keys']:,} new or changed keys, {change['inserted']:,} records written, {change['deleted']:,} replaced")
+            st.info(f"📊 {len(changes)} of {len(sheet_info)} datasets updated (data generation {generation})")
+            st.warning("⚠️ **IMPORTANT**: Commit the `data/` folder to GitHub to make this persistent!")
+            return True
+        
+        except DatabaseUnchanged:
+            st.info("✅ The database already matches this workbook, nothing to update")
+            return True
+        except Exception as e:
+            st.error(f"Error updating database: {str(e)}")
+            return False
+    
+    def upsert_database_file(self, uploaded_file, target_path, generation, streaming=False, progress_callback=None):
+        """Copy the live database to target_path and upsert the workbook into it; returns (sheet_info, changes per table)"""
+        # The workbook is parsed into a private staging file, so the diff runs in SQL next to the live tables
+        staging_path = target_path + ".staging"
+        staging = sqlite3.connect(staging_path)
+        try:
+            staging.execute("PRAGMA journal_mode=OFF")
+            staging.execute("PRAGMA synchronous=OFF")
+            incoming = self.load_workbook_sheets(staging, uploaded_file, streaming, progress_callback, index_tables=False)
+        finally:
+            staging.close()
+        
+        conn = sqlite3.connect(target_path)
+        try:
+            source = sqlite3.connect(self.db_path)
+            try:
+                source.backup(conn)
+            finally:
+                source.close()
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("ATTACH DATABASE ? AS staging", (staging_path,))
+            conn.create_aggregate("row_digest", -1, RowDigest)
+            
+            sheet_info = self.catalog_sheet_info(self.get_catalog())
+            changes = {}
+            rollup_weeks = set()
+            for sheet_name, info in incoming.items():
+                table_name = info['table_name']
+                current_name = next((name for name, current in sheet_info.items() if current['table_name'] == table_name), None)
+                current = sheet_info.get(current_name)
+                key = self.incremental_key(info['clean_columns'])
+                same_columns = current is not None and set(current['clean_columns']) == set(info['clean_columns'])
+                
+                if same_columns and key and not current.get('rollup_of'):
+                    change = self.upsert_table(conn, table_name, info['clean_columns'], key)
+                    if change and table_name == ROLLUP_SOURCE_TABLE and ROLLUP_DATE_COLUMN in key:
+                        # Only the ISO weeks of changed order lines need their rollup rows recomputed
+                        for (order_day,) in conn.execute(f'SELECT DISTINCT date("{ROLLUP_DATE_COLUMN}") FROM staging.changed_keys'):
+                            if order_day:
+                                rollup_weeks.add(tuple(date.fromisoformat(order_day).isocalendar()[:2]))
+                    elif change and table_name == ROLLUP_SOURCE_TABLE:
+                        rollup_weeks = None
+                elif not same_columns or self.table_differs(conn, table_name, info['clean_columns']):
+                    # New sheets, changed columns and keyless tables are replaced whole
+                    self.replace_table(conn, table_name)
+                    change = {"replaced": True, "inserted": info['row_count']}
+                    if table_name == ROLLUP_SOURCE_TABLE:
+                        rollup_weeks = None
+                else:
+                    change = None
                 
-                # Store the data in SQLite
-                df.to_sql(table_name, conn, if_exists='replace', index=False)
+                if not change:
+                    continue
+                changes[table_name] = change
+                info = dict(info, row_count=conn.execute(f'SELECT COUNT(*) FROM main."{table_name}"').fetchone()[0])
+                if current_name is None:
+                    sheet_info[sheet_name] = info
+                else:
+                    # Keep the table's position, under the sheet name the workbook uses now
+                    sheet_info = {(sheet_name if name == current_name else name): (info if name == current_name else value) for name, value in sheet_info.items()}
+            
+            if not changes:
+                raise DatabaseUnchanged()
+            
+            if ROLLUP_SOURCE_TABLE in changes:
+                existing_rollups = {info['table_name'] for info in sheet_info.values() if info.get('rollup_of')}
+                for table_name, info in self.create_weekly_rollups(conn, sheet_info, rollup_weeks).items():
+                    self.create_table_indexes(conn, table_name)
+                    sheet_info[table_name] = info
+                    if rollup_weeks is not None and table_name in existing_rollups:
+                        changes[table_name] = {"weeks": len(rollup_weeks)}
+                    else:
+                        changes[table_name] = {"replaced": True, "inserted": info['row_count']}
+            
+            # Statistics, catalog rows and entity names are refreshed for the changed tables only
+            for table_name in changes:
+                conn.execute(f'ANALYZE main."{table_name}"')
+            self.write_catalog(conn, sheet_info, generation)
+            self.write_entity_table(conn, sheet_info, set(changes))
+            conn.execute(f"PRAGMA user_version = {int(generation)}")
+            conn.commit()
+            conn.execute("DETACH DATABASE staging")
+            return sheet_info, changes
+        finally:
+            conn.close()
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+    
+    def catalog_sheet_info(self, catalog):
+        """Rebuild ingest sheet metadata from the catalog, so an update carries unchanged tables over as they are"""
+        return {
+            (entry['sheet_name'] or table_name): {
+                'table_name': table_name,
+                'original_columns': list(entry['original_columns']),
+                'clean_columns': list(entry['columns']),
+                'row_count': entry['row_count'],
+                'column_count': len(entry['columns']),
+                'rollup_of': entry.get('rollup_of'),
+                'ingested_at': entry['ingested_at'],
+                'data_generation': entry['data_generation']
+            }
+            for table_name, entry in catalog['tables'].items()
+        }
+    
+    def incremental_key(self, columns):
+        """Columns an incremental update matches rows on: the first INCREMENTAL_KEYS entry the table has, or None"""
+        by_name = {column.lower(): column for column in columns}
+        for key in INCREMENTAL_KEYS:
+            if all(column.lower() in by_name for column in key):
+                return [by_name[column.lower()] for column in key]
+        return None
+    
+    def partition_digests(self, conn, schema, table_name, columns, partition):
+        """Row count and order-independent digest of each partition of a table, keyed by the partition's values"""
+        column_list = ", ".join(f'"{col}"' for col in columns)
+        partition_list = ", ".join(f'"{col}"' for col in partition)
+        grouping = f" GROUP BY {partition_list}" if partition else ""
+        rows = conn.execute(f'SELECT {partition_list + ", " if partition else ""}COUNT(*), row_digest({column_list}) FROM {schema}."{table_name}"{grouping}')
+        return {tuple(row[:-2]): tuple(row[-2:]) for row in rows}
+    
+    def table_differs(self, conn, table_name, columns):
+        """Whether the staged workbook table and the live one hold different rows (duplicates count)"""
+        return self.partition_digests(conn, "staging", table_name, columns, []) != self.partition_digests(conn, "main", table_name, columns, [])
+    
+    def upsert_table(self, conn, table_name, columns, key):
+        """Replace the rows of every key whose rows differ between workbook and live table; None if nothing changed"""
+        key_list = ", ".join(f'"{col}"' for col in key)
+        column_list = ", ".join(f'"{col}"' for col in columns)
+        
+        # Partitions on the leading key columns (one order day, one week) are compared by digest, so only those that
+        # differ are diffed row by row. Partitions absent from the workbook are left alone: a workbook holding only the
+        # new week updates just that week.
+        partition = key[:INCREMENTAL_PARTITION_COLUMNS]
+        live_digests = self.partition_digests(conn, "main", table_name, columns, partition)
+        changed_partitions = [
+            values for values, digest in self.partition_digests(conn, "staging", table_name, columns, partition).items()
+            if live_digests.get(values) != digest
+        ]
+        if not changed_partitions:
+            return None
+        partition_list = ", ".join(f'"{col}"' for col in partition)
+        conn.execute("DROP TABLE IF EXISTS staging.changed_partitions")
+        # The primary key lets the unindexed staging table be scanned once, probing it, instead of once per partition
+        conn.execute(f"CREATE TABLE staging.changed_partitions ({partition_list}, PRIMARY KEY ({partition_list}))")
+        conn.executemany(f"INSERT INTO staging.changed_partitions VALUES ({', '.join('?' * len(partition))})", changed_partitions)
+        
+        # Copy both sides' rows in those partitions aside once; the live side is read through the key's index
+        for aside_table, schema in (("changed_incoming", "staging"), ("changed_live", "main")):
+            conn.execute(f"DROP TABLE IF EXISTS staging.{aside_table}")
+            conn.execute(f"""
+                CREATE TABLE staging.{aside_table} AS
+                SELECT source.* FROM staging.changed_partitions AS changed
+                JOIN {schema}."{table_name}" AS source ON {match_columns("source", "changed", partition)}
+            """)
+        
+        def changed_rows(changed, unchanged):
+            # Rows with their copy counts, so duplicates count as in the partition digests
+            return f"""
+                SELECT {column_list}, COUNT(*) AS copies FROM staging.{changed} GROUP BY {column_list}
+                EXCEPT
+                SELECT {column_list}, COUNT(*) AS copies FROM staging.{unchanged} GROUP BY {column_list}
+            """
+        
+        # A key changed if the workbook has rows for it the table lacks, or the table has rows for it the workbook no longer does
+        conn.execute("DROP TABLE IF EXISTS staging.changed_keys")
+        conn.execute(f"""
+            CREATE TABLE staging.changed_keys AS
+            SELECT {key_list} FROM ({changed_rows("changed_incoming", "changed_live")})
+            UNION
+            SELECT {", ".join(f'gone."{col}"' for col in key)}
+            FROM ({changed_rows("changed_live", "changed_incoming")}) AS gone
+            JOIN (SELECT DISTINCT {key_list} FROM staging.changed_incoming) AS incoming ON {match_columns("gone", "incoming", key)}
+        """)
+        changed_keys = conn.execute("SELECT COUNT(*) FROM staging.changed_keys").fetchone()[0]
+        
+        # Both statements go through the key's indexes, so only the pages holding changed keys are written
+        deleted = conn.execute(f"""
+            DELETE FROM main."{table_name}" WHERE rowid IN (
+                SELECT live.rowid FROM staging.changed_keys AS changed
+                JOIN main."{table_name}" AS live ON {match_columns("live", "changed", key)}
+            )
+        """).rowcount
+        inserted = conn.execute(f"""
+            INSERT INTO main."{table_name}" ({column_list})
+            SELECT {", ".join(f'incoming."{col}"' for col in columns)}
+            FROM staging.changed_incoming AS incoming
+            JOIN staging.changed_keys AS changed ON {match_columns("incoming", "changed", key)}
+        """).rowcount
+        return {"keys": changed_keys, "inserted": inserted, "deleted": deleted}
+    
+    def replace_table(self, conn, table_name):
+        """Swap a live table for the staged workbook version and index it like a fresh ingest"""
+        create_sql = conn.execute("SELECT sql FROM staging.sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()[0]
+        conn.execute(f'DROP TABLE IF EXISTS main."{table_name}"')
+        conn.execute(create_sql)
+        conn.execute(f'INSERT INTO main."{table_name}" SELECT * FROM staging."{table_name}"')
+        self.create_table_indexes(conn, table_name)
+    
+    def load_sheet_to_table(self, conn, xl_file, sheet_name, table_name):
+        """Load a whole sheet through pandas and store it in one go"""
+        # Read sheet
+        df = xl_file.parse(sheet_name)
+        
+        # Clean data
+        df = df.dropna(how='all').dropna(axis=1, how='all')
+        
+        # Clean column names for SQL
+        original_columns = df.columns.tolist()
+        clean_columns = [self.clean_column_name(col) for col in original_columns]
+        df.columns = clean_columns
+        
+        # Store the data in SQLite
+        df.to_sql(table_name, conn, if_exists='replace', index=False)
+        
+        return {
+            'table_name': table_name,
+            'original_columns': original_columns,
+            'clean_columns': clean_columns,
+            'row_count': len(df),
+            'column_count': len(df.columns)
+        }
+    
+    def stream_sheet_to_table(self, conn, sheet, sheet_name, table_name, progress_callback=None):
+        """Stream a sheet row by row into SQLite in fixed-size batches, keeping memory flat"""
+        rows = sheet.iter_rows(values_only=True)
+        
+        # The first non-empty row is the header, as with pandas
+        header = None
+        for row in rows:
+            if any(value is not None for value in row):
+                header = row
+                break
+        if header is None:
+            raise ValueError(f"Sheet '{sheet_name}' has no header row")
+        
+        original_columns = self.header_column_names(header)
+        clean_columns = [self.clean_column_name(col) for col in original_columns]
+        width = len(original_columns)
+        column_has_data = [False] * width
+        total_estimate = (sheet.max_row - 1) if sheet.max_row else None
+        
+        conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        insert_sql = None
+        row_count = 0
+        batch = []
+        
+        def flush(batch):
+            nonlocal insert_sql
+            if insert_sql is None:
+                # Column types come from the first batch; untyped columns keep values exactly as read
+                column_types = [self.sqlite_column_type(batch, index) for index in range(width)]
+                column_defs = ", ".join(f'"{col}" {col_type}'.rstrip() for col, col_type in zip(clean_columns, column_types))
+                conn.execute(f'CREATE TABLE "{table_name}" ({column_defs})')
+                insert_sql = f'INSERT INTO "{table_name}" VALUES ({", ".join("?" * width)})'
+            conn.executemany(insert_sql, batch)
+        
+        for row in rows:
+            # Pad or trim to the header width, then drop rows that are entirely empty
+            values = tuple(row[:width]) + (None,) * (width - len(row))
+            if all(value is None for value in values):
+                continue
+            
+            values = tuple(self.sqlite_cell_value(value) for value in values)
+            for index, value in enumerate(values):
+                if value is not None:
+                    column_has_data[index] = True
+            batch.append(values)
+            row_count += 1
+            
+            if len(batch) >= INGEST_BATCH_ROWS:
+                flush(batch)
+                batch = []
+                if progress_callback:
+                    progress_callback(sheet_name, row_count, total_estimate)
+        
+        if batch or insert_sql is None:
+            flush(batch)
+        conn.commit()
+        
+        # Columns that never held a value are dropped, matching dropna(axis=1, how='all')
+        empty_columns = [col for col, has_data in zip(clean_columns, column_has_data) if not has_data]
+        if empty_columns:
+            self.drop_table_columns(conn, table_name, clean_columns, empty_columns)
+            keep = [index for index, has_data in enumerate(column_has_data) if has_data]
+            original_columns = [original_columns[index] for index in keep]
+            clean_columns = [clean_columns[index] for index in keep]
+        
+        if progress_callback:
+            progress_callback(sheet_name, row_count, row_count)
+        
+        return {
+            'table_name': table_name,
+            'original_columns': original_columns,
+            'clean_columns': clean_columns,
+            'row_count': row_count,
+            'column_count': len(clean_columns)
+        }
+    
+    def header_column_names(self, header):
+        """Name header cells the way pandas does: 'Unnamed: N' for blanks and '.1' suffixes for duplicates"""
+        names = []
+        seen = {}
+        for index, value in enumerate(header):
+            name = f"Unnamed: {index}" if value is None else value
+            if name in seen:
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+            names.append(name)
+        return names
+    
+    def sqlite_cell_value(self, value):
+        """Convert an openpyxl cell value into what pandas' to_sql would store"""
+        if isinstance(value, datetime):
+            return value.isoformat(sep=' ')
+        if isinstance(value, (date, dt_time)):
+            return value.isoformat()
+        if isinstance(value, bool):
+            return int(value)
+        return value
+    
+    def sqlite_column_type(self, batch, index):
+        """Pick a declared column type from the first non-empty value in a batch"""
+        for row in batch:
+            value = row[index]
+            if value is None:
+                continue
+            if isinstance(value, int):
+                return "INTEGER"
+            if isinstance(value, float):
+                return "REAL"
+            if isinstance(value, str) and re.match(r'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}', value):
+                return "TIMESTAMP"
+            return "TEXT"
+        return ""
+    
+    def drop_table_columns(self, conn, table_name, columns, drop_columns):
+        """Remove columns from a table, rebuilding it on SQLite versions without DROP COLUMN"""
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            for col in drop_columns:
+                conn.execute(f'ALTER TABLE "{table_name}" DROP COLUMN "{col}"')
+        else:
+            keep = ", ".join(f'"{col}"' for col in columns if col not in drop_columns)
+            conn.execute(f'CREATE TABLE "{table_name}__rebuild" AS SELECT {keep} FROM "{table_name}"')
+            conn.execute(f'DROP TABLE "{table_name}"')
+            conn.execute(f'ALTER TABLE "{table_name}__rebuild" RENAME TO "{table_name}"')
+        conn.commit()
+    
+    def create_weekly_rollups(self, conn, sheet_info, weeks=None):
+        """Aggregate the daily order lines into weekly, vendor x week and SKU x week tables; weeks limits it to those ISO weeks"""
+        source = next((info for info in sheet_info.values() if info['table_name'] == ROLLUP_SOURCE_TABLE), None)
+        if not source or not {ROLLUP_DATE_COLUMN, ROLLUP_QUANTITY_COLUMN} <= set(source['clean_columns']):
+            return {}
+        
+        # ISO weeks run Monday to Sunday, matching the Week numbers in the weekly sheets
+        def iso_part(value, part):
+            try:
+                return date.fromisoformat(str(value)[:10]).isocalendar()[part]
+            except ValueError:
+                return None
+        
+        conn.create_function("iso_year", 1, lambda value: iso_part(value, 0), deterministic=True)
+        conn.create_function("iso_week", 1, lambda value: iso_part(value, 1), deterministic=True)
+        
+        rollups = {}
+        for table_name, group_columns in ROLLUP_TABLES.items():
+            group_columns = [f'"{col}"' for col in group_columns if col in source['clean_columns']]
+            dims = "".join(f"{col}, " for col in group_columns)
+            
+            # Collapse to one row per day first, so the week functions run once per day and group
+            def rollup_sql(date_filter=""):
+                return f"""
+                    SELECT iso_year(order_day) AS Year, iso_week(order_day) AS Week, {dims}
+                           SUM(day_units) AS Total_Units_Sold, SUM(day_lines) AS Order_Lines,
+                           MIN(order_day) AS First_Order_Date, MAX(order_day) AS Last_Order_Date
+                    FROM (
+                        SELECT date("{ROLLUP_DATE_COLUMN}") AS order_day, {dims}
+                               SUM("{ROLLUP_QUANTITY_COLUMN}") AS day_units, COUNT(*) AS day_lines
+                        FROM "{ROLLUP_SOURCE_TABLE}"
+                        WHERE "{ROLLUP_DATE_COLUMN}" IS NOT NULL{date_filter}
+                        GROUP BY {", ".join(["order_day"] + group_columns)}
+                    )
+                    GROUP BY {", ".join(["Year", "Week"] + group_columns)}
+                    ORDER BY Year, Week
+                """
+            
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+            if weeks is None or not exists:
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+                conn.execute(f'CREATE TABLE "{table_name}" AS {rollup_sql()}')
+            else:
+                # Recompute just the given weeks, reading their Monday-to-Sunday order lines through the date index
+                week_sql = rollup_sql(f' AND "{ROLLUP_DATE_COLUMN}" >= ? AND "{ROLLUP_DATE_COLUMN}" < ?')
+                for year, week in sorted(weeks):
+                    monday = date.fromisocalendar(year, week, 1)
+                    conn.execute(f'DELETE FROM "{table_name}" WHERE Year = ? AND Week = ?', (year, week))
+                    conn.execute(f'INSERT INTO "{table_name}" {week_sql}', (monday.isoformat(), (monday + timedelta(days=7)).isoformat()))
+            
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()]
+            rollups[table_name] = {
+                'table_name': table_name,
+                'original_columns': columns,
+                'clean_columns': columns,
+                'row_count': conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0],
+                'column_count': len(columns),
+                'rollup_of': ROLLUP_SOURCE_TABLE
+            }
+        conn.commit()
+        return rollups
+    
+    def create_table_indexes(self, conn, table_name):
+        """Index week/year/product/vendor/SKU/date-like columns, using the summary's keyword detection"""
+        for col in self.index_candidate_columns(conn, table_name):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_{col}" ON "{table_name}" ("{col}")')
+        conn.commit()
+    
+    def index_candidate_columns(self, conn, table_name):
+        """Keyword-matched columns worth indexing; REAL columns and measure-named columns (e.g. NI_per_SKU, Last_Order_Date) are not filters"""
+        candidates = []
+        for row in conn.execute(f'PRAGMA table_info("{table_name}")').fetchall():
+            parts = row[1].lower().split("_")
+            if row[2].upper() == "REAL" or any(part in INDEX_MEASURE_PARTS for part in parts):
+                continue
+            if any(keyword in parts for keyword in INDEX_COLUMN_KEYWORDS):
+                candidates.append(row[1])
+        return candidates
+    
+    def suggest_indexes(self, queries=None):
+        """Propose indexes from executed queries: equality columns first, then a range or grouping column"""
+        catalog = self.get_catalog()
+        if not catalog:
+            return []
+        if queries is None:
+            queries = get_query_log().snapshot()
+        
+        # Keyword columns the ingest would have indexed; older databases may be missing them
+        keyword_indexes = set()
+        with get_read_pool().connection(self.db_path) as conn:
+            existing = {table: list_table_indexes(conn, table) for table in catalog['tables']}
+            for table in catalog['tables']:
+                for col in self.index_candidate_columns(conn, table):
+                    keyword_indexes.add((table, (col,)))
+        
+        usage = Counter()
+        for query in queries:
+            clauses = self.query_clauses(query)
+            for table, entry in catalog['tables'].items():
+                if not re.search(rf'\b{re.escape(table)}\b', query, re.IGNORECASE):
+                    continue
                 
-                # Store metadata
-                sheet_info[sheet_name] = {
-                    'table_name': table_name,
-                    'original_columns': original_columns,
-                    'clean_columns': clean_columns,
-                    'row_count': len(df),
-                    'column_count': len(df.columns)
-                }
+                equality, ranges, grouping = [], [], []
+                for col in entry['columns']:
+                    col_pattern = rf'\b(?:\w+\.)?"?{re.escape(col)}"?\s*'
+                    if re.search(col_pattern + r'(=|IN\b|IS\b)', clauses['where'], re.IGNORECASE):
+                        equality.append(col)
+                    elif re.search(col_pattern + r'(<|>|BETWEEN\b|LIKE\b)', clauses['where'], re.IGNORECASE):
+                        ranges.append(col)
+                    if re.search(rf'\b(?:\w+\.)?"?{re.escape(col)}"?\b', clauses['group'], re.IGNORECASE):
+                        grouping.append(col)
                 
-                st.success(f"✅ Sheet '{sheet_name}' → Dataset '{table_name}' ({len(df):,} records)")
-            
-            conn.close()
+                # Equality columns lead; a range column (or else a grouping column) can follow
+                trailing = ranges[:1] or [col for col in grouping if col not in equality][:1]
+                columns = tuple(equality + trailing)
+                if columns:
+                    usage[(table, columns)] += 1
+        
+        proposals = []
+        candidates = sorted(keyword_indexes | set(usage), key=lambda key: (-usage[key], key))
+        for table, columns in candidates:
+            uses = usage[(table, columns)]
+            if (table, columns) not in keyword_indexes and uses < INDEX_ADVISOR_MIN_USES:
+                continue
             
-            # Generate database summary
-            self.generate_database_summary(sheet_info)
+            # An existing index whose leading columns match already serves the pattern
+            if any(index[:len(columns)] == columns for index in existing.get(table, [])):
+                continue
             
-            st.success(f"🎉 Data processed successfully with {len(xl_file.sheet_names)} datasets!")
-            st.info(f"📊 Database saved to: {self.db_path}")
-            st.warning("⚠️ **IMPORTANT**: Commit the `data/` folder to GitHub to make this persistent!")
+            index_name = f"idx_{table}_{'_'.join(columns)}"
+            column_list = ", ".join(f'"{col}"' for col in columns)
+            proposals.append({
+                "table": table,
+                "columns": columns,
+                "uses": uses,
+                "reason": "query pattern" if uses >= INDEX_ADVISOR_MIN_USES else "filter column",
+                "statement": f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table}" ({column_list})'
+            })
+        
+        # A composite index also serves lookups on its leading columns
+        return [
+            proposal for proposal in proposals
+            if not any(
+                other['table'] == proposal['table']
+                and len(other['columns']) > len(proposal['columns'])
+                and other['columns'][:len(proposal['columns'])] == proposal['columns']
+                for other in proposals
+            )
+        ]
+    
+    def query_clauses(self, query):
+        """Split the WHERE and GROUP BY/ORDER BY text out of a query for the index advisor"""
+        stops = r'(?=\bGROUP\s+BY\b|\bORDER\s+BY\b|\bHAVING\b|\bLIMIT\b|\bUNION\b|;|$)'
+        where = re.findall(r'\bWHERE\b(.*?)' + stops, query, re.IGNORECASE | re.DOTALL)
+        group = re.findall(r'\b(?:GROUP|ORDER)\s+BY\b(.*?)' + r'(?=\bHAVING\b|\bORDER\s+BY\b|\bLIMIT\b|\bUNION\b|;|$)', query, re.IGNORECASE | re.DOTALL)
+        return {"where": " ".join(where), "group": " ".join(group)}
+    
+    def apply_indexes(self, statements):
+        """Add indexes to a copy of the live database and swap it in, leaving readers undisturbed"""
+        def build(path, generation):
+            source = sqlite3.connect(self.db_path)
+            target = sqlite3.connect(path)
+            try:
+                source.backup(target)
+                for statement in statements:
+                    target.execute(statement)
+                target.execute("ANALYZE")
+                target.execute(f"PRAGMA user_version = {int(generation)}")
+                target.commit()
+                integrity = target.execute("PRAGMA quick_check").fetchone()[0]
+                if integrity != "ok":
+                    raise ValueError(f"Indexed database failed integrity check: {integrity}")
+            finally:
+                source.close()
+                target.close()
+            return len(statements)
+        
+        generation, _ = self.publish_database(build)
+        return generation
+    
+    def validate_database_file(self, path, sheet_info):
+        """Make sure a freshly built database is intact before it replaces the live one"""
+        conn = sqlite3.connect(path)
+        try:
+            integrity = conn.execute("PRAGMA quick_check").fetchone()[0]
+            if integrity != "ok":
+                raise ValueError(f"New database failed integrity check: {integrity}")
             
-            return True
+            if not sheet_info:
+                raise ValueError("Workbook contains no sheets")
             
-        except Exception as e:
-            st.error(f"Error creating database: {str(e)}")
-            return False
+            for sheet_name, info in sheet_info.items():
+                row_count = conn.execute(f"SELECT COUNT(*) FROM {info['table_name']}").fetchone()[0]
+                if row_count != info['row_count']:
+                    raise ValueError(f"Sheet '{sheet_name}' wrote {row_count:,} of {info['row_count']:,} records")
+        finally:
+            conn.close()
     
-    def generate_database_summary(self, sheet_info):
-        """Generate database schema summary"""
-        conn = sqlite3.connect(self.db_path)
-        
+    def generate_database_summary(self, sheet_info, previous=None, changed_tables=None):
+        """Generate database schema summary, reusing previous entries for tables outside changed_tables"""
         summary = {
             "database_path": self.db_path,
             "total_tables": len(sheet_info),
             "tables": {}
         }
         
-        for sheet_name, info in sheet_info.items():
-            table_name = info['table_name']
-            
-            # Get table schema
-            cursor = conn.execute(f"PRAGMA table_info({table_name})")
-            schema = cursor.fetchall()
-            
-            # Get sample data
-            cursor = conn.execute(f"SELECT * FROM {table_name} LIMIT 10")
-            sample_data = cursor.fetchall()
-            columns = [description[0] for description in cursor.description]
-            
-            # Get all unique values for potential product columns
-            product_columns = []
-            for col in info['clean_columns']:
-                if any(keyword in col.lower() for keyword in ['product', 'name', 'item', 'sku']):
-                    cursor = conn.execute(f"SELECT DISTINCT {col} FROM {table_name} WHERE {col} IS NOT NULL LIMIT 50")
-                    unique_values = [row[0] for row in cursor.fetchall()]
-                    product_columns.append({
-                        'column': col,
-                        'original_name': info['original_columns'][info['clean_columns'].index(col)],
-                        'unique_values': unique_values
-                    })
-            
-            summary["tables"][sheet_name] = {
-                "table_name": table_name,
-                "schema": schema,
-                "sample_data": sample_data,
-                "sample_columns": columns,
-                "row_count": info['row_count'],
-                "column_mapping": dict(zip(info['original_columns'], info['clean_columns'])),
-                "product_columns": product_columns
-            }
+        with get_read_pool().connection(self.db_path) as conn:
+            for sheet_name, info in sheet_info.items():
+                table_name = info['table_name']
+                
+                # An incremental update left this table as it was
+                if previous and changed_tables is not None and table_name not in changed_tables:
+                    reused = next((entry for entry in previous['tables'].values() if entry['table_name'] == table_name), None)
+                    if reused:
+                        summary["tables"][sheet_name] = reused
+                        continue
+                
+                # Get table schema
+                cursor = conn.execute(f"PRAGMA table_info({table_name})")
+                schema = cursor.fetchall()
+                
+                # Get sample data
+                cursor = conn.execute(f"SELECT * FROM {table_name} LIMIT 10")
+                sample_data = cursor.fetchall()
+                columns = [description[0] for description in cursor.description]
+                
+                # Get all unique values for potential product columns
+                product_columns = []
+                for col in info['clean_columns']:
+                    if any(keyword in col.lower() for keyword in PRODUCT_COLUMN_KEYWORDS):
+                        cursor = conn.execute(f"SELECT DISTINCT {col} FROM {table_name} WHERE {col} IS NOT NULL LIMIT 50")
+                        unique_values = [row[0] for row in cursor.fetchall()]
+                        product_columns.append({
+                            'column': col,
+                            'original_name': info['original_columns'][info['clean_columns'].index(col)],
+                            'unique_values': unique_values
+                        })
+                
+                summary["tables"][sheet_name] = {
+                    "table_name": table_name,
+                    "schema": schema,
+                    "sample_data": sample_data,
+                    "sample_columns": columns,
+                    "row_count": info['row_count'],
+                    "column_mapping": dict(zip(info['original_columns'], info['clean_columns'])),
+                    "product_columns": product_columns,
+                    "rollup_of": info.get('rollup_of')
+                }
         
-        conn.close()
-        self.data_summary = summary
+        self.data_summary = get_summary_cache().put(self.db_path, summary)
     
     def load_existing_database_summary(self):
-        """Load database summary from existing database"""
+        """Load database summary from the shared cache, rebuilding it if the database changed"""
         try:
-            if not os.path.exists(self.db_path):
+            summary = get_summary_cache().get(self.db_path, self.build_existing_database_summary)
+            if summary is None:
                 return False
             
-            conn = sqlite3.connect(self.db_path)
-            
-            # Get all tables
-            cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
-            
-            if not tables:
-                conn.close()
-                return False
+            self.data_summary = summary
+            return True
             
+        except Exception as e:
+            st.error(f"Error loading existing database: {str(e)}")
+            return False
+    
+    def build_existing_database_summary(self):
+        """Build database summary from existing database"""
+        if not os.path.exists(self.db_path):
+            return None
+        
+        # Row counts and original column names come from the catalog
+        catalog = self.get_catalog()
+        if not catalog or not catalog['tables']:
+            return None
+        
+        with get_read_pool().connection(self.db_path) as conn:
             # Generate summary for existing database
             summary = {
                 "database_path": self.db_path,
-                "total_tables": len(tables),
+                "total_tables": len(catalog['tables']),
                 "tables": {}
             }
             
-            for table_name in tables:
+            for table_name, entry in catalog['tables'].items():
                 # Get table schema
                 cursor = conn.execute(f"PRAGMA table_info({table_name})")
                 schema = cursor.fetchall()
@@ -657,85 +2994,140 @@ class KrisprChatbot:
                 sample_data = cursor.fetchall()
                 columns = [description[0] for description in cursor.description]
                 
-                # Get row count
-                cursor = conn.execute(f"SELECT COUNT(*) FROM {table_name}")
-                row_count = cursor.fetchone()[0]
-                
-                # Create column mapping (simplified for existing DB)
-                column_mapping = {col: col for col in columns}
+                # Map original Excel headers to system columns (identity for pre-catalog databases)
+                original_names = dict(zip(entry['columns'], entry['original_columns']))
+                column_mapping = {original_names.get(col, col): col for col in columns}
                 
                 # Get product columns
                 product_columns = []
                 for col in columns:
-                    if any(keyword in col.lower() for keyword in ['product', 'name', 'item', 'sku']):
+                    if any(keyword in col.lower() for keyword in PRODUCT_COLUMN_KEYWORDS):
                         cursor = conn.execute(f"SELECT DISTINCT {col} FROM {table_name} WHERE {col} IS NOT NULL LIMIT 50")
                         unique_values = [row[0] for row in cursor.fetchall()]
                         product_columns.append({
                             'column': col,
-                            'original_name': col,
+                            'original_name': original_names.get(col, col),
                             'unique_values': unique_values
                         })
                 
-                summary["tables"][table_name] = {
+                summary["tables"][entry['sheet_name'] or table_name] = {
                     "table_name": table_name,
                     "schema": schema,
                     "sample_data": sample_data,
                     "sample_columns": columns,
-                    "row_count": row_count,
+                    "row_count": entry['row_count'],
                     "column_mapping": column_mapping,
-                    "product_columns": product_columns
+                    "product_columns": product_columns,
+                    "rollup_of": entry.get('rollup_of')
                 }
             
-            conn.close()
-            self.data_summary = summary
-            return True
-            
-        except Exception as e:
-            st.error(f"Error loading existing database: {str(e)}")
-            return False
+            return summary
+    
+    def query_connection(self):
+        """Read connection for generated queries: the in-memory replica when enabled, else the pooled file"""
+        if self.memory_replica:
+            return get_memory_replica().connection(self.db_path)
+        return get_read_pool().connection(self.db_path)
     
     def get_database_info(self):
         """Get database tables and columns for debugging"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            
-            # Get all tables
-            cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
-            
-            # Get columns for each table
-            table_info = {}
-            for table in tables:
-                cursor = conn.execute(f"PRAGMA table_info({table})")
-                columns = [row[1] for row in cursor.fetchall()]
-                table_info[table] = columns
+            with get_read_pool().connection(self.db_path) as conn:
+                # Get all tables
+                tables = list_data_tables(conn)
+                
+                # Get columns for each table
+                table_info = {}
+                for table in tables:
+                    cursor = conn.execute(f"PRAGMA table_info({table})")
+                    columns = [row[1] for row in cursor.fetchall()]
+                    table_info[table] = columns
             
-            conn.close()
             return table_info
         except Exception as e:
             return f"Error getting database info: {str(e)}"
     
+    def estimate_query_rows(self, query, plan):
+        """Estimate how many rows a query plan visits, using the catalog's table sizes"""
+        catalog = self.get_catalog()
+        table_rows = {name: entry['row_count'] for name, entry in catalog['tables'].items()} if catalog else {}
+        return estimate_plan_rows(plan, table_rows, query_table_aliases(query, table_rows))
+    
+    def reject_query(self, query, reason, plan=(), estimated_rows=None):
+        """Record a refused or stopped query with its plan, then raise QueryRejected"""
+        get_rejected_query_log().record({
+            "at": datetime.now().isoformat(timespec='seconds'),
+            "query": query,
+            "reason": reason,
+            "plan": [row[3] for row in plan],
+            "estimated_rows": estimated_rows
+        })
+        raise QueryRejected(reason)
+    
+    def query_data_version(self, query):
+        """Database id plus the generations that last changed the tables a query names, so updates to other tables keep its cached result"""
+        catalog = self.get_catalog()
+        words = {word.lower() for word in re.findall(r'\w+', query)}
+        versions = tuple(sorted(
+            (table_name, entry['data_generation']) for table_name, entry in (catalog['tables'].items() if catalog else ())
+            if table_name.lower() in words
+        ))
+        return self.get_database_id(), versions or self.get_data_generation()
+    
+    def run_guarded_query(self, sql_text, clean_query, fetch):
+        """Run one statement behind the read-only authorizer, the plan-size check and the deadline; return (columns, fetch(cursor))"""
+        with self.query_connection() as conn, read_only_statements(conn):
+            # The prefix check passes WITH ... DELETE; the authorizer refuses it while planning
+            try:
+                plan = conn.execute(f"EXPLAIN QUERY PLAN {sql_text}").fetchall()
+            except sqlite3.DatabaseError as e:
+                if "not authorized" not in str(e):
+                    raise
+                self.reject_query(clean_query, READ_ONLY_REJECTION)
+            
+            # Refuse cartesian products and other runaway plans before running anything
+            estimated_rows = self.estimate_query_rows(clean_query, plan)
+            if estimated_rows > QUERY_PLAN_MAX_ROWS:
+                self.reject_query(clean_query, f"The query would visit about {estimated_rows:,} rows (limit {QUERY_PLAN_MAX_ROWS:,}). Add join conditions or filters.", plan, estimated_rows)
+            
+            try:
+                with query_deadline(conn):
+                    cursor = conn.execute(sql_text)
+                    return [description[0] for description in cursor.description], fetch(cursor)
+            except sqlite3.OperationalError as e:
+                if "interrupted" not in str(e):
+                    raise
+                self.reject_query(clean_query, f"The query was stopped after {QUERY_TIMEOUT_SECONDS} seconds. Simplify it or filter earlier.", plan, estimated_rows)
+    
     def execute_sql_query(self, query):
         """Execute SQL query and return results"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            # Run the statement as written (line comments need their line breaks); key and log it in canonical form
+            sql_text = strip_sql_markdown(query)
+            clean_query = normalize_sql_query(query)
+            rejection = check_read_only_query(sql_text)
+            if rejection:
+                self.reject_query(clean_query, rejection)
             
-            # Clean the query one more time
-            clean_query = query.strip()
-            if clean_query.endswith(';;'):
-                clean_query = clean_query[:-1]  # Remove double semicolon
+            # Identical SQL is served from memory until a table it reads changes
+            result_key = (self.query_data_version(clean_query), clean_query)
+            cached = get_result_cache().get(result_key)
+            if cached is None:
+                # Never materialise more than QUERY_MAX_ROWS; one extra row tells us the result was cut
+                columns, rows = self.run_guarded_query(sql_text, clean_query, lambda cursor: cursor.fetchmany(QUERY_MAX_ROWS + 1))
+                cached = QueryResult(columns, rows[:QUERY_MAX_ROWS], truncated=len(rows) > QUERY_MAX_ROWS)
+                get_result_cache().put(result_key, cached)
             
-            cursor = conn.execute(clean_query)
-            results = cursor.fetchall()
-            columns = [description[0] for description in cursor.description]
-            conn.close()
+            # Remember the statement so the index advisor can learn from real traffic
+            get_query_log().record(clean_query)
             
             return {
                 "success": True,
-                "columns": columns,
-                "data": results,
-                "row_count": len(results),
-                "query_executed": clean_query
+                "columns": list(cached.columns),
+                "data": cached.rows(),
+                "row_count": cached.row_count,
+                "truncated": cached.truncated,
+                "query_executed": sql_text
             }
         except Exception as e:
             # Get database info for debugging
@@ -747,20 +3139,697 @@ class KrisprChatbot:
                 "database_info": db_info
             }
     
-    def get_ai_response(self, user_question):
-        """Get AI response using SQL database"""
+    def table_prompt_block(self, sheet_name, table_info):
+        """Schema, column mapping, sample rows and product values of one table, as written into the SQL system prompt"""
+        block = f"""
+            
+        DATA SOURCE: {table_info['table_name']} (from "{sheet_name}")
+        - Records: {table_info['row_count']:,}
+        - Columns: {', '.join(table_info['sample_columns'])}
+        """
+        if table_info.get('rollup_of'):
+            block += f"""- Pre-aggregated: weekly totals of {table_info['rollup_of']} by ISO Year/Week (use instead of {table_info['rollup_of']} for weekly questions)
+        """
+        block += f"""
+        Column Mapping (Original → System):
+        {json.dumps(dict(table_info['column_mapping']), indent=2)}
+        
+        Sample Data from {table_info['table_name']}:
+        Columns: {list(table_info['sample_columns'])}
+        """
+        for i, row in enumerate(table_info['sample_data'][:3]):  # Show 3 rows instead of 5 for context
+            block += f"\nRow {i+1}: {row}"
+        
+        # Enhanced column analysis for media/organic detection
+        block += f"""
+        
+        IMPORTANT COLUMN ANALYSIS for {table_info['table_name']}:
+        """
+        # Look for media/organic related columns
+        media_organic_columns = []
+        for col in table_info['sample_columns']:
+            if any(keyword in col.lower() for keyword in ['media', 'msv', 'organic', 'osv', 'units_sold', 'performance', 'sold']):
+                media_organic_columns.append(col)
+        
+        if media_organic_columns:
+            block += f"Media/Organic Related Columns: {', '.join(media_organic_columns)}\n"
+        
+        # Look for week columns
+        week_columns = [col for col in table_info['sample_columns'] if 'week' in col.lower()]
+        if week_columns:
+            block += f"Week Columns: {', '.join(week_columns)}\n"
+        
+        # Add product information if available
+        if table_info['product_columns']:
+            block += f"""
+        Product Columns in {table_info['table_name']}:
+        """
+            for prod_col in table_info['product_columns']:
+                block += f"""
+        - {prod_col['column']} (original: {prod_col['original_name']})
+          Sample products: {list(prod_col['unique_values'][:5])}
+        """
+        return block
+    
+    def build_prompt_parts(self):
+        """Build the pieces of the SQL system prompt: the header, one schema block per table, and the closing instructions per query mode"""
+        # Prepare database context
+        header = f"""
+        You are KRISPR Business Intelligence Assistant, an expert data analyst. You have access to business data from multiple sources.
+        
+        DATABASE INFORMATION:
+        - Total Data Sources: {self.data_summary['total_tables']}
+        
+        AVAILABLE DATA SOURCES AND SCHEMA:
+        """
+        
+        instructions = """
+        
+        INSTRUCTIONS:
+        1. You are a business intelligence assistant with access to comprehensive business data
+        2. When users ask questions, ALWAYS generate and execute queries to find precise answers
+        3. Use SELECT statements to query the data - NEVER give up without trying SQL first
+        
+        *** CRITICAL SALES DATA RULE - ABSOLUTE PRIORITY ***
+        For ANY sales/units question involving specific weeks:
+        - WEEKS 21-24: Use 'total_units_sold' from raw sales tables
+        - WEEKS 25-28: Use 'invoiced_units' or 'supplied_units' from overall tables
+        - NEVER use 'units_sold' terminology for weeks 25+ in responses
+        - Always check week numbers first before selecting data source
+        *** END CRITICAL RULE ***
+        
+        4. For media vs organic comparisons, look for columns containing:
+           - 'media', 'MSV', 'Media_Units_Sold', 'media_sold', 'media_performance'
+           - 'organic', 'OSV', 'Org_Units_Sold', 'organic_sold', 'organic_performance'
+        5. For vendor/supplier questions, look for columns like 'vendor', 'supplier', 'source', etc.
+        6. For week questions, look for columns containing 'week' or numeric week values
+        7. For weekly comparisons, use GROUP BY week to compare across different weeks
+        8. For performance comparisons, calculate totals, averages, or ratios as needed
+        9. ALWAYS try to find relevant data - be creative with column name variations
+        10. Use the clean column names (system-compatible) in your queries
+        11. When searching for week 25/26, use WHERE week = 25 or WHERE week_number = 25
+        12. For comparisons, use SUM(), AVG(), or direct column comparisons
+        13. Group results by vendor/week/product as needed for breakdowns
+        14. NEVER mention "SQLite", "database", or technical terms - just provide business insights
+        
+        CRITICAL SALES COMPARISON LOGIC - MUST FOLLOW:
+        For ANY sales-related question, you MUST use different data sources based on week numbers:
+        
+        WEEK-BASED DATA SOURCE RULES (MANDATORY):
+        - Weeks 21, 22, 23, 24 (< 25): Use 'total_units_sold' or 'units_sold' from RAW SALES data tables
+        - Weeks 25, 26, 27, 28 (>= 25): Use 'invoiced_units' or 'supplied_units' from OVERALL/SUMMARY data tables
+        
+        STEP-BY-STEP PROCESS FOR SALES QUERIES:
+        1. Identify ALL week numbers mentioned in the user question
+        2. For each week number, determine data source:
+           - If week < 25: Query raw sales table for 'total_units_sold' or 'units_sold'
+           - If week >= 25: Query overall/summary table for 'invoiced_units' or 'supplied_units'
+        3. If question spans both ranges, use UNION or separate queries for each range
+        4. NEVER mix data sources - maintain separation between raw sales and invoiced data
+        
+        MANDATORY QUERY EXAMPLES:
+        - Week 21-24 sales: SELECT week, SUM(total_units_sold) FROM raw_sales_table WHERE week IN (21,22,23,24) GROUP BY week;
+        - Week 25-28 sales: SELECT week, SUM(invoiced_units) FROM overall_table WHERE week IN (25,26,27,28) GROUP BY week;
+        - Mixed range (21-28): Use UNION of both queries above
+        - Single week < 25: SELECT SUM(total_units_sold) FROM raw_sales_table WHERE week = 22;
+        - Single week >= 25: SELECT SUM(invoiced_units) FROM overall_table WHERE week = 26;
+        
+        RESPONSE LANGUAGE RULES:
+        - For weeks < 25: Say "units sold" (from raw sales)
+        - For weeks >= 25: Say "invoiced units" or "supplied units" (from overall data)
+        - NEVER say "units sold" for weeks 25+
+        
+        IMPORTANT: Format your query EXACTLY like this (no markdown, no code blocks):
+        SQL_QUERY: SELECT column FROM table WHERE condition;
+        EXPLANATION: [your explanation here]
+        
+        DO NOT use ```sql or ``` formatting. Just provide the plain query after "SQL_QUERY:"
+        ALWAYS TRY TO GENERATE A QUERY - don't give generic "I couldn't find data" responses without trying SQL first.
+        
+        Provide your response in this exact format:
+        SQL_QUERY: [clean query statement here]
+        EXPLANATION: [explanation of what you're looking for]
+        """
+        
+        tool_instructions = instructions[:instructions.index("IMPORTANT: Format your query EXACTLY")] + """HOW TO ANSWER:
+        - Call the run_sql tool with a single SELECT statement to get the figures you need
+        - If run_sql returns an error, correct the query and call it again
+        - ALWAYS TRY A QUERY - don't give generic "I couldn't find data" responses without calling run_sql first
+        - Once you have the results, answer the user's question in a natural, conversational tone, like you're talking to a colleague
+        - Give the direct answer first, then supporting details, with specific numbers and vendor names in the sentences
+        - Don't use numbered lists, bullet points or bold section headings
+        - NEVER mention file names, table names, sheet names, SQL or database structure details
+        - For weeks 21-24 say "units sold"; for weeks 25-28 say "invoiced units" or "supplied units" - NEVER "units sold"
+        """
+        
+        return {
+            "header": header,
+            "tables": {table_info['table_name']: self.table_prompt_block(sheet_name, table_info) for sheet_name, table_info in self.data_summary['tables'].items()},
+            "rollups": [table_info['table_name'] for table_info in self.data_summary['tables'].values() if table_info.get('rollup_of')],
+            SQL_MODE_LEGACY: instructions,
+            SQL_MODE_TOOLS: tool_instructions
+        }
+    
+    def assemble_system_prompt(self, parts, mode, tables=None):
+        """Join the prompt pieces for one query mode, keeping only the given tables' schema (None keeps every table)"""
+        context = parts['header'] + "".join(block for table_name, block in parts['tables'].items() if tables is None or table_name in tables)
+        
+        # Point weekly questions at the rollup tables instead of the daily order lines
+        rollup_tables = [table_name for table_name in parts['rollups'] if tables is None or table_name in tables]
+        if rollup_tables:
+            context += f"""
+        
+        PRE-AGGREGATED WEEKLY TABLES:
+        - {', '.join(rollup_tables)} already hold weekly totals (Year, Week, Total_Units_Sold) of the daily order lines
+        - For weekly units sold (weeks 21-24), query these with WHERE Week = N instead of aggregating the daily table
+        - Never derive weeks with strftime() on order dates; use the Week column of these tables
+        """
+        
+        return context + parts[mode]
+    
+    def build_system_prompt(self, tables=None):
+        """Build the SQL system prompt for each query mode from scratch; it depends on the data and the chosen tables, never on the question text"""
+        parts = self.build_prompt_parts()
+        return {mode: self.assemble_system_prompt(parts, mode, tables) for mode in (SQL_MODE_LEGACY, SQL_MODE_TOOLS)}
+    
+    def get_system_prompt(self, mode=SQL_MODE_LEGACY, tables=None):
+        """Return the system prompt for the current data generation; its pieces are built once and shared by all sessions"""
+        return self.assemble_system_prompt(get_prompt_cache().get(self.db_path, self.build_prompt_parts), mode, tables)
+    
+    def relevant_tables(self, user_question):
+        """Tables whose schema goes into the prompt for this question; None sends every table"""
+        if not self.prune_schema:
+            return None
+        index = get_schema_index_cache().get(self.db_path, lambda: SchemaIndex(self.data_summary['tables']))
+        return index.select(user_question) if index is not None else None
+    
+    def find_weekly_product_table(self):
+        """Locate the weekly per-product table with units sold, invoiced units and the media/organic split"""
+        catalog = self.get_catalog()
+        needed = {"week", "product_name", "total_units_sold", "invoiced_supplied", "media_units_sold", "org_units_sold"}
+        for table_name, entry in (catalog['tables'].items() if catalog else []):
+            columns = {column.lower(): f'"{column}"' for column in entry['columns']}
+            if needed <= set(columns):
+                return table_name, columns
+        return None
+    
+    def weekly_units(self, table_name, columns, week):
+        """Return (units, label) for a week, using units sold before the invoicing cut-over and invoiced units after"""
+        column, label = ("invoiced_supplied", "invoiced units") if week >= INVOICED_FROM_WEEK else ("total_units_sold", "units sold")
+        result = self.execute_sql_query(f'SELECT SUM({columns[column]}) FROM "{table_name}" WHERE {columns["week"]} = {week};')
+        if not result["success"] or not result["data"] or result["data"][0][0] is None:
+            return None, label
+        return result["data"][0][0], label
+    
+    def answer_from_template(self, intent, slots):
+        """Answer a matched question template from a fixed query; None when the data can't answer it that way"""
+        source = self.find_weekly_product_table()
+        if source is None:
+            return None
+        table_name, columns = source
+        
+        if intent == "units":
+            units, label = self.weekly_units(table_name, columns, slots['week'])
+            if units is None:
+                return None
+            return f"Week {slots['week']} had {format_units(units)} {label} in total."
+        
+        if intent == "compare_weeks":
+            first_week, second_week = slots['weeks']
+            first_units, first_label = self.weekly_units(table_name, columns, first_week)
+            second_units, second_label = self.weekly_units(table_name, columns, second_week)
+            if first_units is None or second_units is None:
+                return None
+            if first_label != second_label:
+                return (f"Week {first_week} had {format_units(first_units)} {first_label}, while week {second_week} had "
+                        f"{format_units(second_units)} {second_label}. Weeks before {INVOICED_FROM_WEEK} are measured as units sold and later weeks as "
+                        f"invoiced units, so the two figures aren't a like-for-like comparison.")
+            answer = f"Week {first_week} had {format_units(first_units)} {first_label} and week {second_week} had {format_units(second_units)}"
+            if first_units:
+                change = (second_units - first_units) / first_units
+                answer += f", {abs(change):.1%} {'more' if change >= 0 else 'fewer'} than week {first_week}"
+            return answer + "."
+        
+        week = slots['week']
+        if intent == "media_organic":
+            result = self.execute_sql_query(
+                f'SELECT SUM({columns["media_units_sold"]}), SUM({columns["org_units_sold"]}) FROM "{table_name}" WHERE {columns["week"]} = {week};'
+            )
+            if not result["success"] or not result["data"] or None in result["data"][0] or not sum(result["data"][0]):
+                return None
+            media, organic = result["data"][0]
+            label = "units sold" if week < INVOICED_FROM_WEEK else "units"
+            return (f"In week {week}, media accounted for {format_units(media)} {label} and organic for {format_units(organic)}, "
+                    f"so media made up {media / (media + organic):.1%} of the split and organic {organic / (media + organic):.1%}.")
+        
+        if intent == "top_k":
+            if slots['entity'] == "product":
+                column, label = ("invoiced_supplied", "invoiced units") if week >= INVOICED_FROM_WEEK else ("total_units_sold", "units sold")
+                query = (f'SELECT {columns["product_name"]}, SUM({columns[column]}) AS units FROM "{table_name}" '
+                         f'WHERE {columns["week"]} = {week} GROUP BY {columns["product_name"]} HAVING units IS NOT NULL ORDER BY units DESC LIMIT {slots["k"]};')
+            else:
+                # Vendors only appear in the daily sales lines, which have no invoiced figures for later weeks
+                vendor_rollup = next((name for name, group_columns in ROLLUP_TABLES.items() if group_columns == ["Vendor_Name"]), None)
+                catalog = self.get_catalog()
+                if week >= INVOICED_FROM_WEEK or vendor_rollup not in catalog['tables']:
+                    return None
+                label = "units sold"
+                query = (f'SELECT "Vendor_Name", SUM("Total_Units_Sold") AS units FROM "{vendor_rollup}" '
+                         f'WHERE "Week" = {week} GROUP BY "Vendor_Name" ORDER BY units DESC LIMIT {slots["k"]};')
+            result = self.execute_sql_query(query)
+            if not result["success"] or not result["data"]:
+                return None
+            ranked = [f"{name} ({format_units(units)})" for name, units in result["data"]]
+            if len(ranked) == 1:
+                return f"{result['data'][0][0]} led week {week} with {format_units(result['data'][0][1])} {label}."
+            return f"The top {len(ranked)} {slots['entity']}s by {label} in week {week} were {join_names(ranked)}."
+        
+        return None
+    
+    def start_request_metrics(self, mode, prompt_build_ms, system_prompt):
+        """Start the metrics record for a question: prompt build time and size, then tokens and round trips as calls are made"""
+        metrics = {
+            "at": datetime.now().isoformat(timespec='seconds'),
+            "mode": mode,
+            "build_ms": prompt_build_ms,
+            "prompt_chars": len(system_prompt),
+            "prompt_tokens": None,
+            "cached_tokens": 0,
+            "round_trips": 0,
+            "answered": False,
+            "first_token_ms": None
+        }
+        self.last_prompt_metrics = metrics
+        get_prompt_metrics().record(metrics)
+        return metrics
+    
+    def record_usage(self, usage):
+        """Add the tokens the provider counted for the last call to the current question, and store the call with its cost"""
+        if usage is None or self.last_prompt_metrics is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) or 0
+        self.last_prompt_metrics['prompt_tokens'] = (self.last_prompt_metrics['prompt_tokens'] or 0) + usage.prompt_tokens
+        self.last_prompt_metrics['cached_tokens'] += cached_tokens
+        if self.last_call is None:
+            return
+        completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+        now = datetime.now()
+        get_usage_store().record({
+            "at": now.isoformat(timespec='seconds'),
+            "day": now.date().isoformat(),
+            "session": self.session_id,
+            "question_id": self.trace.id if self.trace is not None else None,
+            "question": self.trace.question if self.trace is not None else None,
+            "mode": self.last_prompt_metrics['mode'],
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "cost_usd": usage_cost(usage.prompt_tokens, completion_tokens, cached_tokens),
+            **self.last_call
+        })
+        self.last_call = None
+    
+    def trace_span(self, stage):
+        """Time a pipeline stage of the current question"""
+        return self.trace.span(stage) if self.trace is not None else nullcontext()
+    
+    def record_route(self, route):
+        """Count how the current question was answered"""
+        get_route_stats().record(route)
+        if self.trace is not None:
+            self.trace.route = route
+    
+    def remaining_seconds(self):
+        """Time left before the current question's deadline; raises once it has passed"""
+        if self.question_deadline is None:
+            return float('inf')
+        remaining = self.question_deadline - time.monotonic()
+        if remaining <= 0:
+            raise QuestionDeadlineExceeded()
+        return remaining
+    
+    def chat_completion(self, **request):
+        """Call the chat model for the current question, retrying 429/5xx within the question deadline, and count the round trip"""
+        if request.get('stream'):
+            request['stream_options'] = {"include_usage": True}
+        stage = "second_completion" if self.trace is not None and "first_completion" in self.trace.stages else "first_completion"
+        sections = estimate_prompt_sections(request['messages'], request.get('tools'))
+        estimated_tokens = sum(sections.values()) + request.get('max_tokens', 0)
+        attempt = 0
+        while True:
+            get_rate_limiter().acquire(estimated_tokens, min(RATE_LIMIT_MAX_WAIT_SECONDS, self.remaining_seconds()))
+            try:
+                with self.trace_span(stage):
+                    response = self.create_completion(request, estimated_tokens)
+                break
+            except RETRYABLE_OPENAI_ERRORS as e:
+                delay = retry_delay(attempt, e)
+                if attempt >= self.max_retries or delay >= self.remaining_seconds():
+                    raise
+                get_call_stats().count("retries")
+                time.sleep(delay)
+                attempt += 1
+        # A streamed call's usage arrives with its last chunk, so the call is stored from stream_final_answer
+        self.last_call = {"stage": stage, "sections": sections}
+        if self.last_prompt_metrics is not None:
+            self.last_prompt_metrics['round_trips'] += 1
+        if not request.get('stream'):
+            self.record_usage(getattr(response, 'usage', None))
+        return response
+    
+    def timed_completion(self, request, timeout):
+        """One API call; full (non-streamed) call latencies feed the hedging threshold"""
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(model="gpt-4o-mini", temperature=0.1, timeout=timeout, **request)
+        if not request.get('stream'):
+            get_call_stats().record_latency(time.perf_counter() - start)
+        return response
+    
+    def create_completion(self, request, estimated_tokens):
+        """Make the call, hedged when enabled: a duplicate goes out if the first is slower than the recent p95, and the first success wins"""
+        timeout = min(self.call_timeout, self.remaining_seconds())
+        # Streamed calls return as soon as the answer starts, so there is no slow tail to hedge
+        hedge_after = get_call_stats().percentile(HEDGE_PERCENTILE) if self.hedge_requests and not request.get('stream') else None
+        if hedge_after is None or hedge_after >= timeout:
+            return self.timed_completion(request, timeout)
+        
+        first = get_hedge_pool().submit(self.timed_completion, request, timeout)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        try:
+            get_rate_limiter().acquire(estimated_tokens, max_wait=0)
+        except ModelBusy:
+            # No spare budget for a duplicate: keep waiting on the original
+            return first.result()
+        get_call_stats().count("hedges")
+        hedge = get_hedge_pool().submit(self.timed_completion, request, timeout - hedge_after)
+        
+        # The slower attempt is left to finish in the background; its response is discarded
+        attempts = {first, hedge}
+        while True:
+            done, attempts = wait(attempts, return_when=FIRST_COMPLETED)
+            winner = next((attempt for attempt in done if attempt.exception() is None), None)
+            if winner is not None:
+                if winner is hedge:
+                    get_call_stats().count("hedge_wins")
+                return winner.result()
+            if not attempts:
+                return done.pop().result()
+    
+    def result_column_stats(self, query_result):
+        """Totals and ranges per numeric result column, over every row the query returns"""
+        columns = query_result["columns"]
+        values = list(zip(*query_result["data"])) if query_result["data"] else [() for _ in columns]
+        numeric = [
+            position for position, column_values in enumerate(values)
+            if any(value is not None for value in column_values)
+            and all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in column_values)
+        ]
+        
+        if query_result.get("truncated") and len(set(columns)) == len(columns):
+            # Only part of the result is in memory, so let SQLite aggregate the full query instead
+            try:
+                aggregates = ", ".join(
+                    f'SUM("{columns[position]}"), MIN("{columns[position]}"), MAX("{columns[position]}"), AVG("{columns[position]}")'
+                    for position in numeric
+                )
+                # Same connection and guards as the query itself; the line breaks keep a trailing -- comment inside the subquery
+                stats_query = f'SELECT COUNT(*){", " + aggregates if aggregates else ""} FROM (\n{query_result["query_executed"]}\n)'
+                _, row = self.run_guarded_query(stats_query, normalize_sql_query(stats_query), lambda cursor: cursor.fetchone())
+                stats = {
+                    columns[position]: dict(zip(("sum", "min", "max", "mean"), row[1 + 4 * index:5 + 4 * index]))
+                    for index, position in enumerate(numeric)
+                }
+                return row[0], stats, "all rows"
+            except (sqlite3.Error, QueryRejected):
+                pass
+        
+        stats = {}
+        for position in numeric:
+            column = np.array(values[position], dtype=float)
+            stats[columns[position]] = {
+                "sum": float(np.nansum(column)),
+                "min": float(np.nanmin(column)),
+                "max": float(np.nanmax(column)),
+                "mean": float(np.nanmean(column))
+            }
+        scope = f"the first {query_result['row_count']:,} rows" if query_result.get("truncated") else "all rows"
+        return query_result["row_count"], stats, scope
+    
+    def summarize_query_result(self, query_result):
+        """Fit a query result into RESULT_TOKEN_BUDGET: leading rows verbatim, plus per-column totals when rows are left out"""
+        header = f"Columns: {query_result['columns']}"
+        row_lines = [str(tuple(row)) for row in query_result["data"]]
+        budget = RESULT_TOKEN_BUDGET * CHARS_PER_TOKEN
+        if query_result.get("truncated") or len(header) + sum(len(line) + 1 for line in row_lines) > budget:
+            # Leave room for the row count line and one totals line per column
+            budget -= 100 * (len(query_result['columns']) + 1)
+        lines, used = [], len(header)
+        for line in row_lines:
+            if used + len(line) + 1 > budget:
+                break
+            lines.append(line)
+            used += len(line) + 1
+        
+        summary = {
+            "columns": query_result["columns"],
+            "rows": query_result["data"][:len(lines)],
+            "row_count": query_result["row_count"],
+            "rows_shown": len(lines),
+            "truncated": False,
+            "column_stats": {},
+            "stats_scope": None
+        }
+        if len(lines) == query_result["row_count"] and not query_result.get("truncated"):
+            summary["text"] = "\n".join([header] + lines)
+            return summary
+        
+        row_count, stats, scope = self.result_column_stats(query_result)
+        summary.update(row_count=row_count, truncated=True, column_stats=stats, stats_scope=scope)
+        stat_lines = [
+            f"{column}: sum={values['sum']:,.2f}, min={values['min']:,.2f}, max={values['max']:,.2f}, mean={values['mean']:,.2f}"
+            for column, values in stats.items() if values['sum'] is not None
+        ]
+        summary["text"] = "\n".join(
+            [header, f"First {len(lines):,} of {row_count:,} rows:"] + lines
+            + ([f"Column totals over {scope}:"] + stat_lines if stat_lines else [])
+        )
+        return summary
+    
+    def result_note(self, summary):
+        """Tell the user when an answer was written from part of the query result"""
+        if not summary.get("truncated"):
+            return ""
+        note = f"\n\n_Based on the first {summary['rows_shown']:,} of {summary['row_count']:,} result rows"
+        if summary['column_stats']:
+            note += f"; totals cover {summary['stats_scope']}"
+        return note + "._"
+    
+    def run_traced_query(self, query):
+        """execute_sql_query, timed and noted on the current question's trace"""
+        if self.trace is not None:
+            self.trace.sql.append(query)
+        with self.trace_span("sql_execute"):
+            return self.execute_sql_query(query)
+    
+    def run_sql_tool(self, tool_call):
+        """Execute one run_sql tool call and return the payload sent back to the model"""
+        try:
+            with self.trace_span("sql_parse"):
+                if tool_call.function.name != "run_sql":
+                    raise ValueError
+                query = json.loads(tool_call.function.arguments)["query"]
+        except (ValueError, KeyError, TypeError):
+            return {"success": False, "error": "Call run_sql with a JSON object holding a 'query' string"}
+        
+        query_result = self.run_traced_query(query)
+        if not query_result["success"]:
+            return {"success": False, "error": query_result["error"]}
+        summary = self.summarize_query_result(query_result)
+        del summary["text"]
+        return {"success": True, **summary}
+    
+    def tool_answer_messages(self, user_question, messages):
+        """Messages for the answer turn of tools mode: each successful query with its result, and short answer guidelines"""
+        queries = {}
+        for message in messages:
+            for call in message.get('tool_calls') or ():
+                try:
+                    queries[call['id']] = json.loads(call['function']['arguments'])['query']
+                except (ValueError, KeyError, TypeError):
+                    queries[call['id']] = call['function']['arguments']
+        results = "\n\n".join(
+            f"Query: {queries.get(message['tool_call_id'], '')}\n{message['content']}"
+            for message in messages
+            if message['role'] == 'tool' and json.loads(message['content']).get('success')
+        )
+        context = f"""You are KRISPR Business Intelligence Assistant. These queries were run against the business data.
+        
+        Results:
+        {results}
+        
+        Based on these results, provide a natural, conversational answer to the user's question: {user_question}
+        
+        {TOOL_ANSWER_GUIDELINES}
+        """
+        return [
+            {"role": "system", "content": context},
+            {"role": "user", "content": "Provide the final answer based on the results."}
+        ]
+    
+    def answer_with_tools(self, user_question, system_prompt, answer_key, question_start, stream=False, entity_hint=""):
+        """Let the model query through run_sql and answer in the same conversation; None means it used the text protocol instead"""
+        # The entity hint names tables and columns, so it goes with the question for the SQL turns only
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_question + entity_hint}
+        ]
+        queried = False
+        note = ""
+        tool_choice = "auto"
+        for round_number in range(SQL_TOOL_MAX_ROUNDS):
+            if round_number == SQL_TOOL_MAX_ROUNDS - 1:
+                tool_choice = "none"
+            
+            # Once results are in hand the next turn can only be the answer: send just the results, and stream it
+            if queried and tool_choice == "none":
+                response = self.chat_completion(messages=self.tool_answer_messages(user_question, messages), max_tokens=1000, stream=stream)
+                self.last_prompt_metrics['answered'] = True
+                if stream:
+                    return self.stream_final_answer(response, answer_key, question_start, note)
+                answer = (response.choices[0].message.content or "") + note
+                self.last_prompt_metrics['first_token_ms'] = (time.perf_counter() - question_start) * 1000
+                get_answer_cache().put(answer_key, answer)
+                return answer
+            
+            response = self.chat_completion(
+                messages=messages,
+                tools=[RUN_SQL_TOOL],
+                tool_choice=tool_choice,
+                max_tokens=1000
+            )
+            message = response.choices[0].message
+            if not message.tool_calls:
+                break
+            
+            messages.append({
+                "role": "assistant",
+                "content": message.content,
+                "tool_calls": [
+                    {"id": call.id, "type": "function", "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                    for call in message.tool_calls
+                ]
+            })
+            failed = False
+            for call in message.tool_calls:
+                tool_result = self.run_sql_tool(call)
+                queried = queried or tool_result["success"]
+                failed = failed or not tool_result["success"]
+                note = self.result_note(tool_result) or note
+                messages.append({"role": "tool", "tool_call_id": call.id, "content": json.dumps(tool_result, default=str)})
+            
+            # After an error the model gets another turn to fix its query; otherwise it must answer now
+            if not failed:
+                tool_choice = "none"
+        
+        answer = message.content or ""
+        if not queried:
+            # No data was looked up: either a non-data reply, or a model that wrote SQL_QUERY text instead of calling the tool
+            return None if "SQL_QUERY:" in answer else answer
+        
+        answer += note
+        self.last_prompt_metrics['answered'] = True
+        self.last_prompt_metrics['first_token_ms'] = (time.perf_counter() - question_start) * 1000
+        get_answer_cache().put(answer_key, answer)
+        return answer
+    
+    def stream_final_answer(self, final_response, answer_key, question_start, note=""):
+        """Yield the final answer as it arrives, followed by any note, then cache the full text like a non-streamed answer"""
+        parts = []
+        try:
+            for chunk in final_response:
+                if getattr(chunk, 'usage', None) is not None:
+                    self.record_usage(chunk.usage)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if not parts and self.last_prompt_metrics is not None:
+                    self.last_prompt_metrics['first_token_ms'] = (time.perf_counter() - question_start) * 1000
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        except Exception:
+            # Keep whatever already reached the user and explain the cut-off instead of raising into the page
+            yield "\n\nThe answer was interrupted. Please ask again."
+            return
+        if note:
+            parts.append(note)
+            yield note
+        if parts:
+            get_answer_cache().put(answer_key, "".join(parts))
+    
+    def answer_in_background(self, pending):
+        """Executor job: run the question pipeline and feed the answer text into pending"""
+        pending.trace.add("queue", (time.perf_counter() - pending.trace.started) * 1000)
+        try:
+            # The chat page finishes the trace once it has drawn the answer
+            response = self.get_ai_response(pending.question, stream=True, trace=pending.trace)
+            if isinstance(response, str):
+                pending.append(response)
+            else:
+                for chunk in response:
+                    pending.append(chunk)
+        except Exception:
+            pending.append("I had trouble processing your request. Please try again.")
+        finally:
+            pending.finish()
+    
+    def question_worker(self):
+        """Copy of this chatbot for one background question, so its trace, deadline, prompt metrics and call record stay off the session's chatbot"""
+        worker = copy.copy(self)
+        worker.trace = None
+        worker.question_deadline = None
+        worker.last_prompt_metrics = None
+        worker.last_call = None
+        return worker
+    
+    def submit_question(self, user_question):
+        """Answer a question on the shared executor; returns a PendingAnswer, or None when too many questions are waiting"""
+        pending = PendingAnswer(user_question)
+        if get_request_executor().submit(self.question_worker().answer_in_background, pending) is None:
+            return None
+        return pending
+    
+    def get_ai_response(self, user_question, stream=False, trace=None):
+        """Get AI response using SQL database; with stream=True the final answer is returned as a generator of text chunks.
+        
+        Each stage is timed on a RequestTrace. A trace passed in is left open for the caller to finish."""
+        self.trace = trace or RequestTrace(user_question)
+        response = self.answer_question(user_question, stream)
+        if isinstance(response, str):
+            if trace is None:
+                self.trace.finish()
+            return response
+        return self.trace.timed_stream(response, "second_completion", finish=trace is None)
+    
+    def answer_question(self, user_question, stream=False):
+        """The question pipeline behind get_ai_response"""
+        question_start = time.perf_counter()
+        self.question_deadline = time.monotonic() + self.question_timeout
         if not self.client:
             return "Please contact admin to configure the system first."
         
         # Check database status
-        db_ready, db_message = self.check_database_exists_and_ready()
+        with self.trace_span("readiness"):
+            db_ready, db_message = self.check_database_exists_and_ready()
         if not db_ready:
             return f"Database not ready: {db_message}. Please contact admin to upload data."
         
-        # Load database summary if not already loaded
-        if not self.data_summary:
-            if not self.load_existing_database_summary():
-                return "Error loading database information. Please contact admin."
+        # Fetch the shared database summary (only rebuilt when the database changed)
+        with self.trace_span("summary"):
+            summary_loaded = self.load_existing_database_summary()
+        if not summary_loaded:
+            return "Error loading database information. Please contact admin."
         
         try:
             # Handle simple greetings only (not data questions)
@@ -769,148 +3838,64 @@ class KrisprChatbot:
             
             # Only respond with greeting if it's JUST a greeting, not a data question
             if question_lower in simple_greetings:
+                self.record_route("greeting")
                 return "Hi there! 👋 I'm KRISPR Business Intelligence Assistant. I'm here to help you analyze your business data and provide insights. How can I assist you today?"
             
             if question_lower in ['who are you', 'what are you','what can you do ?', 'introduce yourself']:
+                self.record_route("greeting")
                 return "I'm KRISPR Business Intelligence Assistant, your expert data analyst. I can help you understand your business data, find specific metrics, analyze trends, and provide actionable insights. What would you like to know about your data?"
             
-            # For ALL OTHER questions (including data questions), process with SQL
-            # Prepare database context
-            context = f"""
-            You are KRISPR Business Intelligence Assistant, an expert data analyst. You have access to business data from multiple sources.
-            
-            DATABASE INFORMATION:
-            - Total Data Sources: {self.data_summary['total_tables']}
-            
-            AVAILABLE DATA SOURCES AND SCHEMA:
-            """
-            
-            # Add detailed table information with enhanced column guidance
-            for sheet_name, table_info in self.data_summary['tables'].items():
-                context += f"""
-                
-            DATA SOURCE: {table_info['table_name']} (from "{sheet_name}")
-            - Records: {table_info['row_count']:,}
-            - Columns: {', '.join(table_info['sample_columns'])}
-            
-            Column Mapping (Original → System):
-            {json.dumps(table_info['column_mapping'], indent=2)}
-            
-            Sample Data from {table_info['table_name']}:
-            Columns: {table_info['sample_columns']}
-            """
-                for i, row in enumerate(table_info['sample_data'][:3]):  # Show 3 rows instead of 5 for context
-                    context += f"\nRow {i+1}: {row}"
-                
-                # Enhanced column analysis for media/organic detection
-                context += f"""
+            # Repeated questions on the same data are answered from the shared cache.
+            # The database id and generation are part of the key, so a new upload or a recreated database invalidates every entry.
+            answer_key = (self.get_database_id(), self.get_data_generation(), normalize_question(user_question))
+            cached_answer = get_answer_cache().get(answer_key)
+            if cached_answer is not None:
+                self.record_route("answer_cache")
+                return cached_answer
             
-            IMPORTANT COLUMN ANALYSIS for {table_info['table_name']}:
-            """
-                # Look for media/organic related columns
-                media_organic_columns = []
-                for col in table_info['sample_columns']:
-                    if any(keyword in col.lower() for keyword in ['media', 'msv', 'organic', 'osv', 'units_sold', 'performance', 'sold']):
-                        media_organic_columns.append(col)
-                
-                if media_organic_columns:
-                    context += f"Media/Organic Related Columns: {', '.join(media_organic_columns)}\n"
-                
-                # Look for week columns
-                week_columns = [col for col in table_info['sample_columns'] if 'week' in col.lower()]
-                if week_columns:
-                    context += f"Week Columns: {', '.join(week_columns)}\n"
-                
-                # Add product information if available
-                if table_info['product_columns']:
-                    context += f"""
-            Product Columns in {table_info['table_name']}:
-            """
-                    for prod_col in table_info['product_columns']:
-                        context += f"""
-            - {prod_col['column']} (original: {prod_col['original_name']})
-              Sample products: {prod_col['unique_values'][:5]}
-            """
+            # Common question shapes are answered from a fixed query, without calling the model
+            template = match_question_template(user_question)
+            if template is not None:
+                routed_answer = self.answer_from_template(*template)
+                if routed_answer is not None:
+                    self.record_route("fast_path")
+                    return routed_answer
+            self.record_route("llm")
             
-            context += f"""
+            # For ALL OTHER questions (including data questions), process with SQL
+            # The system prompt is identical for every question on the same data, so it is built once per
+            # generation; the question goes last, in the user message, to keep the prefix cacheable
+            build_start = time.perf_counter()
+            with self.trace_span("prompt"):
+                # Only the tables the question is about, unless the match is too weak to trust
+                schema_tables = self.relevant_tables(user_question)
+                self.trace.schema_tables = sorted(schema_tables) if schema_tables is not None else None
+                context = self.get_system_prompt(self.sql_mode, schema_tables)
+                # Exact spellings of the products and vendors it names ride along with the question
+                hint = self.entity_hint(user_question)
+                sql_question = user_question + hint
+            prompt_build_ms = (time.perf_counter() - build_start) * 1000
+            self.start_request_metrics(self.sql_mode, prompt_build_ms, context)
             
-            INSTRUCTIONS:
-            1. You are a business intelligence assistant with access to comprehensive business data
-            2. When users ask questions, ALWAYS generate and execute queries to find precise answers
-            3. Use SELECT statements to query the data - NEVER give up without trying SQL first
-            
-            *** CRITICAL SALES DATA RULE - ABSOLUTE PRIORITY ***
-            For ANY sales/units question involving specific weeks:
-            - WEEKS 21-24: Use 'total_units_sold' from raw sales tables
-            - WEEKS 25-28: Use 'invoiced_units' or 'supplied_units' from overall tables
-            - NEVER use 'units_sold' terminology for weeks 25+ in responses
-            - Always check week numbers first before selecting data source
-            *** END CRITICAL RULE ***
-            
-            4. For media vs organic comparisons, look for columns containing:
-               - 'media', 'MSV', 'Media_Units_Sold', 'media_sold', 'media_performance'
-               - 'organic', 'OSV', 'Org_Units_Sold', 'organic_sold', 'organic_performance'
-            5. For vendor/supplier questions, look for columns like 'vendor', 'supplier', 'source', etc.
-            6. For week questions, look for columns containing 'week' or numeric week values
-            7. For weekly comparisons, use GROUP BY week to compare across different weeks
-            8. For performance comparisons, calculate totals, averages, or ratios as needed
-            9. ALWAYS try to find relevant data - be creative with column name variations
-            10. Use the clean column names (system-compatible) in your queries
-            11. When searching for week 25/26, use WHERE week = 25 or WHERE week_number = 25
-            12. For comparisons, use SUM(), AVG(), or direct column comparisons
-            13. Group results by vendor/week/product as needed for breakdowns
-            14. NEVER mention "SQLite", "database", or technical terms - just provide business insights
-            
-            CRITICAL SALES COMPARISON LOGIC - MUST FOLLOW:
-            For ANY sales-related question, you MUST use different data sources based on week numbers:
-            
-            WEEK-BASED DATA SOURCE RULES (MANDATORY):
-            - Weeks 21, 22, 23, 24 (< 25): Use 'total_units_sold' or 'units_sold' from RAW SALES data tables
-            - Weeks 25, 26, 27, 28 (>= 25): Use 'invoiced_units' or 'supplied_units' from OVERALL/SUMMARY data tables
-            
-            STEP-BY-STEP PROCESS FOR SALES QUERIES:
-            1. Identify ALL week numbers mentioned in the user question
-            2. For each week number, determine data source:
-               - If week < 25: Query raw sales table for 'total_units_sold' or 'units_sold'
-               - If week >= 25: Query overall/summary table for 'invoiced_units' or 'supplied_units'
-            3. If question spans both ranges, use UNION or separate queries for each range
-            4. NEVER mix data sources - maintain separation between raw sales and invoiced data
-            
-            MANDATORY QUERY EXAMPLES:
-            - Week 21-24 sales: SELECT week, SUM(total_units_sold) FROM raw_sales_table WHERE week IN (21,22,23,24) GROUP BY week;
-            - Week 25-28 sales: SELECT week, SUM(invoiced_units) FROM overall_table WHERE week IN (25,26,27,28) GROUP BY week;
-            - Mixed range (21-28): Use UNION of both queries above
-            - Single week < 25: SELECT SUM(total_units_sold) FROM raw_sales_table WHERE week = 22;
-            - Single week >= 25: SELECT SUM(invoiced_units) FROM overall_table WHERE week = 26;
-            
-            RESPONSE LANGUAGE RULES:
-            - For weeks < 25: Say "units sold" (from raw sales)
-            - For weeks >= 25: Say "invoiced units" or "supplied units" (from overall data)
-            - NEVER say "units sold" for weeks 25+
-            
-            IMPORTANT: Format your query EXACTLY like this (no markdown, no code blocks):
-            SQL_QUERY: SELECT column FROM table WHERE condition;
-            EXPLANATION: [your explanation here]
-            
-            DO NOT use ```sql or ``` formatting. Just provide the plain query after "SQL_QUERY:"
-            ALWAYS TRY TO GENERATE A QUERY - don't give generic "I couldn't find data" responses without trying SQL first.
-            
-            USER QUESTION: {user_question}
-            
-            Provide your response in this exact format:
-            SQL_QUERY: [clean query statement here]
-            EXPLANATION: [explanation of what you're looking for]
-            """
+            # Structured mode: the query arrives as a tool call, so there is nothing to parse
+            if self.sql_mode == SQL_MODE_TOOLS:
+                try:
+                    answer = self.answer_with_tools(user_question, context, answer_key, question_start, stream, hint)
+                except openai.BadRequestError:
+                    # Endpoints or models without tool support
+                    answer = None
+                if answer is not None:
+                    return answer
+                self.last_prompt_metrics['mode'] = SQL_MODE_LEGACY
+                context = self.get_system_prompt(SQL_MODE_LEGACY, schema_tables)
             
             # Get AI response with SQL query
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = self.chat_completion(
                 messages=[
                     {"role": "system", "content": context},
-                    {"role": "user", "content": user_question}
+                    {"role": "user", "content": sql_question}
                 ],
-                max_tokens=1500,
-                temperature=0.1
+                max_tokens=1500
             )
             
             ai_response = response.choices[0].message.content
@@ -918,40 +3903,37 @@ class KrisprChatbot:
             # Extract SQL query from response - handle multiple formats
             sql_query = None
             
-            # Look for SQL_QUERY: format
-            if "SQL_QUERY:" in ai_response:
-                sql_start = ai_response.find("SQL_QUERY:") + len("SQL_QUERY:")
-                sql_end = ai_response.find("EXPLANATION:", sql_start)
-                if sql_end == -1:
-                    sql_end = len(ai_response)
-                sql_query = ai_response[sql_start:sql_end].strip()
-            
-            # Clean up the SQL query - remove markdown formatting
-            if sql_query:
-                # Remove ```sql and ``` markers
-                sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
-                # Remove any remaining markdown or HTML
-                sql_query = sql_query.replace("<code>", "").replace("</code>", "").strip()
-                # Remove any newlines and extra spaces
-                sql_query = " ".join(sql_query.split())
-                # Ensure it ends with semicolon
-                if sql_query and not sql_query.endswith(';'):
-                    sql_query += ';'
+            with self.trace_span("sql_parse"):
+                # Look for SQL_QUERY: format
+                if "SQL_QUERY:" in ai_response:
+                    sql_start = ai_response.find("SQL_QUERY:") + len("SQL_QUERY:")
+                    sql_end = ai_response.find("EXPLANATION:", sql_start)
+                    if sql_end == -1:
+                        sql_end = len(ai_response)
+                    sql_query = ai_response[sql_start:sql_end].strip()
+                
+                # Clean up the SQL query - remove markdown formatting
+                if sql_query:
+                    sql_query = strip_sql_markdown(sql_query)
             
             # Execute the SQL query if found
             if sql_query:
-                query_result = self.execute_sql_query(sql_query)
+                query_result = self.run_traced_query(sql_query)
                 
                 if query_result["success"]:
                     # Format the results
                     if query_result["data"]:
+                        # Large results are cut down to the prompt's token budget before they reach the model
+                        result_summary = self.summarize_query_result(query_result)
+                        
                         # Get final answer from AI
                         final_context = f"""
                         The query was executed successfully. Here are the results:
                         
                         Query: {sql_query}
-                        Results: {query_result['data']}
-                        Columns: {query_result['columns']}
+                        Results:
+                        {result_summary['text']}
+                        {"Only part of the result is listed; use the column totals for overall figures." if result_summary['truncated'] else ""}
                         
                         Based on these results, provide a natural, conversational answer to the user's question: {user_question}
                         
@@ -985,17 +3967,22 @@ class KrisprChatbot:
                         Just answer naturally like a helpful business analyst would in conversation.
                         """
                         
-                        final_response = self.client.chat.completions.create(
-                            model="gpt-4o-mini",
+                        final_response = self.chat_completion(
                             messages=[
                                 {"role": "system", "content": final_context},
                                 {"role": "user", "content": "Provide the final answer based on the results."}
                             ],
                             max_tokens=1000,
-                            temperature=0.1
+                            stream=stream
                         )
+                        self.last_prompt_metrics['answered'] = True
+                        if stream:
+                            return self.stream_final_answer(final_response, answer_key, question_start, self.result_note(result_summary))
                         
-                        return final_response.choices[0].message.content
+                        answer = final_response.choices[0].message.content + self.result_note(result_summary)
+                        self.last_prompt_metrics['first_token_ms'] = (time.perf_counter() - question_start) * 1000
+                        get_answer_cache().put(answer_key, answer)
+                        return answer
                     else:
                         return "I searched the data but couldn't find specific results for your query. Could you try rephrasing your question? For example: 'Compare media and organic units sold for week 25' or 'Show me weekly sales trends for the last 5 weeks'."
                 else:
@@ -1021,6 +4008,11 @@ class KrisprChatbot:
                     else:
                         return ai_response
             
+        except (QuestionDeadlineExceeded, openai.APITimeoutError):
+            get_call_stats().count("deadline_misses")
+            return "This question took too long to answer, so I stopped rather than keep you waiting. Try narrowing it to a specific week, product or vendor."
+        except (ModelBusy, openai.RateLimitError):
+            return "I'm answering a lot of questions right now. Please wait a minute before asking again."
         except Exception as e:
             return "I had trouble processing your request. For media vs organic analysis, try: 'Compare media and organic performance for week 25'. For weekly comparisons, try: 'Show sales trends by week'. What specific analysis would you like?"
 
@@ -1114,6 +4106,18 @@ def admin_panel():
             st.metric("System Status", "Ready", delta="Operational")
         else:
             st.metric("System Status", "Not Ready", delta="Action Required")
+        
+        summary_stats = get_summary_cache().stats()
+        st.info(f"🧠 Shared summary cache: {summary_stats['hits']:,} hits / {summary_stats['misses']:,} misses ({summary_stats['hit_rate']:.0%} hit rate)")
+        pool_stats = get_read_pool().stats()
+        st.info(f"🔌 Read connections: {pool_stats['opened']:,} opened / {pool_stats['reused']:,} reused ({pool_stats['idle']} idle)")
+        if st.session_state.chatbot.memory_replica:
+            replica_stats = get_memory_replica().stats()
+            load_time = f", last load {replica_stats['last_load_ms']:,.0f} ms" if replica_stats['last_load_ms'] is not None else ""
+            if replica_stats['disabled_reason']:
+                st.warning(f"💾 In-memory replica off, queries read the database file: {replica_stats['disabled_reason']}")
+            else:
+                st.info(f"💾 In-memory replica: {replica_stats['bytes'] / (1024 * 1024):,.1f} MB, {replica_stats['loads']:,} loads{load_time}, {replica_stats['fallbacks']:,} queries served from disk")
     
     st.header("📊 Data Management")
     
@@ -1125,29 +4129,217 @@ def admin_panel():
         </div>
         """, unsafe_allow_html=True)
         
-        # Show current database info
+        # Show current database info from the ingest-time catalog
         try:
-            conn = sqlite3.connect(st.session_state.chatbot.db_path)
-            cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
+            catalog = st.session_state.chatbot.get_catalog()
+            tables = catalog['tables']
             
             st.info(f"📊 Available data sources: {len(tables)} datasets")
             st.info(f"📁 Database location: `{st.session_state.chatbot.db_path}`")
+            if catalog['ingested_at']:
+                st.info(f"🕒 Last ingest: {catalog['ingested_at']} (data generation {catalog['generation']})")
             
             # Show table details
             total_rows = 0
             st.subheader("📈 Data Overview")
-            for table in tables:
-                cursor = conn.execute(f"SELECT COUNT(*) FROM {table}")
-                row_count = cursor.fetchone()[0]
-                total_rows += row_count
-                st.text(f"• {table.replace('_', ' ')}: {row_count:,} records")
+            for table, entry in tables.items():
+                if entry.get('rollup_of'):
+                    st.text(f"• {table.replace('_', ' ')}: {entry['row_count']:,} weekly rows (rollup of {entry['rollup_of'].replace('_', ' ')})")
+                    continue
+                total_rows += entry['row_count']
+                st.text(f"• {table.replace('_', ' ')}: {entry['row_count']:,} records")
             
             st.success(f"📈 Total data: {total_rows:,} records across {len(tables)} datasets")
-            conn.close()
             
         except Exception as e:
             st.warning(f"⚠️ Error reading data: {str(e)}")
+        
+        # Shared answer cache for repeated questions
+        st.subheader("💬 Answer Cache")
+        answer_stats = get_answer_cache().stats()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Hit Rate", f"{answer_stats['hit_rate']:.0%}", delta=f"{answer_stats['hits']:,} hits / {answer_stats['misses']:,} misses", delta_color="off")
+        col2.metric("Cached Answers", f"{answer_stats['entries']:,} / {ANSWER_CACHE_SIZE:,}")
+        col3.metric("Evictions", f"{answer_stats['evictions']:,}")
+        if st.button("Clear Answer Cache", key="clear_answer_cache_btn"):
+            get_answer_cache().clear()
+            st.success("✅ Answer cache cleared")
+            st.rerun()
+        
+        # Shared executor load and time spent waiting on the rate limiter
+        st.subheader("🚥 Request Executor")
+        executor_stats = get_request_executor().stats()
+        limiter_stats = get_rate_limiter().stats()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Answering", f"{executor_stats['running']} / {ANSWER_MAX_CONCURRENCY}")
+        col2.metric("Waiting", f"{executor_stats['queued']} / {ANSWER_QUEUE_SIZE}", delta=f"{executor_stats['rejected']:,} turned away", delta_color="off")
+        col3.metric("Completed", f"{executor_stats['completed']:,}")
+        col4.metric("Rate Limit Waits", f"{limiter_stats['waits']:,}", delta=f"{limiter_stats['wait_seconds']:.1f} s total", delta_color="off")
+        
+        # Model call latency and how often the retry, hedging and deadline policy kicked in
+        st.subheader("⏱️ Model Calls")
+        call_stats = get_call_stats().stats()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Latency p50 / p95", f"{call_stats['p50']:.1f} / {call_stats['p95']:.1f} s" if call_stats['calls'] else "-")
+        col2.metric("Retries", f"{call_stats['retries']:,}")
+        col3.metric("Hedged Calls", f"{call_stats['hedges']:,}", delta=f"{call_stats['hedge_wins']:,} won by the duplicate", delta_color="off")
+        col4.metric("Deadline Misses", f"{call_stats['deadline_misses']:,}")
+        
+        # Where the time goes for each question, stage by stage
+        st.subheader("🔬 Pipeline Latency")
+        trace_log = get_trace_log()
+        stage_rows = trace_log.stage_percentiles()
+        if stage_rows:
+            st.dataframe(pd.DataFrame([
+                {
+                    "Stage": row['stage'].replace("_", " ").title(),
+                    "Questions": row['count'],
+                    "p50 (ms)": round(row['p50_ms'], 1),
+                    "p95 (ms)": round(row['p95_ms'], 1),
+                    "Max (ms)": round(row['max_ms'], 1)
+                }
+                for row in stage_rows
+            ]), use_container_width=True)
+            st.caption("Slowest recent questions")
+            st.dataframe(pd.DataFrame([
+                {
+                    "Time": trace['at'],
+                    "Question": trace['question'],
+                    "Route": trace['route'],
+                    "Total (ms)": trace['total_ms'],
+                    "Slowest Stage": max(trace['stages'], key=trace['stages'].get) if trace['stages'] else "-",
+                    "Schema": ", ".join(trace['schema_tables']) if trace.get('schema_tables') else "all tables",
+                    "SQL": " ; ".join(trace['sql'])
+                }
+                for trace in trace_log.slowest()
+            ]), use_container_width=True)
+            st.caption(f"Every trace is also appended to {trace_log.path}")
+        else:
+            st.info("No questions traced yet")
+        
+        # What questions cost, and which part of the prompt the tokens go to
+        st.subheader("💰 Token Usage & Cost")
+        usage_store = get_usage_store()
+        daily_usage = usage_store.daily()
+        if not daily_usage.empty:
+            today = daily_usage.iloc[0]
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric(f"Questions ({today['day']})", f"{today['questions']:,}")
+            col2.metric("Prompt Tokens", f"{int(today['prompt_tokens']):,}")
+            col3.metric("Completion Tokens", f"{int(today['completion_tokens']):,}")
+            col4.metric("Cost", f"${today['cost_usd']:.4f}", delta=f"${today['cost_usd'] / today['questions']:.5f} per question", delta_color="off")
+            
+            st.caption("Most expensive questions, with the estimated tokens of each prompt section")
+            st.dataframe(usage_store.top_questions(), use_container_width=True)
+            st.caption("Per stage: average tokens per call and the estimated make-up of the prompt")
+            st.dataframe(usage_store.by_stage(), use_container_width=True)
+            col1, col2 = st.columns(2)
+            with col1:
+                st.caption("Per day")
+                st.dataframe(daily_usage, use_container_width=True)
+            with col2:
+                st.caption("Most expensive sessions")
+                st.dataframe(usage_store.by_session(), use_container_width=True)
+        else:
+            st.info("No model calls recorded yet")
+        
+        # How much traffic never reaches the model
+        st.subheader("🚦 Question Routing")
+        routes = get_route_stats().snapshot()
+        questions = sum(routes.values())
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Questions", f"{questions:,}")
+        col2.metric("Served Without API Call", f"{(questions - routes['llm']) / questions:.0%}" if questions else "-")
+        col3.metric("Fast Path", f"{routes['fast_path']:,}")
+        col4.metric("Answer Cache", f"{routes['answer_cache']:,}")
+        
+        # Prompt size and build time, so growth in the schema section is visible before it costs latency
+        st.subheader("🧾 Prompt Metrics")
+        prompt_requests = get_prompt_metrics().snapshot()
+        if prompt_requests:
+            counted = [request for request in prompt_requests if request['prompt_tokens']]
+            first_tokens = [request['first_token_ms'] for request in prompt_requests if request.get('first_token_ms') is not None]
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Avg Prompt Build", f"{sum(request['build_ms'] for request in prompt_requests) / len(prompt_requests):.2f} ms")
+            if first_tokens:
+                col4.metric("Avg Time to First Token", f"{sum(first_tokens) / len(first_tokens) / 1000:.2f} s")
+            if counted:
+                prompt_tokens = sum(request['prompt_tokens'] for request in counted)
+                col2.metric("Avg Prompt Tokens", f"{prompt_tokens / len(counted):,.0f}")
+                col3.metric("Provider-Cached Tokens", f"{sum(request['cached_tokens'] for request in counted) / prompt_tokens:.0%}")
+            st.dataframe(pd.DataFrame([
+                {
+                    "Time": request['at'],
+                    "Mode": request['mode'],
+                    "Round Trips": request['round_trips'],
+                    "Answered": request['answered'],
+                    "Build (ms)": round(request['build_ms'], 2),
+                    "System Prompt (chars)": request['prompt_chars'],
+                    "Prompt Tokens": request['prompt_tokens'],
+                    "Cached Tokens": request['cached_tokens'],
+                    "First Token (s)": round(request['first_token_ms'] / 1000, 2) if request.get('first_token_ms') is not None else None
+                }
+                for request in reversed(prompt_requests[-20:])
+            ]), use_container_width=True)
+            st.caption("Round trips per answered question, by query mode")
+            st.dataframe(pd.DataFrame([
+                {"Mode": mode, **summary} for mode, summary in round_trip_summary(prompt_requests).items()
+            ]), use_container_width=True)
+        else:
+            st.info("No questions answered since the app started")
+        
+        # Query results reused across different phrasings of the same question
+        st.subheader("🗄️ Query Result Cache")
+        result_stats = get_result_cache().stats()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Hit Rate", f"{result_stats['hit_rate']:.0%}", delta=f"{result_stats['hits']:,} hits / {result_stats['misses']:,} misses", delta_color="off")
+        col2.metric("Memory Used", f"{result_stats['bytes'] / (1024 * 1024):.1f} / {RESULT_CACHE_MAX_BYTES // (1024 * 1024)} MB", delta=f"{result_stats['entries']:,} results", delta_color="off")
+        col3.metric("Evictions", f"{result_stats['evictions']:,}")
+        if st.button("Clear Result Cache", key="clear_result_cache_btn"):
+            get_result_cache().clear()
+            st.success("✅ Result cache cleared")
+            st.rerun()
+        
+        # Generated queries the watchdog refused or cut off, with the plan that explains why
+        st.subheader("🛑 Stopped Queries")
+        rejected_queries = get_rejected_query_log().snapshot()
+        if rejected_queries:
+            st.dataframe(pd.DataFrame([
+                {
+                    "Time": rejected['at'],
+                    "Reason": rejected['reason'],
+                    "Query": rejected['query'],
+                    "Estimated Rows": rejected['estimated_rows'],
+                    "Plan": " | ".join(rejected['plan'])
+                }
+                for rejected in reversed(rejected_queries)
+            ]), use_container_width=True)
+        else:
+            st.info(f"✅ No queries stopped (limits: {QUERY_TIMEOUT_SECONDS} s, {QUERY_PLAN_MAX_ROWS:,} estimated rows, SELECT only)")
+        
+        # Index suggestions learned from the queries users actually ran
+        try:
+            st.subheader("⚡ Index Advisor")
+            proposals = st.session_state.chatbot.suggest_indexes()
+            if proposals:
+                st.dataframe(pd.DataFrame([
+                    {
+                        "Dataset": proposal['table'],
+                        "Columns": ", ".join(proposal['columns']),
+                        "Queries using it": proposal['uses'],
+                        "Reason": proposal['reason']
+                    }
+                    for proposal in proposals
+                ]), use_container_width=True)
+                if st.button("Create Indexes", key="create_indexes_btn"):
+                    with st.spinner("⚙️ Building indexes on a copy of the data..."):
+                        generation = st.session_state.chatbot.apply_indexes([proposal['statement'] for proposal in proposals])
+                    st.success(f"✅ {len(proposals)} indexes created (data generation {generation})")
+                    st.warning("⚠️ **Don't forget to commit the `data/` folder to GitHub!**")
+            else:
+                st.info(f"✅ No missing indexes ({len(get_query_log().snapshot()):,} recent queries analysed)")
+        except Exception as e:
+            st.warning(f"⚠️ Error analysing indexes: {str(e)}")
     else:
         st.markdown(f"""
         <div class="info-box">
@@ -1174,8 +4366,14 @@ def admin_panel():
     
     if uploaded_file:
         try:
-            # Read all sheet names
-            xl_file = pd.ExcelFile(uploaded_file)
+            # Parse the workbook once per upload; reruns and the ingest reuse it
+            upload_key = (getattr(uploaded_file, 'file_id', None), uploaded_file.name, uploaded_file.size)
+            cached_workbook = st.session_state.get('uploaded_workbook')
+            if not cached_workbook or cached_workbook[0] != upload_key:
+                if cached_workbook:
+                    cached_workbook[1].close()
+                st.session_state.uploaded_workbook = (upload_key, st.session_state.chatbot.parse_workbook(uploaded_file))
+            xl_file = st.session_state.uploaded_workbook[1]
             sheet_names = xl_file.sheet_names
             
             st.success(f"✅ File uploaded successfully!")
@@ -1185,20 +4383,52 @@ def admin_panel():
             st.subheader("📋 Workbook Preview")
             for i, sheet_name in enumerate(sheet_names[:3]):  # Show first 3 sheets
                 with st.expander(f"Sheet: {sheet_name}"):
-                    preview_df = pd.read_excel(uploaded_file, sheet_name=sheet_name)
-                    st.write(f"📈 {len(preview_df):,} rows × {len(preview_df.columns)} columns")
-                    st.dataframe(preview_df.head(3), use_container_width=True)
+                    # Only the first rows are read for the preview
+                    preview_df = xl_file.parse(sheet_name, nrows=3)
+                    dimensions = st.session_state.chatbot.get_sheet_dimensions(xl_file, sheet_name)
+                    if dimensions:
+                        st.write(f"📈 {dimensions[0]:,} rows × {dimensions[1]} columns")
+                    else:
+                        st.write(f"📈 {len(preview_df.columns)} columns (row count shown after processing)")
+                    st.dataframe(preview_df, use_container_width=True)
             
             if len(sheet_names) > 3:
                 st.info(f"... and {len(sheet_names) - 3} more sheets")
             
+            # Streaming keeps memory flat on very large workbooks; default it on for big uploads
+            streaming = st.checkbox(
+                "Streaming ingest (bounded memory, for very large sheets)",
+                value=uploaded_file.size >= STREAMING_INGEST_MIN_BYTES,
+                disabled=not isinstance(xl_file.book, openpyxl.Workbook),
+                help="Reads rows one at a time and writes them in batches instead of loading whole sheets"
+            )
+            
+            # Weekly refreshes only need the new or corrected rows written; a first upload builds from scratch
+            incremental = st.checkbox(
+                "Update existing data (only new or changed rows)",
+                value=os.path.exists(st.session_state.chatbot.db_path),
+                disabled=not os.path.exists(st.session_state.chatbot.db_path),
+                help="Keeps the current database and upserts rows whose Year/Week/Product or Date/SKU/Vendor is new or whose values "
+                     "changed. Rows missing from the workbook are kept, so a workbook with just the latest week works too."
+            )
+            
             # Convert to database button
             st.markdown("---")
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
                 if st.button("Process Data", use_container_width=True, type="primary"):
+                    progress_bar = st.progress(0.0, text="Starting ingest...")
+                    sheet_positions = {name: index for index, name in enumerate(sheet_names)}
+                    
+                    def report_progress(sheet_name, rows_done, rows_total):
+                        # Overall progress: completed sheets plus the fraction of the current one
+                        fraction = min(rows_done / rows_total, 1.0) if rows_total else 0.0
+                        overall = (sheet_positions[sheet_name] + fraction) / len(sheet_names)
+                        progress_bar.progress(min(overall, 1.0), text=f"📥 {sheet_name}: {rows_done:,} records loaded")
+                    
                     with st.spinner("🔄 Processing your business data..."):
-                        if st.session_state.chatbot.create_database_from_excel(uploaded_file):
+                        ingest = st.session_state.chatbot.update_database_from_excel if incremental else st.session_state.chatbot.create_database_from_excel
+                        if ingest(xl_file, streaming=streaming, progress_callback=report_progress):
                             st.balloons()
                             st.success("🎉 Data processed successfully!")
                             st.success("📊 All sheets are ready for analysis")
@@ -1230,6 +4460,9 @@ def chatbot_page():
     with col3:
         if st.button("🗑️ Clear All", use_container_width=True):
             st.session_state.chat_history = []
+            # An answer still being produced is abandoned along with the questions waiting behind it
+            st.session_state.pending_answer = None
+            st.session_state.queued_questions = []
             st.session_state.input_key += 1
             st.rerun()
     
@@ -1250,11 +4483,14 @@ def chatbot_page():
         """, unsafe_allow_html=True)
         return
     
-    # Load database summary if not already loaded (silently)
-    if not st.session_state.chatbot.data_summary:
-        if not st.session_state.chatbot.load_existing_database_summary():
-            st.error("❌ Error loading data. Please contact admin.")
-            return
+    # Fetch the shared database summary (silently, only rebuilt when the database changed)
+    if not st.session_state.chatbot.load_existing_database_summary():
+        st.error("❌ Error loading data. Please contact admin.")
+        return
+    
+    # Load the in-memory replica before the first question rather than during it
+    if st.session_state.chatbot.memory_replica:
+        get_memory_replica().refresh(st.session_state.chatbot.db_path)
     
     # Display chat history
     for i, chat in enumerate(st.session_state.chat_history):
@@ -1280,16 +4516,64 @@ def chatbot_page():
         with col2:
             submitted = st.form_submit_button("Send", type="primary", use_container_width=True)
     
-    # Handle form submission (Enter key or button click)
+    # Handle form submission (Enter key or button click); the answer is produced on the shared executor
+    if 'queued_questions' not in st.session_state:
+        st.session_state.queued_questions = []
     if submitted and user_question:
-        with st.spinner("🧠 Analyzing your data..."):
-            ai_response = st.session_state.chatbot.get_ai_response(user_question)
-            st.session_state.chat_history.append({
-                "user": user_question,
-                "ai": ai_response
-            })
-            # Clear input by incrementing key
-            st.session_state.input_key += 1
+        # Clear input by incrementing key
+        st.session_state.input_key += 1
+        # Every question goes through the queue: one at a time per session, and none dropped while the assistant is busy
+        st.session_state.queued_questions.append(user_question)
+        st.rerun()
+    
+    if st.session_state.get('pending_answer') is not None or st.session_state.queued_questions:
+        render_pending_answer()
+
+def submit_next_question():
+    """Hand the first queued question to the shared executor as this session's pending answer; it stays queued if the executor is full"""
+    queued = st.session_state.queued_questions
+    pending = st.session_state.chatbot.submit_question(queued[0])
+    if pending is None:
+        st.warning(f"⏳ The assistant is busy right now. Your question will be sent as soon as there is room: {queued[0]}")
+        return False
+    queued.pop(0)
+    st.session_state.pending_answer = pending
+    return True
+
+@st.fragment(run_every=ANSWER_POLL_SECONDS)
+def render_pending_answer():
+    """Draw the pending answer as far as it has got, or send the next queued question; reruns on its own until both are done"""
+    if st.session_state.get('pending_answer') is None:
+        # Retried on every poll while the executor is full
+        if not st.session_state.get('queued_questions') or not submit_next_question():
+            return
+    pending = st.session_state.pending_answer
+    
+    st.markdown(f"""
+    <div class="user-message">
+        <strong>💬 You:</strong> {pending.question}
+    </div>
+    """, unsafe_allow_html=True)
+    text, finished = pending.snapshot()
+    if text:
+        st.markdown("**🌱 KRISPR AI:**")
+        with pending.trace.span("render") if finished else nullcontext():
+            st.markdown(text)
+    else:
+        st.info("🧠 Analyzing your data...")
+    
+    queued = st.session_state.get('queued_questions', [])
+    if queued:
+        st.info(f"⏳ Still answering this question; {len(queued)} more will follow: " + " · ".join(queued))
+    
+    if finished:
+        pending.trace.finish()
+        st.session_state.chat_history.append({
+            "user": pending.question,
+            "ai": text
+        })
+        # The full rerun draws the history; the next queued question is sent from there
+        st.session_state.pending_answer = None
         st.rerun()
 
 def home_page():
@@ -1350,7 +4634,7 @@ def main():
     try:
         api_key = st.secrets["OPENAI_API_KEY"]
         if not st.session_state.get('openai_initialized', False):
-            if st.session_state.chatbot.initialize_openai(api_key):
+            if st.session_state.chatbot.initialize_openai(api_key, st.secrets.get("OPENAI_BASE_URL")):
                 st.session_state.openai_initialized = True
     except Exception as e:
         st.error("⚠️ OpenAI API key not found in secrets.toml")
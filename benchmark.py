@@ -0,0 +1,1219 @@
+"""Offline benchmarks for the KRISPR chatbot.
+
+Run from the repository root, for example:
+
+    python benchmark.py connections
+    python benchmark.py excel --sheets 4 --rows 20000
+    python benchmark.py ingest --sheets 1 --rows 200000
+    python benchmark.py indexes --rows 1000000
+    python benchmark.py results --rows 1000000
+    python benchmark.py prompt
+    python benchmark.py schema
+    python benchmark.py entities
+    python benchmark.py update --weeks 26 --daily-rows 500
+    python benchmark.py replica --rows 1000000
+    python benchmark.py stream --iterations 10
+    python benchmark.py tools --drift-every 5
+    python benchmark.py router
+    python benchmark.py bounded --rows 1000000
+    python benchmark.py executor --sessions 40 --tpm 2000000
+    python benchmark.py resilience --error-every 9 --slow-every 25
+    python benchmark.py e2e --synthetic-rows 100000 1000000 --baseline benchmark-results/e2e-<commit>.json
+
+Every benchmark works on a temporary copy of the database, so the committed
+data/krispr_data.db is never modified. Benchmarks that need the language model
+talk to a local stub server (StubLLMServer), so no API key is used.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+DEFAULT_DB = os.path.join("data", "krispr_data.db")
+DEFAULT_ITERATIONS = {"connections": 2000, "excel": 1, "indexes": 20, "results": 20, "prompt": 500, "stream": 10, "tools": 40, "router": 3, "resilience": 100, "e2e": 3, "schema": 200, "entities": 2000, "replica": 20}
+
+
+def load_app():
+    """Import app.py outside `streamlit run`, silencing the bare-mode warnings"""
+    import streamlit  # noqa: F401
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    import app
+    # Keep benchmark questions out of the app's own trace log and usage ledger
+    app.get_trace_log().path = os.path.join(tempfile.gettempdir(), "krispr_benchmark_traces.jsonl")
+    app.get_usage_store().path = os.path.join(tempfile.gettempdir(), "krispr_benchmark_usage.db")
+    return app
+
+
+def copy_database(source, workdir, name="krispr_data.db"):
+    """Copy the database into the benchmark working directory"""
+    target = os.path.join(workdir, name)
+    shutil.copyfile(source, target)
+    return target
+
+
+def time_calls(fn, iterations, warmup=20):
+    """Run fn repeatedly and return per-call timings in microseconds"""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def compare_calls(before, after, iterations, warmup=20):
+    """Time two implementations call by call, alternating so machine drift hits both equally"""
+    for _ in range(warmup):
+        before()
+        after()
+    before_timings, after_timings = [], []
+    for _ in range(iterations):
+        for fn, timings in ((before, before_timings), (after, after_timings)):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1e6)
+    return before_timings, after_timings
+
+
+def print_comparison(title, rows, unit="us"):
+    """Print before/after timings (given in microseconds) as an aligned table"""
+    scale = {"us": 1, "ms": 1e3, "s": 1e6}[unit]
+    print(f"\n{title}")
+    print(f"{'case':<28}{f'before ({unit})':>14}{f'after ({unit})':>14}{'speed-up':>10}")
+    for label, before, after in rows:
+        before_median = statistics.median(before)
+        after_median = statistics.median(after)
+        print(f"{label:<28}{before_median / scale:>14.1f}{after_median / scale:>14.1f}{before_median / after_median:>9.1f}x")
+
+
+def bench_connections(args):
+    """Per-query overhead of connect-per-call versus the pooled read-only connections"""
+    app = load_app()
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = copy_database(args.db, workdir)
+        pool = app.ReadConnectionPool()
+        queries = [
+            ("SELECT 1", "SELECT 1"),
+            ("catalog listing", "SELECT name FROM sqlite_master WHERE type='table'"),
+            ("vendor aggregate", "SELECT Vendor_Name, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY Vendor_Name"),
+        ]
+
+        rows = []
+        for label, query in queries:
+            def connect_per_call():
+                conn = sqlite3.connect(db_path)
+                conn.execute(query).fetchall()
+                conn.close()
+
+            def pooled():
+                with pool.connection(db_path) as conn:
+                    conn.execute(query).fetchall()
+
+            rows.append((label, *compare_calls(connect_per_call, pooled, args.iterations)))
+
+        print_comparison(f"Per-query cost over {args.iterations} runs (median)", rows)
+        print(f"pool: {pool.stats()}")
+
+
+def bench_prompt(args):
+    """SQL system prompt cost per question, rebuilt every time versus built once per data generation"""
+    app = load_app()
+    with tempfile.TemporaryDirectory() as workdir:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = copy_database(args.db, workdir)
+        if not chatbot.load_existing_database_summary():
+            raise RuntimeError("could not load the database summary")
+
+        rows = [("system prompt", *compare_calls(chatbot.build_system_prompt, chatbot.get_system_prompt, args.iterations))]
+        print_comparison(f"Prompt build over {args.iterations} runs (median)", rows)
+
+        for mode in (app.SQL_MODE_LEGACY, app.SQL_MODE_TOOLS):
+            prompt = chatbot.get_system_prompt(mode)
+            print(f"{mode} system prompt: {len(prompt):,} chars (~{len(prompt) // 4:,} tokens), identical across questions: {prompt == chatbot.build_system_prompt()[mode]}")
+
+
+STUB_SQL = "SELECT Vendor_Name, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY Vendor_Name ORDER BY 2 DESC LIMIT 5;"
+# Canned queries the stub model "writes" for questions mentioning these words; anything else gets STUB_SQL
+STUB_QUERIES = [
+    (("trend", "weekly", "declining", "growth"), "SELECT Week, SUM(Total_Units_sold) FROM Overall GROUP BY Week ORDER BY Week;"),
+    (("media", "organic", "tcs"), "SELECT Week, SUM(Media_Units_Sold), SUM(Org_Units_sold) FROM Overall GROUP BY Week;"),
+    (("product", "sku", "item"), "SELECT Item_Description, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY Item_Description ORDER BY 2 DESC LIMIT 10;"),
+    (("day", "daily", "date"), "SELECT date(Local_Order_Date), SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY 1 ORDER BY 1 DESC LIMIT 14;"),
+]
+STUB_ANSWER = (
+    "Talabat Mart in Dubai Silicon Oasis sold the most units over the period, well ahead of the next "
+    "branches, which were close to each other. The gap comes mostly from steady daily volume rather than "
+    "a few large days, so the branch looks like a reliable anchor for future promotions."
+)
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible chat completions endpoint with configurable latency"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, request):
+        """Return (content, tool_calls) the way the real model would for this conversation"""
+        stub = self.server.stub
+        messages = request["messages"]
+        question = next((message["content"] for message in messages if message["role"] == "user"), "").lower()
+        sql = next((query for words, query in STUB_QUERIES if any(word in question for word in words)), STUB_SQL)
+        if request.get("tools"):
+            if request.get("tool_choice") != "none" and messages[-1]["role"] != "tool":
+                return None, [{"id": "call_stub", "type": "function", "function": {"name": "run_sql", "arguments": json.dumps({"query": sql})}}]
+            return STUB_ANSWER, None
+        # The SQL-writing prompt is the one that asks for the SQL_QUERY format
+        if "SQL_QUERY" not in messages[0]["content"]:
+            return STUB_ANSWER, None
+        if stub.drift_every and stub.count_legacy_query() % stub.drift_every == 0:
+            # Occasionally ignore the requested format, as real models do
+            return f"Here is the query I would run:\n```sql\n{sql}\n```", None
+        return f"SQL_QUERY: {sql}\nEXPLANATION: canned stub query", None
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        stub = self.server.stub
+        number = stub.count_request()
+        if stub.error_every and number % stub.error_every == 0:
+            # Injected fault: alternate between a transient 429 and a 503
+            self.send_error_body(429 if number // stub.error_every % 2 else 503, "Injected failure")
+            return
+        if not stub.enter():
+            # Over the provider's concurrency allowance: answer like a rate-limited API
+            self.send_error_body(429, "Rate limit reached")
+            return
+        try:
+            if stub.slow_every and number % stub.slow_every == 0:
+                time.sleep(stub.slow_delay)
+            self.respond(request)
+        finally:
+            stub.leave()
+
+    def send_error_body(self, status, message):
+        body = json.dumps({"error": {"message": message, "type": "rate_limit_error" if status == 429 else "server_error"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, request):
+        stub = self.server.stub
+        content, tool_calls = self.reply(request)
+        tokens = [word + " " for word in content.split(" ")] if content else []
+        prompt_tokens = sum(len(message.get("content") or "") for message in request["messages"]) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+        time.sleep(stub.first_token_delay)
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for token in tokens:
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": request["model"],
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(stub.token_delay)
+            if request.get("stream_options", {}).get("include_usage"):
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": request["model"], "choices": [], "usage": usage}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        time.sleep(stub.token_delay * max(len(tokens), 1))
+        message = {"role": "assistant", "content": "".join(tokens).strip() if content else None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        body = json.dumps({
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": request["model"],
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage,
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubLLMServer:
+    """Run StubLLMHandler on a free local port for the duration of a with-block.
+
+    Every error_every-th request fails with a 429 or 503, and every slow_every-th
+    request takes an extra slow_delay seconds, to exercise the retry and hedging policy.
+    """
+
+    def __init__(self, first_token_delay=0.4, token_delay=0.02, drift_every=0, max_concurrent=None, error_every=0, slow_every=0, slow_delay=0.0):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.drift_every = drift_every
+        self.max_concurrent = max_concurrent
+        self.error_every = error_every
+        self.slow_every = slow_every
+        self.slow_delay = slow_delay
+        self.requests = 0
+        self.legacy_queries = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        ThreadingHTTPServer.request_queue_size = 128
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), StubLLMHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def enter(self):
+        """Admit a request unless max_concurrent are already in flight"""
+        with self._lock:
+            if self.max_concurrent is not None and self.in_flight >= self.max_concurrent:
+                self.rate_limited += 1
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def count_legacy_query(self):
+        with self._lock:
+            self.legacy_queries += 1
+            return self.legacy_queries
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def bench_stream(args):
+    """Time to first visible answer token and total time, buffered final answer versus streamed"""
+    app = load_app()
+    question = "Which vendors sold the most units?"
+    with tempfile.TemporaryDirectory() as workdir, StubLLMServer() as server:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = copy_database(args.db, workdir)
+        chatbot.initialize_openai("stub-key", base_url=server.url)
+        print(f"Stub model: {server.first_token_delay * 1000:.0f} ms to first token, {server.token_delay * 1000:.0f} ms per token")
+
+        timings = {False: ([], []), True: ([], [])}
+        for _ in range(args.iterations):
+            # Alternate modes so drift hits both; the answer cache would otherwise short-circuit repeats
+            for stream in (False, True):
+                app.get_answer_cache().clear()
+                start = time.perf_counter()
+                response = chatbot.get_ai_response(question, stream=stream)
+                first = None
+                if isinstance(response, str):
+                    first = time.perf_counter()
+                else:
+                    for _ in response:
+                        first = first or time.perf_counter()
+                end = time.perf_counter()
+                timings[stream][0].append((first - start) * 1e6)
+                timings[stream][1].append((end - start) * 1e6)
+
+        print_comparison(f"Buffered (before) vs streamed (after) final answer over {args.iterations} questions (median)", [
+            ("first visible token", timings[False][0], timings[True][0]),
+            ("complete answer", timings[False][1], timings[True][1]),
+        ], unit="ms")
+        print(f"Stub requests served: {server.requests}")
+
+
+def bench_tools(args):
+    """Model round trips and prompt tokens per answered question, SQL_QUERY text parsing versus run_sql tool calls"""
+    app = load_app()
+    questions = ["Which vendors sold the most units?", "Top vendors by units", "Best selling branches", "Vendor ranking by quantity"]
+    with tempfile.TemporaryDirectory() as workdir, StubLLMServer(first_token_delay=0.05, token_delay=0.001, drift_every=args.drift_every) as server:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = copy_database(args.db, workdir)
+        chatbot.initialize_openai("stub-key", base_url=server.url)
+        print(f"Stub model ignores the SQL_QUERY format on every {args.drift_every}th legacy reply" if args.drift_every else "Stub model always follows the SQL_QUERY format")
+
+        metrics = []
+        for iteration in range(args.iterations):
+            for mode in (app.SQL_MODE_LEGACY, app.SQL_MODE_TOOLS):
+                app.get_answer_cache().clear()
+                chatbot.sql_mode = mode
+                chatbot.get_ai_response(questions[iteration % len(questions)])
+                metrics.append(chatbot.last_prompt_metrics)
+
+        print(f"\n{'mode':<10}{'questions':>11}{'answered':>10}{'round trips/answer':>20}{'prompt tokens/answer':>22}")
+        for mode, summary in app.round_trip_summary(metrics).items():
+            answered = summary['answered'] or 1
+            tokens = sum(request['prompt_tokens'] or 0 for request in metrics if request['mode'] == mode)
+            per_answer = f"{summary['round_trips_per_answer']:.2f}" if summary['round_trips_per_answer'] else "-"
+            print(f"{mode:<10}{summary['questions']:>11}{summary['answered_share']:>10.0%}{per_answer:>20}{tokens / answered:>22,.0f}")
+
+
+ROUTER_QUESTIONS = [
+    "How many units sold in week 22?",
+    "What were the invoiced units for week 26?",
+    "Media vs organic for week 25",
+    "Compare media and organic units sold for week 23",
+    "Top 5 products in week 21",
+    "Best selling product week 27",
+    "Which vendor sold the most in week 23?",
+    "Compare week 21 vs week 22",
+    "Compare week 27 vs 28",
+    "Top vendors in week 26",
+    "How many units of basil sold in week 22?",
+    "Show me weekly sales trends for the last 5 weeks",
+    "Which products are declining?",
+    "What is the average TCS for media?",
+]
+
+
+def bench_router(args):
+    """Share of a mixed question set answered by the fast-path templates, and latency by route"""
+    app = load_app()
+    with tempfile.TemporaryDirectory() as workdir, StubLLMServer(first_token_delay=0.2, token_delay=0.005) as server:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = copy_database(args.db, workdir)
+        chatbot.initialize_openai("stub-key", base_url=server.url)
+
+        timings = {}
+        for iteration in range(args.iterations):
+            for question in ROUTER_QUESTIONS:
+                # Measure routing itself, not repeats served by the answer cache
+                app.get_answer_cache().clear()
+                before = server.requests
+                start = time.perf_counter()
+                chatbot.get_ai_response(question)
+                route = "fast path" if server.requests == before else "model"
+                timings.setdefault(route, []).append((time.perf_counter() - start) * 1e6)
+
+        routes = app.get_route_stats().snapshot()
+        questions = sum(routes.values())
+        print(f"{questions} questions, {routes['fast_path']} on the fast path, {routes['llm']} sent to the model "
+              f"({(questions - routes['llm']) / questions:.0%} served without an API call, {server.requests} stub requests)")
+        print(f"\n{'route':<12}{'questions':>11}{'median (ms)':>14}")
+        for route, route_timings in timings.items():
+            print(f"{route:<12}{len(route_timings):>11}{statistics.median(route_timings) / 1000:>14.1f}")
+
+
+def bench_executor(args):
+    """A burst of simultaneous questions: one thread per session versus the shared executor, against a stub that 429s above 10 in flight"""
+    app = load_app()
+    questions = ["Which vendors sold the most units?", "Top vendors by units", "Best selling branches", "Vendor ranking by quantity"]
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = copy_database(args.db, workdir)
+        print(f"{args.sessions} sessions ask at once; executor runs {app.ANSWER_MAX_CONCURRENCY} at a time, queue {app.ANSWER_QUEUE_SIZE}, "
+              f"rate limit {args.rpm:,} requests / {args.tpm:,} tokens per minute")
+        print(f"\n{'mode':<12}{'seconds':>9}{'peak in flight':>16}{'429s':>7}{'answered':>10}{'turned away':>13}")
+
+        for mode in ("threads", "executor"):
+            with StubLLMServer(first_token_delay=0.3, token_delay=0.005, max_concurrent=10) as server:
+                app.get_answer_cache().clear()
+                chatbots = []
+                for _ in range(args.sessions):
+                    chatbot = app.KrisprChatbot()
+                    chatbot.db_path = db_path
+                    chatbot.initialize_openai("stub-key", base_url=server.url)
+                    chatbots.append(chatbot)
+
+                # The threads mode stands for the code before the executor, so it runs without a rate limiter
+                limiter = app.get_rate_limiter()
+                limiter.requests, limiter.tokens = (app.TokenBucket(1e12), app.TokenBucket(1e12)) if mode == "threads" else (app.TokenBucket(args.rpm), app.TokenBucket(args.tpm))
+                answers, turned_away = [], 0
+                start = time.perf_counter()
+                if mode == "threads":
+                    # Before: every session calls the model from its own script thread
+                    def ask(chatbot, question):
+                        answers.append(chatbot.get_ai_response(question))
+                    threads = [threading.Thread(target=ask, args=(chatbot, f"{questions[n % len(questions)]} ({n})")) for n, chatbot in enumerate(chatbots)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                else:
+                    pending = [chatbot.submit_question(f"{questions[n % len(questions)]} ({n})") for n, chatbot in enumerate(chatbots)]
+                    turned_away = pending.count(None)
+                    answers = ["".join(answer.chunks()) for answer in pending if answer is not None]
+                elapsed = time.perf_counter() - start
+
+                answered = sum(1 for answer in answers if answer.startswith("Talabat"))
+                print(f"{mode:<12}{elapsed:>9.1f}{server.peak_in_flight:>16}{server.rate_limited:>7}{answered:>10}{turned_away:>13}")
+
+
+def bench_resilience(args):
+    """Answer latency and success under injected 429/503 errors and slow replies: SDK default retries, our retry policy, and retries plus hedging"""
+    app = load_app()
+    from openai import OpenAI
+    questions = ["Which vendors sold the most units?", "Top vendors by units", "Best selling branches", "Vendor ranking by quantity"]
+    policies = [("sdk default", 0, False), ("retries", app.OPENAI_MAX_RETRIES, False), ("retries+hedge", app.OPENAI_MAX_RETRIES, True)]
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = copy_database(args.db, workdir)
+        print(f"Stub fails every {args.error_every}th request with a 429 or 503 and delays every {args.slow_every}th by {args.slow_delay:.1f} s; "
+              f"{args.iterations} questions per policy")
+        print(f"\n{'policy':<15}{'answered':>10}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'max s':>8}{'requests':>10}{'retries':>9}{'hedges':>8}")
+
+        limiter = app.get_rate_limiter()
+        limiter.requests, limiter.tokens = app.TokenBucket(1e12), app.TokenBucket(1e12)
+        for policy, max_retries, hedge in policies:
+            with StubLLMServer(first_token_delay=0.1, token_delay=0.002, error_every=args.error_every, slow_every=args.slow_every, slow_delay=args.slow_delay) as server:
+                app.get_call_stats.clear()
+                chatbot = app.KrisprChatbot()
+                chatbot.db_path = db_path
+                chatbot.initialize_openai("stub-key", base_url=server.url)
+                if policy == "sdk default":
+                    # Before: the client as it was created originally, retrying inside the SDK with no question deadline
+                    chatbot.client = OpenAI(api_key="stub-key", base_url=server.url)
+                chatbot.max_retries = max_retries
+                chatbot.hedge_requests = hedge
+
+                latencies, answered = [], 0
+                for iteration in range(args.iterations):
+                    app.get_answer_cache().clear()
+                    start = time.perf_counter()
+                    answer = chatbot.get_ai_response(questions[iteration % len(questions)])
+                    latencies.append(time.perf_counter() - start)
+                    answered += answer.startswith("Talabat")
+
+                latencies.sort()
+                pick = lambda percent: latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+                calls = app.get_call_stats().stats()
+                print(f"{policy:<15}{answered / args.iterations:>10.0%}{pick(50):>8.2f}{pick(95):>8.2f}{pick(99):>8.2f}{latencies[-1]:>8.2f}"
+                      f"{server.requests:>10}{calls['retries']:>9}{calls['hedges']:>8}")
+
+
+E2E_QUESTIONS = ROUTER_QUESTIONS + [
+    "Which vendors sold the most units?",
+    "Which products sold the most overall?",
+    "How did daily sales look over the last two weeks?",
+    "Show the weekly trend of total units",
+    "Which branches are our strongest performers?",
+    "Is media or organic driving growth?",
+]
+
+
+def percentiles(values):
+    """p50/p95/p99 and max of a list of seconds, in milliseconds"""
+    ordered = sorted(values)
+    pick = lambda percent: ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))] * 1000
+    return {"p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99), "max_ms": ordered[-1] * 1000}
+
+
+def git_commit():
+    """Short hash of the checked-out commit, to label result files"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def replay_corpus(app, db_path, server_url, rounds, concurrency):
+    """Ask every corpus question rounds times from concurrency sessions; returns per-question seconds and wall time"""
+    chatbots = []
+    for _ in range(concurrency):
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = db_path
+        chatbot.initialize_openai("stub-key", base_url=server_url)
+        chatbots.append(chatbot)
+    work = [question for _ in range(rounds) for question in E2E_QUESTIONS]
+    latencies, failures = [], 0
+    lock = threading.Lock()
+
+    def session(chatbot, questions):
+        nonlocal failures
+        for question in questions:
+            # Every round goes through the whole pipeline; repeats would otherwise come from the answer cache
+            app.get_answer_cache().clear()
+            start = time.perf_counter()
+            answer = chatbot.get_ai_response(question)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                failures += "trouble processing" in answer or "took too long" in answer
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(chatbot, work[n::concurrency])) for n, chatbot in enumerate(chatbots)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start, failures
+
+
+def bench_e2e(args):
+    """End-to-end get_ai_response latency, throughput and peak memory over a question corpus, against the stub model; writes a JSON report"""
+    app = load_app()
+    limiter = app.get_rate_limiter()
+    limiter.requests, limiter.tokens = app.TokenBucket(1e12), app.TokenBucket(1e12)
+    report = {
+        "commit": git_commit(),
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "settings": {"rounds": args.iterations, "concurrency": args.concurrency, "questions": len(E2E_QUESTIONS),
+                     "first_token_delay": args.first_token_delay, "token_delay": args.token_delay},
+        "datasets": {},
+    }
+    print(f"{len(E2E_QUESTIONS)} questions x {args.iterations} rounds from {args.concurrency} sessions; "
+          f"stub model {args.first_token_delay * 1000:.0f} ms to first token, {args.token_delay * 1000:.0f} ms per token")
+    print(f"\n{'dataset':<20}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/s':>7}{'calls/q':>9}{'no API':>8}{'failed':>8}{'peak MB':>9}")
+
+    with tempfile.TemporaryDirectory() as workdir, StubLLMServer(first_token_delay=args.first_token_delay, token_delay=args.token_delay) as server:
+        datasets = [("krispr_data.db", lambda: copy_database(args.db, workdir))]
+        for rows in args.synthetic_rows:
+            datasets.append((f"synthetic {rows:,}", lambda rows=rows: build_synthetic_database(os.path.join(workdir, f"synthetic_{rows}.db"), rows, rows // 5)))
+
+        for name, build in datasets:
+            db_path = build()
+            for cache in (app.get_answer_cache(), app.get_result_cache()):
+                cache.clear()
+            app.get_route_stats.clear()
+            requests_before = server.requests
+
+            latencies, elapsed, failures = replay_corpus(app, db_path, server.url, args.iterations, args.concurrency)
+            routes = app.get_route_stats().snapshot()
+            calls = server.requests - requests_before
+
+            # Peak Python memory from a separate traced round, so tracing does not slow the timed rounds
+            app.get_answer_cache().clear()
+            app.get_result_cache().clear()
+            tracemalloc.start()
+            replay_corpus(app, db_path, server.url, 1, args.concurrency)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            result = {
+                **percentiles(latencies),
+                "questions": len(latencies),
+                "throughput_qps": len(latencies) / elapsed,
+                "model_calls_per_question": calls / len(latencies),
+                "served_without_api_call": 1 - routes["llm"] / len(latencies),
+                "failed": failures,
+                "peak_traced_mb": peak_bytes / 1e6,
+                "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+            report["datasets"][name] = result
+            print(f"{name:<20}{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}{result['p99_ms']:>9.0f}{result['throughput_qps']:>7.1f}"
+                  f"{result['model_calls_per_question']:>9.2f}{result['served_without_api_call']:>8.0%}{failures:>8}{result['peak_traced_mb']:>9.1f}")
+
+    output = args.output or os.path.join("benchmark-results", f"e2e-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nChange against {args.baseline} (commit {baseline['commit']})")
+        for name, result in report["datasets"].items():
+            before = baseline["datasets"].get(name)
+            if before:
+                changes = "  ".join(f"{key} {(result[key] - before[key]) / before[key]:+.0%}" for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_qps") if before[key])
+                print(f"{name:<20}{changes}")
+
+
+# Questions labelled with the tables that can answer them; any one alternative is enough.
+# An empty list means no table is clearly needed, so sending the full schema is also correct.
+SCHEMA_QUESTIONS = [
+    ("Which vendors sold the most units?", [{"Raw_Data_Date_Wise"}]),
+    ("Top 5 branches by quantity sold", [{"Raw_Data_Date_Wise"}]),
+    ("How did daily sales look over the last two weeks?", [{"Raw_Data_Date_Wise"}]),
+    ("Which item sold the most on 3 June?", [{"Raw_Data_Date_Wise"}]),
+    ("How many units did Talabat Mart Dubai Marina sell?", [{"Raw_Data_Date_Wise"}]),
+    ("Which store had the lowest orders in week 22?", [{"Raw_Data_Date_Wise"}]),
+    ("Show order quantity by vendor for week 23", [{"Raw_Data_Date_Wise"}]),
+    ("Compare media and organic units sold for week 25", [{"Overall"}]),
+    ("What were the invoiced units for week 27?", [{"Overall"}]),
+    ("Which product had the highest invoiced quantity in week 28?", [{"Overall"}]),
+    ("What is the overall sales value per product in week 26?", [{"Overall"}]),
+    ("How many total units were sold per week for Krispr Baby Plum Tomatoes?", [{"Overall"}, {"Raw_Data_Date_Wise"}]),
+    ("What was the CPA for each product in week 25?", [{"Media"}]),
+    ("Which product has the worst net income per SKU from media?", [{"Media"}]),
+    ("Total daily NI from media in week 23", [{"Media"}, {"Overall_Avg_Change"}]),
+    ("What is the daily MSV for cucumbers?", [{"Media"}]),
+    ("What is the organic share of sales for tomatoes in week 24?", [{"Organic"}, {"Overall"}]),
+    ("Net income per SKU for organic sales in week 26", [{"Organic"}]),
+    ("What is the daily organic sales value of baby cucumbers?", [{"Organic"}, {"Overall"}]),
+    ("What is the sell-in price and COGS of each organic product?", [{"Organic"}]),
+    ("How did the average TCS for media change week over week?", [{"Overall_Avg_Change"}]),
+    ("What was the change in average daily OSV in week 24?", [{"Overall_Avg_Change"}]),
+    ("Show the media share change by week", [{"Overall_Avg_Change"}]),
+    ("Average overall daily sales value trend", [{"Overall_Avg_Change"}]),
+    ("Compare vendor sales in week 22 with invoiced units in week 26", [{"Raw_Data_Date_Wise", "Overall"}]),
+    ("Compare media CPA with organic net income for week 25", [{"Media", "Organic"}]),
+    ("Which products have media units sold but low organic share?", [{"Overall"}, {"Media", "Organic"}]),
+    ("Which products are declining?", []),
+    ("Give me a summary of performance", []),
+    ("What should we focus on next week?", []),
+]
+
+
+def bench_schema(args):
+    """Prompt tokens and table-selection accuracy of question-aware schema pruning on a labelled question set"""
+    app = load_app()
+    with tempfile.TemporaryDirectory() as workdir:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = copy_database(args.db, workdir)
+        if not chatbot.load_existing_database_summary():
+            raise RuntimeError("could not load the database summary")
+        full_tokens = len(chatbot.get_system_prompt(app.SQL_MODE_TOOLS)) // app.CHARS_PER_TOKEN
+
+        print(f"{'question':<70}{'tables':<44}{'tokens':>8}  ok")
+        correct, pruned_tokens, fallbacks, misses = 0, [], 0, []
+        for question, gold in SCHEMA_QUESTIONS:
+            tables = chatbot.relevant_tables(question)
+            tokens = len(chatbot.get_system_prompt(app.SQL_MODE_TOOLS, tables)) // app.CHARS_PER_TOKEN
+            pruned_tokens.append(tokens)
+            fallbacks += tables is None
+            # The full schema always contains the right tables
+            ok = tables is None or not gold or any(needed <= tables for needed in gold)
+            correct += ok
+            if not ok:
+                misses.append(question)
+            shown = "all (fallback)" if tables is None else ", ".join(sorted(tables))
+            print(f"{question[:68]:<70}{shown[:42]:<44}{tokens:>8,}  {'yes' if ok else 'NO'}")
+
+        selection = time_calls(lambda: [chatbot.relevant_tables(question) for question, _ in SCHEMA_QUESTIONS], args.iterations, warmup=5)
+        average = statistics.mean(pruned_tokens)
+        print(f"\nTools-mode system prompt: {full_tokens:,} tokens with every table, {average:,.0f} on average after pruning "
+              f"({1 - average / full_tokens:.0%} fewer)")
+        print(f"Selection accuracy: {correct}/{len(SCHEMA_QUESTIONS)} questions keep a table set that can answer them; "
+              f"{fallbacks} fell back to the full schema")
+        print(f"Selection time: {statistics.median(selection) / len(SCHEMA_QUESTIONS):.0f} us per question (median)")
+
+
+# Misspelled, partial and informal names with the values they must resolve to; an empty set means nothing should match
+ENTITY_QUESTIONS = [
+    ("How many cherry tomatos did we sell last week?", {"Krispr Premium Baby Cherry Tomatoes, 300g"}),
+    ("sales of genovese basl in week 22", {"Krispr Premium Genovese Basil - UAE, 20g", "Krispr Premium Genovese Basil UAE 20g"}),
+    ("Basil units sold by week", {"Krispr Premium Genovese Basil - UAE, 20g"}),
+    ("How is the rosmary doing?", {"Krispr Premium Rosemary, 40g"}),
+    ("thyme revenue this year", {"Krispr Premium Thyme, 25g"}),
+    ("baby kale sales trend", {"Krispr Premium Baby Kale - UAE, 75g", "Krispr Premium Baby Kale UAE 75g"}),
+    ("Compare butterhead and crispy lettuce", {"Krispr Premium Baby Butterhead Lettuce - UAE, 75g", "Krispr Premium Baby Crispy Lettuce - UAE, 75g"}),
+    ("frisee lettuce media spend", {"Krispr Premium Baby Frisee (Easy Leaf) Lettuce - UAE, 75g"}),
+    ("Media clicks for the sweet peper mix", {"Krispr Sweet Pepper Mix, 150g"}),
+    ("plum tomatoes units in May", {"Krispr Baby Plum Tomatoes - UAE, 300g", "Krispr Finest Mixed Baby Plum Tomatoes - UAE, 300g"}),
+    ("cucumber sales by vendor", {"Krispr Finest Baby Cucumbers, 250g", "Krispr Baby Cucumbers Pack, 250g"}),
+    ("salad mix organic units", {"Krispr Premium Baby Salad Mix - UAE, 75g"}),
+    ("units sold at dubai marina", {"talabat mart , Dubai Marina"}),
+    ("How did Jumeira Village Circle do?", {"talabat mart , Jumeirah Village Circle - JVC"}),
+    ("JVC daily orders", {"talabat mart , Jumeirah Village Circle - JVC"}),
+    ("sales in silicon oasis", {"talabat mart , Dubai Silicon Oasis"}),
+    ("Musafah branch units", {"talabat mart, Musaffah"}),
+    ("mirdiff vs international city", {"talabat mart, Mirdif", "talabat mart, International City"}),
+    ("palm jumeira orders", {"Talabat Mart , Palm Jumeirah"}),
+    ("business bay basil sales", {"talabat mart , Business Bay", "Krispr Premium Genovese Basil - UAE, 20g"}),
+    ("al quoz industrial", {"talabat mart, Al Quoz Industrial Area 1"}),
+    ("port saeed cherry tomatoes", {"talabat mart , Port Saeed", "Krispr Premium Baby Cherry Tomatoes, 300g"}),
+    ("Which vendors sold the most units?", set()),
+    ("What is the total revenue by week?", set()),
+    ("Show sales by area for last month", set()),
+    ("What was the ROAS for week 23?", set()),
+]
+
+
+def bench_entities(args):
+    """Resolution accuracy and lookup latency of the product and vendor name index on misspelled and partial names"""
+    app = load_app()
+    with tempfile.TemporaryDirectory() as workdir:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = copy_database(args.db, workdir)
+        build = time_calls(chatbot.build_entity_index, 5, warmup=1)
+        index = chatbot.build_entity_index()
+        print(f"Index: {len(index.entities)} distinct names, {len(index.word_entities)} words, built in {statistics.median(build) / 1000:.1f} ms\n")
+
+        print(f"{'question':<52}{'resolved':<70}  ok")
+        correct = 0
+        for question, expected in ENTITY_QUESTIONS:
+            resolved = [match["value"] for match in index.resolve(question)]
+            # Names differ only in case between tables, so compare them case-insensitively
+            found = {value.lower() for value in resolved}
+            ok = {value.lower() for value in expected} <= found if expected else not resolved
+            correct += ok
+            shown = "; ".join(resolved) or "-"
+            print(f"{question[:50]:<52}{shown[:68]:<70}  {'yes' if ok else 'NO'}")
+
+        lookups = [sample / len(ENTITY_QUESTIONS) for sample in time_calls(
+            lambda: [index.resolve(question) for question, _ in ENTITY_QUESTIONS], args.iterations // len(ENTITY_QUESTIONS) or 1, warmup=5)]
+        single = time_calls(lambda: index.resolve(ENTITY_QUESTIONS[0][0]), args.iterations)
+        print(f"\nAccuracy: {correct}/{len(ENTITY_QUESTIONS)} questions resolve to the expected names")
+        print(f"Lookup: {statistics.median(lookups):.0f} us per question on average; "
+              f"single question p50 {statistics.median(single):.0f} us, p99 {statistics.quantiles(single, n=100)[98]:.0f} us")
+
+
+def build_synthetic_workbook(sheets, rows):
+    """Build an in-memory workbook shaped like the daily sales export"""
+    import openpyxl
+    random.seed(7)
+    vendors = [f"Talabat Mart, Branch {i}" for i in range(40)]
+    products = [f"Krispr Premium Product {i}, 75g" for i in range(25)]
+    start = datetime(2025, 5, 19)
+
+    book = openpyxl.Workbook(write_only=True)
+    for index in range(sheets):
+        sheet = book.create_sheet(f"Sales Sheet {index + 1}")
+        sheet.append(["Item SKU", "Item Description", "Vendor Name", "Local Order Date", "Sold Quantity", "Week", "Year"])
+        for row in range(rows):
+            order_date = start + timedelta(days=row % 70)
+            sheet.append([
+                900000 + row % 25, random.choice(products), random.choice(vendors),
+                order_date, random.randint(1, 12), order_date.isocalendar()[1], order_date.year
+            ])
+    buffer = BytesIO()
+    book.save(buffer)
+    return buffer.getvalue()
+
+
+def build_synthetic_database(path, raw_rows, weekly_rows):
+    """Create a scaled-up database with the same daily and weekly table shapes as the real data"""
+    random.seed(11)
+    vendors = [f"Talabat Mart, Branch {i}" for i in range(60)]
+    products = [(900000 + i, f"Krispr Premium Product {i}, 75g") for i in range(40)]
+    start = datetime(2024, 1, 1)
+
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE "Raw_Data_Date_Wise" ("Item_SKU" INTEGER, "Item_Description" TEXT, "Vendor_Name" TEXT, "Local_Order_Date" TIMESTAMP, "Sold_Quantity" INTEGER)')
+    conn.execute('CREATE TABLE "Overall" ("Year" INTEGER, "Week" INTEGER, "Product_Name" TEXT, "Total_Units_sold" INTEGER, "Invoiced_Supplied" REAL, "Media_Units_Sold" INTEGER, "Org_Units_sold" INTEGER)')
+
+    def raw_rows_iter():
+        for row in range(raw_rows):
+            sku, description = products[row % len(products)]
+            order_date = start + timedelta(days=(row * 7) % 600)
+            yield sku, description, random.choice(vendors), order_date.isoformat(sep=" "), random.randint(1, 12)
+
+    def weekly_rows_iter():
+        for row in range(weekly_rows):
+            media, organic = random.randint(0, 200), random.randint(0, 400)
+            yield 2020 + row % 6, 1 + (row // 6) % 52, products[row % len(products)][1], media + organic, float(media + organic), media, organic
+
+    conn.executemany('INSERT INTO "Raw_Data_Date_Wise" VALUES (?, ?, ?, ?, ?)', raw_rows_iter())
+    conn.executemany('INSERT INTO "Overall" VALUES (?, ?, ?, ?, ?, ?, ?)', weekly_rows_iter())
+    conn.commit()
+    conn.close()
+    return path
+
+
+def build_weekly_workbook(weeks, daily_rows, corrections=0, only_weeks=None):
+    """Workbook of daily order lines and weekly product totals; every day's rows are the same whatever the week count"""
+    import openpyxl
+    vendors = [f"Talabat Mart, Branch {i}" for i in range(40)]
+    products = [(900000 + i, f"Krispr Premium Product {i}, 75g") for i in range(25)]
+    start = datetime(2025, 1, 6)
+
+    book = openpyxl.Workbook(write_only=True)
+    raw = book.create_sheet("Raw Data Date Wise")
+    raw.append(["Item SKU", "Item Description", "Vendor Name", "Local Order Date", "Sold Quantity"])
+    weekly_units = {}
+    for day in range(weeks * 7):
+        if only_weeks is not None and day // 7 not in only_weeks:
+            continue
+        rng = random.Random(day)
+        order_date = start + timedelta(days=day)
+        for line in range(daily_rows):
+            sku, description = products[line % len(products)]
+            quantity = rng.randint(1, 12)
+            # Late corrections to the first week's order lines
+            if day == 0 and line < corrections:
+                quantity += 100
+            raw.append([sku, description, vendors[(line // len(products)) % len(vendors)], order_date, quantity])
+            week_key = (*order_date.isocalendar()[:2], description)
+            weekly_units[week_key] = weekly_units.get(week_key, 0) + quantity
+
+    overall = book.create_sheet("Overall")
+    overall.append(["Year", "Week", "Product Name", "Total Units sold", "Invoiced Supplied"])
+    for (year, week, description), units in sorted(weekly_units.items()):
+        overall.append([year, week, description, units, units * 1.5])
+    buffer = BytesIO()
+    book.save(buffer)
+    return buffer.getvalue()
+
+
+def changed_pages(before_path, after_path):
+    """Pages of after_path that differ from before_path, and its total page count"""
+    with open(before_path, "rb") as before, open(after_path, "rb") as after:
+        page_size = sqlite3.connect(after_path).execute("PRAGMA page_size").fetchone()[0]
+        changed = total = 0
+        while True:
+            page = after.read(page_size)
+            if not page:
+                return changed, total
+            total += 1
+            changed += page != before.read(page_size)
+
+
+def bench_update(args):
+    """Full rebuild versus incremental upsert when the workbook grows by one week, checking both give the same data"""
+    app = load_app()
+    base = build_weekly_workbook(args.weeks, args.daily_rows)
+    grown = build_weekly_workbook(args.weeks + 1, args.daily_rows, corrections=args.corrections)
+    # The same update as a workbook holding only the weeks that changed: the corrected first week and the new one
+    delta = build_weekly_workbook(args.weeks + 1, args.daily_rows, corrections=args.corrections, only_weeks={0, args.weeks})
+    print(f"Workbook: {args.weeks} weeks x {args.daily_rows} order lines a day, then one more week "
+          f"and {args.corrections} corrected lines ({len(grown) / 1e6:.1f} MB; {len(delta) / 1e6:.1f} MB with only the changed weeks)")
+    modes = (
+        ("full rebuild", "full.db", grown),
+        ("incremental", "incremental.db", grown),
+        ("changed weeks", "delta.db", delta)
+    )
+
+    with tempfile.TemporaryDirectory() as workdir:
+        def chatbot_for(name):
+            chatbot = app.KrisprChatbot()
+            chatbot.db_path = os.path.join(workdir, name)
+            return chatbot
+
+        if not chatbot_for("base.db").create_database_from_excel(BytesIO(base)):
+            raise RuntimeError("base ingest failed")
+        # Reading the whole workbook is the same work in both modes that upload all of it
+        start = time.perf_counter()
+        app.KrisprChatbot().load_workbook_sheets(sqlite3.connect(":memory:"), BytesIO(grown), streaming=True, index_tables=False)
+        print(f"Reading the full workbook alone: {time.perf_counter() - start:.2f} s")
+
+        print(f"\n{'mode':<16}{'seconds':>10}{'pages changed':>20}  same data")
+        for mode, name, workbook in modes:
+            if name != "full.db":
+                shutil.copyfile(os.path.join(workdir, "base.db"), os.path.join(workdir, name))
+            chatbot = chatbot_for(name)
+            ingest = chatbot.create_database_from_excel if name == "full.db" else chatbot.update_database_from_excel
+            start = time.perf_counter()
+            if not ingest(BytesIO(workbook), streaming=True):
+                raise RuntimeError(f"{mode} failed")
+            elapsed = time.perf_counter() - start
+
+            changed, total = changed_pages(os.path.join(workdir, "base.db"), os.path.join(workdir, name))
+            mismatched = [] if name == "full.db" else tables_differing(app, os.path.join(workdir, "full.db"), os.path.join(workdir, name))
+            same = "yes" if not mismatched else "NO: " + ", ".join(mismatched)
+            print(f"{mode:<16}{elapsed:>10.2f}{f'{changed:,} / {total:,}':>20}  {same}")
+
+
+def tables_differing(app, expected_path, actual_path):
+    """Data tables, rollups included, whose rows differ between two databases"""
+    conn = sqlite3.connect(expected_path)
+    conn.execute("ATTACH DATABASE ? AS actual", (actual_path,))
+    mismatched = []
+    for table_name in app.list_data_tables(conn):
+        columns = ", ".join(f'"{row[1]}"' for row in conn.execute(f'PRAGMA main.table_info("{table_name}")'))
+        for left, right in (("main", "actual"), ("actual", "main")):
+            if conn.execute(f'SELECT 1 FROM (SELECT {columns} FROM {left}."{table_name}" EXCEPT SELECT {columns} FROM {right}."{table_name}") LIMIT 1').fetchone():
+                mismatched.append(table_name)
+                break
+    conn.close()
+    return mismatched
+
+
+def bench_indexes(args):
+    """Query latency on a scaled-up database before and after ingest-time and advisor-proposed indexes"""
+    app = load_app()
+    queries = [
+        ("week filter", "SELECT Product_Name, SUM(Total_Units_sold) FROM Overall WHERE Week = 25 GROUP BY Product_Name;"),
+        ("vendor filter", "SELECT SUM(Sold_Quantity) FROM Raw_Data_Date_Wise WHERE Vendor_Name = 'Talabat Mart, Branch 3';"),
+        ("date range", "SELECT SUM(Sold_Quantity) FROM Raw_Data_Date_Wise WHERE Local_Order_Date BETWEEN '2024-06-03 00:00:00' AND '2024-06-09 23:59:59';"),
+        ("SKU + date range", "SELECT Local_Order_Date, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise WHERE Item_SKU = 900003 AND Local_Order_Date >= '2025-03-01' GROUP BY Local_Order_Date;"),
+    ]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = build_synthetic_database(os.path.join(workdir, "krispr_data.db"), args.rows, args.rows // 5)
+        print(f"Synthetic database: {args.rows:,} daily rows, {args.rows // 5:,} weekly rows")
+
+        def run_all():
+            timings = {}
+            for label, query in queries:
+                timings[label] = time_calls(lambda: chatbot.execute_sql_query(query), args.iterations, warmup=2)
+            return timings
+
+        before = run_all()
+
+        # Feed the advisor the same traffic the timings just produced
+        proposals = chatbot.suggest_indexes([query for _, query in queries] * app.INDEX_ADVISOR_MIN_USES)
+        for proposal in proposals:
+            print(f"  {proposal['reason']:<14} {proposal['statement']}")
+        chatbot.apply_indexes([proposal['statement'] for proposal in proposals])
+
+        after = run_all()
+        print_comparison(f"Query latency over {args.iterations} runs (median)", [
+            (label, before[label], after[label]) for label, _ in queries
+        ], unit="ms")
+
+
+def row_list_bytes(rows):
+    """Approximate memory of a fetchall() result, counting each distinct value object once"""
+    seen = set()
+    total = sys.getsizeof(rows)
+    for row in rows:
+        total += sys.getsizeof(row)
+        for value in row:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+
+def bench_results(args):
+    """Repeated SQL served from the result cache versus re-executed, plus stored size per layout"""
+    app = load_app()
+    queries = [
+        ("vendor totals", "SELECT Vendor_Name, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY Vendor_Name ORDER BY 2 DESC;"),
+        ("daily SKU totals", "SELECT Item_SKU, Local_Order_Date, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY Item_SKU, Local_Order_Date;"),
+        ("weekly product totals", "SELECT Week, Product_Name, SUM(Total_Units_sold) FROM Overall GROUP BY Week, Product_Name;"),
+    ]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        chatbot = app.KrisprChatbot()
+        chatbot.db_path = build_synthetic_database(os.path.join(workdir, "krispr_data.db"), args.rows, args.rows // 5)
+        print(f"Synthetic database: {args.rows:,} daily rows, {args.rows // 5:,} weekly rows")
+        cache = app.get_result_cache()
+
+        def uncached(query):
+            cache.clear()
+            chatbot.execute_sql_query(query)
+
+        rows = []
+        for label, query in queries:
+            # A differently formatted copy of the same statement, as a rephrased question would produce
+            rephrased = "```sql\n" + query.replace(" FROM ", "\n  FROM ").rstrip(";") + "\n```"
+            rows.append((label, *compare_calls(lambda: uncached(query), lambda: chatbot.execute_sql_query(rephrased), args.iterations, warmup=2)))
+        print_comparison(f"Query latency over {args.iterations} runs (median)", rows, unit="ms")
+
+        print(f"\n{'query':<24}{'rows':>10}{'row tuples (KB)':>18}{'columnar (KB)':>16}")
+        for label, query in queries:
+            result = chatbot.execute_sql_query(query)
+            columnar = app.QueryResult(result["columns"], result["data"])
+            print(f"{label:<24}{result['row_count']:>10,}{row_list_bytes(result['data']) / 1024:>18,.0f}{columnar.nbytes() / 1024:>16,.0f}")
+        stats = cache.stats()
+        print(f"\nCache: {stats['entries']} entries, {stats['bytes'] / 1e6:.1f} MB, hit rate {stats['hit_rate']:.0%}")
+
+
+def bench_bounded(args):
+    """Time, peak memory and prompt size for a wide SELECT: unbounded fetchall versus capped rows plus a summary"""
+    app = load_app()
+    query = "SELECT * FROM Raw_Data_Date_Wise;"
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = build_synthetic_database(os.path.join(workdir, "krispr_data.db"), args.rows, args.rows // 5)
+        print(f"Synthetic database: {args.rows:,} daily rows; query: {query}")
+
+        def unbounded():
+            conn = sqlite3.connect(db_path)
+            rows = conn.execute(query).fetchall()
+            conn.close()
+            prompt_sizes.put(len(f"Results: {rows}"))
+
+        def bounded():
+            chatbot = app.KrisprChatbot()
+            chatbot.db_path = db_path
+            summary = chatbot.summarize_query_result(chatbot.execute_sql_query(query))
+            prompt_sizes.put(len(summary["text"]))
+
+        prompt_sizes = multiprocessing.get_context("fork").Queue()
+        print(f"\n{'mode':<12}{'seconds':>10}{'peak RSS growth (MB)':>24}{'prompt tokens':>16}")
+        for mode, fn in (("unbounded", unbounded), ("bounded", bounded)):
+            elapsed, peak_mb = measure_in_child(fn)
+            print(f"{mode:<12}{elapsed:>10.2f}{peak_mb:>24.1f}{prompt_sizes.get() // app.CHARS_PER_TOKEN:>16,}")
+
+
+def bench_excel(args):
+    """Workbook parse time for the admin preview plus ingest, re-reading versus parsing once"""
+    import pandas as pd
+    app = load_app()
+    chatbot = app.KrisprChatbot()
+    data = build_synthetic_workbook(args.sheets, args.rows)
+    print(f"Synthetic workbook: {args.sheets} sheets x {args.rows:,} rows ({len(data) / 1e6:.1f} MB)")
+
+    def re_reading():
+        upload = BytesIO(data)
+        sheet_names = pd.ExcelFile(upload).sheet_names
+        for sheet_name in sheet_names[:3]:
+            pd.read_excel(upload, sheet_name=sheet_name).head(3)
+        xl_file = pd.ExcelFile(upload)
+        for sheet_name in xl_file.sheet_names:
+            pd.read_excel(upload, sheet_name=sheet_name)
+
+    def parse_once():
+        xl_file = chatbot.parse_workbook(BytesIO(data))
+        for sheet_name in xl_file.sheet_names[:3]:
+            xl_file.parse(sheet_name, nrows=3)
+        for sheet_name in xl_file.sheet_names:
+            xl_file.parse(sheet_name)
+
+    rows = [("preview + ingest", *compare_calls(re_reading, parse_once, args.iterations, warmup=0))]
+    print_comparison(f"Parse time over {args.iterations} runs (median)", rows, unit="s")
+
+
+def read_proc_status_kb(field):
+    """Read a memory field such as VmRSS from /proc/self/status, in kB (Linux only)"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def _run_measured(fn, results):
+    try:
+        # Reset the high-water mark so only this run's growth is counted
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        baseline_kb = read_proc_status_kb("VmRSS")
+    except OSError:
+        baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    try:
+        peak_kb = read_proc_status_kb("VmHWM")
+    except OSError:
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, (peak_kb - baseline_kb) / 1024))
+
+
+def measure_in_child(fn):
+    """Run fn in a forked process and return (seconds, peak RSS growth in MB)"""
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=_run_measured, args=(fn, results))
+    process.start()
+    outcome = results.get()
+    process.join()
+    return outcome
+
+
+def bench_ingest(args):
+    """Ingest time and peak memory for the pandas loader versus the streaming loader"""
+    app = load_app()
+    data = build_synthetic_workbook(args.sheets, args.rows)
+    print(f"Synthetic workbook: {args.sheets} sheets x {args.rows:,} rows ({len(data) / 1e6:.1f} MB)")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"\n{'mode':<12}{'seconds':>10}{'peak RSS growth (MB)':>24}")
+        for mode, streaming in (("pandas", False), ("streaming", True)):
+            def ingest():
+                chatbot = app.KrisprChatbot()
+                chatbot.db_path = os.path.join(workdir, f"{mode}.db")
+                if not chatbot.create_database_from_excel(BytesIO(data), streaming=streaming):
+                    raise RuntimeError(f"{mode} ingest failed")
+
+            elapsed, peak_mb = measure_in_child(ingest)
+            print(f"{mode:<12}{elapsed:>10.1f}{peak_mb:>24.1f}")
+
+
+def bench_replica(args):
+    """Generated-query latency from the database file versus the shared in-memory replica"""
+    app = load_app()
+    queries = [
+        ("vendor totals", "SELECT Vendor_Name, SUM(Sold_Quantity) FROM Raw_Data_Date_Wise GROUP BY Vendor_Name ORDER BY 2 DESC;"),
+        ("date range", "SELECT SUM(Sold_Quantity) FROM Raw_Data_Date_Wise WHERE Local_Order_Date BETWEEN '2024-06-03 00:00:00' AND '2024-06-09 23:59:59';"),
+        ("weekly product totals", "SELECT Week, Product_Name, SUM(Total_Units_sold) FROM Overall GROUP BY Week, Product_Name;"),
+    ]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        databases = [
+            ("committed data", copy_database(args.db, workdir)),
+            (f"{args.rows:,} synthetic rows", build_synthetic_database(os.path.join(workdir, "synthetic.db"), args.rows, args.rows // 5)),
+        ]
+        cache = app.get_result_cache()
+        replica = app.get_memory_replica()
+
+        for title, db_path in databases:
+            on_disk = app.KrisprChatbot()
+            on_disk.db_path = db_path
+            on_disk.memory_replica = False
+            in_memory = app.KrisprChatbot()
+            in_memory.db_path = db_path
+            in_memory.memory_replica = True
+
+            replica.refresh(db_path)
+            print(f"\n{title}: {os.path.getsize(db_path) / 1e6:.1f} MB loaded into memory in {replica.stats()['last_load_ms']:,.0f} ms")
+
+            def uncached(chatbot, query):
+                cache.clear()
+                chatbot.execute_sql_query(query)
+
+            rows = []
+            for label, query in queries:
+                rows.append((label, *compare_calls(lambda: uncached(on_disk, query), lambda: uncached(in_memory, query), args.iterations, warmup=2)))
+            print_comparison(f"Query latency over {args.iterations} runs, file before / replica after (median)", rows, unit="ms")
+        print(f"\nreplica: {replica.stats()}")
+
+
+BENCHMARKS = {
+    "connections": bench_connections,
+    "excel": bench_excel,
+    "ingest": bench_ingest,
+    "indexes": bench_indexes,
+    "results": bench_results,
+    "prompt": bench_prompt,
+    "stream": bench_stream,
+    "tools": bench_tools,
+    "router": bench_router,
+    "bounded": bench_bounded,
+    "executor": bench_executor,
+    "resilience": bench_resilience,
+    "e2e": bench_e2e,
+    "schema": bench_schema,
+    "entities": bench_entities,
+    "update": bench_update,
+    "replica": bench_replica,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--db", default=DEFAULT_DB, help="database to benchmark against")
+    parser.add_argument("--iterations", type=int, default=None, help="timed runs per case")
+    parser.add_argument("--sheets", type=int, default=4, help="sheets in synthetic workbooks")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per synthetic sheet")
+    parser.add_argument("--sessions", type=int, default=40, help="simultaneous chat sessions")
+    parser.add_argument("--error-every", type=int, default=9, help="stub model fails every Nth request with a 429 or 503")
+    parser.add_argument("--slow-every", type=int, default=25, help="stub model delays every Nth request")
+    parser.add_argument("--slow-delay", type=float, default=3.0, help="seconds added to the delayed stub requests")
+    parser.add_argument("--rpm", type=int, default=None, help="model requests per minute for the executor benchmark")
+    parser.add_argument("--tpm", type=int, default=None, help="model tokens per minute for the executor benchmark")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions replaying the end-to-end corpus")
+    parser.add_argument("--synthetic-rows", type=int, nargs="*", default=[100000, 1000000], help="daily rows of each synthetic database in the end-to-end run")
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="stub model seconds to first token in the end-to-end run")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="stub model seconds per token in the end-to-end run")
+    parser.add_argument("--output", default=None, help="end-to-end JSON report (default benchmark-results/e2e-<commit>.json)")
+    parser.add_argument("--baseline", default=None, help="earlier end-to-end JSON report to compare against")
+    parser.add_argument("--weeks", type=int, default=26, help="weeks in the workbook before the update benchmark adds one")
+    parser.add_argument("--daily-rows", type=int, default=500, help="order lines per day in the update benchmark workbook")
+    parser.add_argument("--corrections", type=int, default=20, help="first-week order lines the update benchmark workbook corrects")
+    parser.add_argument("--drift-every", type=int, default=5, help="stub model ignores the SQL_QUERY format on every Nth legacy reply (0 = never)")
+    args = parser.parse_args()
+    app_limits = {"rpm": "OPENAI_REQUESTS_PER_MINUTE", "tpm": "OPENAI_TOKENS_PER_MINUTE"}
+    for arg, constant in app_limits.items():
+        if getattr(args, arg) is None:
+            setattr(args, arg, getattr(load_app(), constant))
+    if args.iterations is None:
+        args.iterations = DEFAULT_ITERATIONS.get(args.benchmark, 100)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()